@@ -0,0 +1,82 @@
+"""
+Benchmark for the task bookkeeping of ExecutionContext.join.
+
+Schedules one tasklist on N nodes and lets the tasklists finish one
+after another, so that join wakes up once per finished task, and measures
+the CPU time the control host spends until join returns.  The cost per
+task should not depend on N.
+
+Run from the top-level directory:
+
+    python3 -m bench.join --sizes 1000,5000,20000
+"""
+
+import argparse
+import asyncio
+import time
+
+from src.gplmtlib import ExecutionContext
+from src.trace import Tracer
+
+
+class BenchNode:
+    def __init__(self, name):
+        self.name = name
+        self.turn = asyncio.get_running_loop().create_future()
+        self.next = None
+
+    async def run_tasklist(self, tasklist, var_env, stop_time):
+        await self.turn
+        if self.next is not None:
+            # let the next node finish in a later iteration of the loop
+            asyncio.get_running_loop().call_soon(self.next.finish)
+
+    def finish(self):
+        if not self.turn.done():
+            self.turn.set_result(None)
+
+
+class BenchTestbed:
+    def __init__(self, nodes):
+        self.nodes = dict((n.name, n) for n in nodes)
+        self.tracer = Tracer(enabled=False)
+        self.journal = None
+
+    def _resolve_target(self, target_name):
+        return [self.nodes[n] for n in target_name.split(' ')]
+
+
+async def run_join(size, sync_targets):
+    nodes = [BenchNode('n%d' % i) for i in range(size)]
+    for a, b in zip(nodes, nodes[1:]):
+        a.next = b
+    nodes[0].turn.set_result(None)
+    ec = ExecutionContext(BenchTestbed(nodes))
+    ec.schedule_tasklist(' '.join(n.name for n in nodes), None, background=False)
+    targets = None
+    if sync_targets:
+        # synchronize on the nodes that finish first
+        targets = nodes[:sync_targets]
+    start = time.process_time()
+    await ec.join(targets)
+    elapsed = time.process_time() - start
+    await ec.cancel_pending()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1000,2000,5000,10000",
+                        help="comma-separated numbers of scheduled tasks")
+    parser.add_argument("--sync-targets", type=int, default=0,
+                        help="join on the first N nodes only, like <synchronize targets=...>")
+    args = parser.parse_args()
+
+    print("%10s %12s %14s" % ("tasks", "cpu (s)", "cpu/task (us)"))
+    for size in [int(x) for x in args.sizes.split(',')]:
+        elapsed = asyncio.run(run_join(size, args.sync_targets))
+        print("%10d %12.3f %14.1f" % (size, elapsed, elapsed / size * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+Benchmark for the interpretation of compiled tasklists.
+
+Runs a generated tasklist (a 'par' of 'seq' branches with 'run' and
+'call' tasks) on N nodes whose commands finish immediately, and measures
+the CPU time the control host spends per task.  This is the overhead
+that is paid for every task on every node, on top of actually running
+the command.  The time for compiling the experiment is reported
+separately, it is only paid once.  With --trace, the tasks are traced
+like with gplmt-light.py --trace, to see what tracing costs.
+
+Run from the top-level directory:
+
+    python3 -m bench.plan --nodes 100 --width 4 --depth 25
+"""
+
+import argparse
+import asyncio
+import time
+
+import lxml.etree
+from lxml.builder import E
+
+from src.gplmtlib import LocalNode
+from src.plan import compile_experiment
+from src.trace import Tracer
+
+
+class BenchNode(LocalNode):
+    async def execute(self, pol, output=None, var_env={}):
+        pol.check_status(0)
+
+
+class BenchTestbed:
+    def __init__(self, trace=False):
+        self.logroot_dir = None
+        self.teardowns = []
+        self.tracer = Tracer(enabled=trace)
+
+    def begin_output(self, node, task_name):
+        return None
+
+
+def make_experiment(width, depth):
+    """Return the experiment document and the number of tasks in tasklist 'work'."""
+    branches = []
+    for b in range(width):
+        tasks = []
+        for d in range(depth):
+            if d % 5 == 4:
+                tasks.append(E.call(tasklist='leaf'))
+            else:
+                tasks.append(E.run('true', {'name': 'r%d.%d' % (b, d), 'expected-status': '0'}))
+        branches.append(E.seq(*tasks))
+    doc = E.experiment(
+        E.targets(),
+        E.tasklists(
+            E.tasklist(E.seq(E.run('true', name='leaf')), name='leaf'),
+            E.tasklist(E.par(*branches), name='work', timeout='PT1H')),
+        E.steps())
+    return lxml.etree.ElementTree(doc), width * depth
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", type=int, default=100,
+                        help="number of nodes that run the tasklist")
+    parser.add_argument("--width", type=int, default=4,
+                        help="number of parallel branches in the tasklist")
+    parser.add_argument("--depth", type=int, default=25,
+                        help="number of tasks in each branch")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="number of times the tasklist is run on all nodes")
+    parser.add_argument("--trace", action="store_true",
+                        help="trace the tasks")
+    args = parser.parse_args()
+
+    doc, num_tasks = make_experiment(args.width, args.depth)
+    start = time.process_time()
+    plan = compile_experiment(doc)
+    compile_time = time.process_time() - start
+
+    testbed = BenchTestbed(args.trace)
+    nodes = [BenchNode(E.target(name='n%d' % i, type='local'), testbed)
+             for i in range(args.nodes)]
+    tasklist = plan.tasklists['work']
+
+    async def run_all():
+        for r in range(args.repeat):
+            await asyncio.gather(*[n.run_tasklist(tasklist, {}, None) for n in nodes])
+
+    start = time.process_time()
+    asyncio.run(run_all())
+    elapsed = time.process_time() - start
+
+    total = num_tasks * args.nodes * args.repeat
+    print("compile: %.3f ms" % (compile_time * 1e3,))
+    print("%10s %12s %14s" % ("tasks", "cpu (s)", "cpu/task (us)"))
+    print("%10d %12.3f %14.1f" % (total, elapsed, elapsed / total * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+"""
+Local stand-in for the PlanetLab PLC API, and a benchmark for the
+discovery of slice nodes.
+
+FakePLCAPI serves GetSlices and GetNodes over XML-RPC for generated
+slices 'slice0', 'slice1', ... with nodes 'nodeN.sliceM.example.org'.
+Every call takes 'latency' seconds, like a far away PLC.  A fraction of
+the nodes is not booted or hasn't contacted PLC for a long time.  Any
+user is accepted with the password 'secret'.
+
+The benchmark fetches all slices one after the other (like gplmt did
+before slices were discovered concurrently), concurrently, and from
+the cache.  Run from the top-level directory:
+
+    python3 -m bench.plcapi --slices 8 --nodes 200 --latency 0.2
+
+With --serve, the stand-in just serves, so that experiments with
+planetlab targets can be run against it:
+
+    python3 -m bench.plcapi --serve --port 8000
+
+  <target name="pl" type="planetlab">
+    <apiurl>http://127.0.0.1:8000/</apiurl>
+    <slicename>slice0</slicename>
+    <user>me</user>
+  </target>
+"""
+
+import argparse
+import asyncio
+import random
+import socketserver
+import tempfile
+import threading
+import time
+import xmlrpc.server
+
+from src.planetlab import SliceCache, discover, fetch_slice, is_alive
+
+PASSWORD = 'secret'
+
+
+class ThreadingXMLRPCServer(socketserver.ThreadingMixIn, xmlrpc.server.SimpleXMLRPCServer):
+    daemon_threads = True
+
+
+class FakePLCAPI:
+    def __init__(self, num_slices, nodes_per_slice, latency=0.0, dead=0.1, seed=0):
+        self.latency = latency
+        rnd = random.Random(seed)
+        now = int(time.time())
+        # node id -> node
+        self.nodes = {}
+        # slice name -> node ids
+        self.slices = {}
+        for s in range(num_slices):
+            ids = []
+            for n in range(nodes_per_slice):
+                node_id = len(self.nodes) + 1
+                node = {
+                    'node_id': node_id,
+                    'hostname': 'node%d.slice%d.example.org' % (n, s),
+                    'boot_state': 'boot',
+                    'run_level': 'boot',
+                    'last_contact': now - rnd.randrange(600),
+                }
+                if rnd.random() < dead:
+                    if rnd.random() < 0.5:
+                        node['boot_state'] = node['run_level'] = 'safeboot'
+                    else:
+                        node['last_contact'] = now - 30 * 86400
+                self.nodes[node_id] = node
+                ids.append(node_id)
+            self.slices['slice%d' % (s,)] = ids
+
+    def _check(self, auth):
+        time.sleep(self.latency)
+        if auth.get('AuthString') != PASSWORD:
+            raise xmlrpc.server.Fault(103, "Invalid password")
+
+    def GetSlices(self, auth, slice_filter, fields):
+        self._check(auth)
+        return [{'name': name, 'node_ids': self.slices[name]}
+                for name in slice_filter if name in self.slices]
+
+    def GetNodes(self, auth, node_filter, fields):
+        self._check(auth)
+        return [{f: self.nodes[i].get(f) for f in fields}
+                for i in node_filter if i in self.nodes]
+
+    def serve(self, port=0):
+        """Start serving in a thread, return the server."""
+        server = ThreadingXMLRPCServer(('127.0.0.1', port), allow_none=True, logRequests=False)
+        server.register_function(self.GetSlices)
+        server.register_function(self.GetNodes)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--slices", type=int, default=8,
+                        help="number of slices")
+    parser.add_argument("--nodes", type=int, default=200,
+                        help="number of nodes per slice")
+    parser.add_argument("--latency", type=float, default=0.2,
+                        help="number of seconds every API call takes")
+    parser.add_argument("--dead", type=float, default=0.1,
+                        help="fraction of nodes that are not up")
+    parser.add_argument("--serve", action="store_true",
+                        help="only serve the API until interrupted")
+    parser.add_argument("--port", type=int, default=0,
+                        help="port to serve on")
+    args = parser.parse_args()
+
+    api = FakePLCAPI(args.slices, args.nodes, args.latency, args.dead)
+    server = api.serve(args.port)
+    api_url = 'http://127.0.0.1:%d/' % (server.server_address[1],)
+    if args.serve:
+        print("Serving %d slices on %s" % (args.slices, api_url))
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    auth = {'Username': 'bench', 'AuthString': PASSWORD, 'AuthMethod': 'password'}
+    slices = [(api_url, name) for name in api.slices]
+
+    start = time.monotonic()
+    for url, name in slices:
+        fetch_slice(url, auth, name)
+    sequential = time.monotonic() - start
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = SliceCache(cache_dir, ttl=3600)
+        start = time.monotonic()
+        results = asyncio.run(discover(slices, cache, get_auth=lambda i: auth))
+        concurrent = time.monotonic() - start
+
+        start = time.monotonic()
+        asyncio.run(discover(slices, cache, get_auth=lambda i: auth))
+        cached = time.monotonic() - start
+
+    now = time.time()
+    total = sum(len(r) for r in results)
+    alive = sum(1 for r in results for n in r if is_alive(n, 3600, now))
+    server.shutdown()
+
+    print("%d slices, %d nodes, %d up" % (len(slices), total, alive))
+    print("%12s %10s" % ("discovery", "time (s)"))
+    print("%12s %10.3f" % ("sequential", sequential))
+    print("%12s %10.3f" % ("concurrent", concurrent))
+    print("%12s %10.3f" % ("cached", cached))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,311 @@
+"""
+Benchmark of the scheduler on generated experiments.
+
+Generates experiments of a given size: N targets in G groups, each
+running a tasklist that is a 'seq' of DEPTH levels of 'par' with WIDTH
+'run' tasks, plus a 'call' to a tasklist of each of INCLUDES included
+files, repeated in a loop LOOPS times.  Every command is 'true', so
+what is measured is what the control host spends on scheduling.
+
+The experiments are run with gplmt-light.py as a separate process,
+against local targets and against ssh targets that are served by
+bench/fakessh/ssh, a stand-in for ssh that is put on PATH and runs the
+commands locally after a simulated network latency.  Every run is
+traced (gplmt-light.py --trace), and reported are
+
+  tasks/s       run tasks per second of running the steps
+  p50, p99      scheduling latency of the run tasks: from the start of
+                the task until its command was started, i.e. waiting for
+                ssh connection slots and master connections, and
+                spawning the command
+  cpu           CPU time of the gplmt process (not of the commands or
+                the ssh stand-in), including startup and compiling
+  cpu/task      the same per run task
+  rss           peak RSS of the gplmt process
+
+Run from the top-level directory:
+
+    python3 -m bench.scheduler --targets 10,100 --types local,ssh
+
+With --save FILE, the results are stored as a baseline, with --baseline
+FILE they are compared against a stored baseline, e.g. before and after
+a change:
+
+    python3 -m bench.scheduler --save /tmp/before.json
+    python3 -m bench.scheduler --baseline /tmp/before.json
+"""
+
+import argparse
+import bisect
+import collections
+import itertools
+import json
+import os
+import resource
+import runpy
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import lxml.etree
+from lxml.builder import E
+
+GPLMT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'gplmt-light.py')
+FAKE_SSH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fakessh')
+
+# Options for gplmt-light.py, so that connection rate limits
+# don't dominate the runs with ssh targets
+GPLMT_ARGS = [
+    '--batch', 'yes',
+    '--no-compile-cache',
+    '--output', 'raw',
+    '--ssh-cooldown', '0',
+    '--ssh-rate', '100000',
+    '--ssh-burst', '100000',
+    '--ssh-subnet-rate', '100000',
+    '--ssh-subnet-burst', '100000',
+]
+
+Scenario = collections.namedtuple('Scenario', 'type targets groups depth width loops includes')
+
+
+def scenario_name(sc):
+    return "%s n=%d g=%d d=%d w=%d l=%d i=%d" % sc
+
+
+def write_xml(filename, root):
+    lxml.etree.ElementTree(root).write(filename, xml_declaration=True, encoding='utf-8', pretty_print=True)
+
+
+def make_experiment(directory, sc):
+    """
+    Write the experiment of scenario 'sc' and its includes to 'directory'.
+    Return the filename and the number of run tasks it runs.
+    """
+    targets = []
+    for n in range(sc.targets):
+        if sc.type == 'local':
+            targets.append(E.target(name='n%d' % (n,), type='local'))
+        else:
+            targets.append(E.target(E.user('bench'), E.host('n%d.bench' % (n,)),
+                                    name='n%d' % (n,), type='ssh'))
+    groups = [[] for g in range(sc.groups)]
+    for n in range(sc.targets):
+        groups[n % sc.groups].append(E.target(ref='n%d' % (n,)))
+    for g, members in enumerate(groups):
+        targets.append(E.target(*members, name='g%d' % (g,), type='group'))
+
+    levels = []
+    for d in range(sc.depth):
+        runs = [E.run('true') for w in range(sc.width)]
+        levels.append(runs[0] if len(runs) == 1 else E.par(*runs))
+    for i in range(sc.includes):
+        write_xml(os.path.join(directory, 'inc%d.xml' % (i,)), E.experiment(
+                E.targets(),
+                E.tasklists(E.tasklist(E.seq(E.run('true')), name='lib')),
+                E.steps()))
+        levels.append(E.call(tasklist='inc%d.lib' % (i,)))
+
+    steps = [E.step(tasklist='work', targets='g%d' % (g,)) for g in range(sc.groups)]
+    if sc.loops > 1:
+        steps = [E.loop(*steps, repeat=str(sc.loops))]
+    doc = E.experiment(
+            *[E.include(file='inc%d.xml' % (i,), prefix='inc%d' % (i,)) for i in range(sc.includes)],
+            E.targets(*targets),
+            E.tasklists(E.tasklist(E.seq(*levels), name='work')),
+            E.steps(*steps))
+    filename = os.path.join(directory, 'experiment.xml')
+    write_xml(filename, doc)
+    return filename, sc.targets * sc.loops * (sc.depth * sc.width + sc.includes)
+
+
+def analyze(events):
+    """
+    Return the number of run tasks, the time the steps took, and the
+    sorted scheduling latencies of the run tasks in a trace.
+    """
+    # (pid, tid) -> spans of processes
+    processes = collections.defaultdict(list)
+    tasks = []
+    first = last = None
+    for ev in events:
+        if ev.get('ph') != 'X':
+            continue
+        step = ev['args'].get('step', '')
+        if step.startswith('step ') or step == 'end of steps':
+            first = ev['ts'] if first is None else min(first, ev['ts'])
+            last = max(last or 0, ev['ts'] + ev['dur'])
+        if ev['cat'] == 'process':
+            processes[(ev['pid'], ev['tid'])].append(ev)
+        elif ev['cat'] == 'task' and ev['name'].startswith('run '):
+            tasks.append(ev)
+    starts = {}
+    for lane, spans in processes.items():
+        spans.sort(key=lambda ev: ev['ts'])
+        starts[lane] = [ev['ts'] for ev in spans]
+    latencies = []
+    for task in tasks:
+        lane = (task['pid'], task['tid'])
+        spans = processes.get(lane)
+        if not spans:
+            continue
+        # The command of the task is the first one started on its lane after it
+        i = bisect.bisect_left(starts[lane], task['ts'])
+        if i == len(spans) or spans[i]['ts'] > task['ts'] + task['dur']:
+            continue
+        proc = spans[i]
+        latencies.append((proc['ts'] - task['ts']) / 1e6 + proc['args'].get('spawn', 0))
+    latencies.sort()
+    duration = 0 if first is None else (last - first) / 1e6
+    return len(tasks), duration, latencies
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def run_child(stats_file, argv):
+    """Run gplmt-light.py in this process and store its resource usage."""
+    sys.argv = [GPLMT] + argv
+    try:
+        runpy.run_path(GPLMT, run_name='__main__')
+    finally:
+        ru = resource.getrusage(resource.RUSAGE_SELF)
+        with open(stats_file, 'w') as f:
+            json.dump({'cpu': ru.ru_utime + ru.ru_stime, 'maxrss': ru.ru_maxrss * 1024}, f)
+
+
+def run_scenario(sc, latency, setup):
+    with tempfile.TemporaryDirectory() as directory:
+        filename, expected = make_experiment(directory, sc)
+        trace_file = os.path.join(directory, 'trace.json')
+        stats_file = os.path.join(directory, 'stats.json')
+        home = os.path.join(directory, 'home')
+        os.makedirs(os.path.join(home, '.ssh'))
+        env = dict(os.environ)
+        # Control paths end up in the temporary home directory
+        env['HOME'] = home
+        env['PATH'] = FAKE_SSH_DIR + os.pathsep + env.get('PATH', '')
+        env['FAKE_SSH_LATENCY'] = str(latency)
+        env['FAKE_SSH_SETUP'] = str(setup)
+        argv = [sys.executable, '-m', 'bench.scheduler', '--child', stats_file,
+                filename, '--rng', os.path.abspath('contrib/gplmt.rng'), '--trace', trace_file] + GPLMT_ARGS
+        start = time.monotonic()
+        proc = subprocess.run(argv, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        wall = time.monotonic() - start
+        if proc.returncode != 0 or not os.path.exists(trace_file):
+            sys.stderr.write(proc.stdout.decode('utf-8', 'replace'))
+            raise SystemExit("Run of '%s' failed" % (scenario_name(sc),))
+        with open(trace_file) as f:
+            events = json.load(f)['traceEvents']
+        with open(stats_file) as f:
+            stats = json.load(f)
+    tasks, duration, latencies = analyze(events)
+    if tasks != expected:
+        print("warning: %s ran %d of %d tasks" % (scenario_name(sc), tasks, expected), file=sys.stderr)
+    return {
+        'tasks': tasks,
+        'wall': wall,
+        'tasks_per_s': tasks / duration if duration else 0.0,
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+        'cpu': stats['cpu'],
+        'cpu_per_task': stats['cpu'] / tasks if tasks else 0.0,
+        'rss': stats['maxrss'],
+    }
+
+
+def median_run(runs):
+    """Of several runs, take the median of every number."""
+    return {k: statistics.median(r[k] for r in runs) for k in runs[0]}
+
+
+HEADER = "%-36s %7s %9s %9s %9s %8s %14s %9s" % (
+        "scenario", "tasks", "tasks/s", "p50 (ms)", "p99 (ms)", "cpu (s)", "cpu/task (us)", "rss (MB)")
+
+
+def format_result(name, r):
+    return "%-36s %7d %9.1f %9.2f %9.2f %8.3f %14.1f %9.1f" % (
+            name, r['tasks'], r['tasks_per_s'], r['p50'] * 1e3, r['p99'] * 1e3,
+            r['cpu'], r['cpu_per_task'] * 1e6, r['rss'] / 2**20)
+
+
+def format_change(name, r, base):
+    def change(key):
+        if not base.get(key):
+            return ""
+        return "%+.1f%%" % ((r[key] - base[key]) / base[key] * 100,)
+    return "%-36s %7s %9s %9s %9s %8s %14s %9s" % (
+            "  vs. baseline", "", change('tasks_per_s'), change('p50'), change('p99'),
+            change('cpu'), change('cpu_per_task'), change('rss'))
+
+
+def int_list(s):
+    return [int(x) for x in s.split(',')]
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == '--child':
+        run_child(sys.argv[2], sys.argv[3:])
+        return
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--types", default="local,ssh",
+                        help="comma-separated target types, 'local' and/or 'ssh'")
+    parser.add_argument("--targets", type=int_list, default=[10, 100],
+                        help="comma-separated numbers of targets")
+    parser.add_argument("--groups", type=int_list, default=[4],
+                        help="comma-separated numbers of groups the targets are split into")
+    parser.add_argument("--depth", type=int_list, default=[5],
+                        help="comma-separated numbers of levels of the tasklist")
+    parser.add_argument("--width", type=int_list, default=[2],
+                        help="comma-separated numbers of 'run' tasks in a 'par' of each level")
+    parser.add_argument("--loops", type=int_list, default=[2],
+                        help="comma-separated numbers of loop repetitions")
+    parser.add_argument("--includes", type=int_list, default=[1],
+                        help="comma-separated numbers of included files")
+    parser.add_argument("--latency", type=float, default=0.01,
+                        help="simulated round trip time of the ssh stand-in, in seconds")
+    parser.add_argument("--setup", type=float, default=0.05,
+                        help="simulated time to set up an ssh master connection, in seconds")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="number of runs per scenario, the median is reported")
+    parser.add_argument("--save", metavar="FILE",
+                        help="store the results as baseline in FILE")
+    parser.add_argument("--baseline", metavar="FILE",
+                        help="compare the results with the baseline in FILE")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+    scenarios = [Scenario(*p) for p in itertools.product(
+            args.types.split(','), args.targets, args.groups, args.depth,
+            args.width, args.loops, args.includes)]
+    results = {}
+    print(HEADER)
+    for sc in scenarios:
+        name = scenario_name(sc)
+        r = results[name] = median_run([run_scenario(sc, args.latency, args.setup) for i in range(args.repeat)])
+        print(format_result(name, r))
+        if name in baseline:
+            print(format_change(name, r, baseline[name]))
+        sys.stdout.flush()
+
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'python': sys.version,
+                'latency': args.latency,
+                'setup': args.setup,
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Benchmark for subprocess spawn throughput of the event loops.
+
+Runs N short commands with at most C of them at a time, the way
+LocalNode runs commands (through a shell, in a new session, with the
+output read from pipes), once on the default asyncio loop, once on
+uvloop if it is installed and once with the spawn worker pool
+(--local-spawn=pool), and reports the number of commands per second and
+the CPU time that the control process spends per command.
+
+Run from the top-level directory:
+
+    python3 -m bench.spawn --commands 2000 --concurrency 100
+"""
+
+import argparse
+import asyncio
+import subprocess
+import time
+
+from src.output import pump_output
+from src.spawn import SpawnPool
+
+
+class NullRecord:
+    def write(self, stream, data):
+        pass
+
+    async def drain(self):
+        pass
+
+
+async def run_command(sema, pool, command):
+    async with sema:
+        if pool is not None:
+            proc = await pool.create_subprocess_shell(
+                    command, {}, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        else:
+            proc = await asyncio.create_subprocess_shell(
+                    command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                    start_new_session=True)
+        await pump_output(proc, NullRecord())
+        await proc.wait()
+
+
+async def spawn_all(num, concurrency, command, workers):
+    sema = asyncio.Semaphore(concurrency)
+    pool = SpawnPool(workers) if workers else None
+    start = time.monotonic()
+    start_cpu = time.process_time()
+    try:
+        await asyncio.gather(*[run_command(sema, pool, command) for i in range(num)])
+    finally:
+        if pool is not None:
+            pool.close()
+    return time.monotonic() - start, time.process_time() - start_cpu
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--commands", type=int, default=2000,
+                        help="number of commands to run")
+    parser.add_argument("--concurrency", type=int, default=100,
+                        help="maximum number of commands running at the same time")
+    parser.add_argument("--command", default="echo hello",
+                        help="shell command to run")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="number of spawn workers for the pool")
+    args = parser.parse_args()
+
+    loops = [("asyncio", asyncio.new_event_loop, 0)]
+    try:
+        import uvloop
+    except ImportError:
+        print("uvloop is not installed, skipping it")
+    else:
+        loops.append(("uvloop", uvloop.new_event_loop, 0))
+    loops.append(("pool", asyncio.new_event_loop, args.workers))
+
+    print("%10s %10s %12s %14s" % ("loop", "time (s)", "commands/s", "cpu/cmd (us)"))
+    for name, new_loop, workers in loops:
+        loop = new_loop()
+        try:
+            elapsed, cpu = loop.run_until_complete(
+                    spawn_all(args.commands, args.concurrency, args.command, workers))
+        finally:
+            loop.close()
+        print("%10s %10.3f %12.1f %14.1f" % (name, elapsed, args.commands / elapsed,
+                                             cpu / args.commands * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -23,8 +23,12 @@ import asyncio
 import sys
 from copy import deepcopy
 import logging
+import os
 
+import src.dryrun as dryrun
 import src.gplmtlib as gplmtlib
+from src.compilecache import default_cache_dir
+from src.preflight import policy as preflight_policy
 
 parser = argparse.ArgumentParser()
 parser.add_argument(
@@ -32,20 +36,242 @@ parser.add_argument(
 parser.add_argument(
     "--rng",default="contrib/gplmt.rng", help="rng-File to validare XML experiment description against")
 parser.add_argument(
-    "--dry", "-d", help="do a dry run")
+    "--compile-cache",
+    metavar="DIR",
+    default=default_cache_dir(),
+    help="Directory where compiled experiments are cached, so that unchanged experiments "
+         "are not parsed and validated again.  The cache is on by default (default: %(default)s)")
+parser.add_argument(
+    "--no-compile-cache",
+    dest="compile_cache",
+    action="store_const",
+    const=None,
+    help="Don't use the compile cache")
+parser.add_argument(
+    "--dry", "-d",
+    action="store_true",
+    help="Don't run anything, simulate the experiment in virtual time and report how long it would take, "
+         "its critical path and how busy the ssh connection limits would be")
+parser.add_argument(
+    "--dry-estimates",
+    metavar="FILE",
+    action="append",
+    help="Trace of a past run (written with --trace) that the durations of commands, transfers and ssh "
+         "connection setup in a dry run are estimated from (can be given several times)")
+parser.add_argument(
+    "--dry-default-duration",
+    type=float,
+    default=1.0,
+    help="Number of seconds that commands take in a dry run if there is no estimate for them")
+parser.add_argument(
+    "--dry-ssh-setup",
+    type=float,
+    default=0.5,
+    help="Number of seconds that setting up an ssh master connection takes in a dry run "
+         "if there is no estimate for it")
 parser.add_argument(
     "--batch", help="disable all interaction (e.g. password prompts)")
 parser.add_argument(
     "--logroot-dir", help="Root directory for logs, will be created if necessary")
+parser.add_argument(
+    "--journal",
+    metavar="FILE",
+    help="Journal the progress of the experiment in FILE, so that it can be resumed with --resume "
+         "(default: 'journal' in --logroot-dir, if given)")
+parser.add_argument(
+    "--resume",
+    action="store_true",
+    help="Resume an experiment that was interrupted: skip the tasklists that the journal says "
+         "have finished, and run the rest and all registered teardowns")
+parser.add_argument(
+    "--log-segment-size",
+    type=int,
+    default=64 << 20,
+    help="Size in bytes after which a new segment of a node's output log is started")
+parser.add_argument(
+    "--log-buffer-size",
+    type=int,
+    default=64 << 10,
+    help="Number of bytes of output that are buffered per command before they are written to the log")
+parser.add_argument(
+    "--log-compress",
+    action="store_true",
+    help="Compress the output of commands in the log")
+parser.add_argument(
+    "--output",
+    choices=["prefix", "collapse", "raw"],
+    default="prefix",
+    help="How the output of commands is shown without --logroot-dir: lines prefixed with node and task, "
+         "identical output of nodes shown once, or written by the commands directly")
+parser.add_argument(
+    "--output-interval",
+    type=float,
+    default=1.0,
+    help="Number of seconds that output is collected before it is shown with --output=collapse")
 parser.add_argument(
     "--ssh-cooldown",
+    type=float,
     default=1.0,
-    help="Number of seconds to wait between ssh connections")
-# Token bucket
+    help="Number of seconds to wait between new ssh connections to the same host "
+         "(before, between any two new ssh connections; see --ssh-rate for that)")
+parser.add_argument(
+    "--ssh-rate",
+    type=float,
+    default=10.0,
+    help="Maximum number of new ssh connections per second over all hosts")
+parser.add_argument(
+    "--ssh-burst",
+    type=int,
+    default=30,
+    help="Number of new ssh connections that may exceed --ssh-rate in a burst")
+parser.add_argument(
+    "--ssh-subnet-rate",
+    type=float,
+    default=0.0,
+    help="Maximum number of new ssh connections per second into one subnet (0 for no limit per subnet)")
+parser.add_argument(
+    "--ssh-subnet-burst",
+    type=int,
+    default=5,
+    help="Number of new ssh connections into one subnet that may exceed --ssh-subnet-rate in a burst")
+parser.add_argument(
+    "--ssh-subnet-prefix",
+    type=int,
+    default=24,
+    help="Prefix length that groups IPv4 targets into subnets (host names are grouped by domain)")
 parser.add_argument(
     "--ssh-parallelism",
+    type=int,
     default=30,
-    help="Maximum number of concurrently opened ssh connections")
+    help="Maximum number of concurrently opened ssh connections (the initial one with --ssh-parallelism-adaptive)")
+parser.add_argument(
+    "--ssh-parallelism-adaptive",
+    action="store_true",
+    help="Adapt the number of concurrently opened ssh connections while the experiment runs: "
+         "increase it while connections are set up quickly and without errors, halve it on errors "
+         "or when file descriptors run out")
+parser.add_argument(
+    "--ssh-parallelism-min",
+    type=int,
+    default=4,
+    help="Lower bound for --ssh-parallelism-adaptive")
+parser.add_argument(
+    "--ssh-parallelism-max",
+    type=int,
+    default=256,
+    help="Upper bound for --ssh-parallelism-adaptive")
+parser.add_argument(
+    "--ssh-max-sessions",
+    type=int,
+    default=10,
+    help="Maximum number of concurrent sessions on one ssh master connection (see MaxSessions in sshd_config)")
+parser.add_argument(
+    "--ssh-master-retries",
+    type=int,
+    default=3,
+    help="Number of retries with exponential backoff when creating an ssh master connection fails")
+parser.add_argument(
+    "--ssh-master-check-interval",
+    type=float,
+    default=300.0,
+    help="Number of seconds after which an ssh master connection is checked again before it is used")
+parser.add_argument(
+    "--preflight",
+    metavar="POLICY",
+    type=preflight_policy,
+    help="Check that all ssh targets are reachable before the first step, and leave out the ones that aren't. "
+         "POLICY is what happens if some aren't: 'fail' stops the experiment, 'skip' runs it on the others, "
+         "'N%%' runs it on the others if they are at least N%% of all ssh targets")
+parser.add_argument(
+    "--preflight-deadline",
+    type=float,
+    default=30.0,
+    help="Number of seconds that the master connection of an ssh target may take to set up in the --preflight "
+         "check, not counting the wait for --ssh-parallelism and the connection rate limits")
+parser.add_argument(
+    "--preflight-connect-timeout",
+    type=float,
+    default=5.0,
+    help="Number of seconds to wait for the TCP connection to the ssh port in the --preflight check")
+parser.add_argument(
+    "--broadcast-width",
+    type=int,
+    default=4,
+    help="Fan-out of the distribution tree for put tasks with broadcast=\"true\"")
+parser.add_argument(
+    "--agent",
+    action="store_true",
+    help="Run tasklists on ssh targets with a remote agent in one ssh session (see the 'agent' attribute of tasklists)")
+parser.add_argument(
+    "--agent-python",
+    default="python3",
+    help="Python interpreter that runs the agent on ssh targets")
+parser.add_argument(
+    "--local-spawn",
+    choices=["loop", "pool"],
+    default="loop",
+    help="Start commands on local targets from the event loop, or with a pool of posix_spawn workers "
+         "(for experiments that run many local commands, needs Python >= 3.9)")
+parser.add_argument(
+    "--local-spawn-workers",
+    type=int,
+    default=4,
+    help="Number of spawn workers for --local-spawn=pool")
+parser.add_argument(
+    "--pl-cache-dir",
+    metavar="DIR",
+    default=os.path.join(default_cache_dir(), "planetlab"),
+    help="Directory where the node lists of PlanetLab slices are cached (default: %(default)s)")
+parser.add_argument(
+    "--no-pl-cache",
+    dest="pl_cache_dir",
+    action="store_const",
+    const=None,
+    help="Don't cache the node lists of PlanetLab slices")
+parser.add_argument(
+    "--pl-cache-ttl",
+    type=float,
+    default=3600.0,
+    help="Number of seconds that a cached node list of a PlanetLab slice is used without asking the API")
+parser.add_argument(
+    "--pl-offline",
+    action="store_true",
+    help="Use the cached node lists of PlanetLab slices however old they are, never ask the API")
+parser.add_argument(
+    "--pl-max-contact-age",
+    type=float,
+    default=3600.0,
+    help="Leave out PlanetLab nodes that haven't contacted PLC for this many seconds (0 to disable)")
+parser.add_argument(
+    "--pl-all-nodes",
+    action="store_true",
+    help="Use all nodes of PlanetLab slices, also the ones that are not booted")
+parser.add_argument(
+    "--trace",
+    metavar="FILE",
+    help="Write a trace of the experiment to FILE (Chrome trace format, can be opened with Perfetto): "
+         "when tasklists, tasks and commands ran on every node, and how long they waited")
+parser.add_argument(
+    "--trace-summary",
+    metavar="FILE",
+    help="Write a summary of the trace to FILE ('-' for standard output): the time spent per step "
+         "in tasks, commands and waiting for ssh connections, transfers and synchronization")
+parser.add_argument(
+    "--loop",
+    choices=["asyncio", "uvloop"],
+    default="asyncio",
+    help="Event loop implementation (uvloop must be installed separately)")
+parser.add_argument(
+    "--start-prewarm",
+    type=float,
+    default=0.0,
+    help="Number of seconds before a step with a start time that the master connections of its ssh targets "
+         "are set up; a connection slot and a session for the first command are reserved shortly before "
+         "the start, so that it starts on time (default: 0, off)")
+parser.add_argument(
+    "--no-ssh-warmup",
+    action="store_true",
+    help="Don't establish ssh master connections to all targets before the first step")
 
 args = parser.parse_args()
 
@@ -54,6 +280,17 @@ logging.basicConfig(
             datefmt='%Y-%m-%d %T %Z',
             level=logging.WARNING)
 
+if args.loop == "uvloop":
+    try:
+        import uvloop
+    except ImportError:
+        print("Fatal: --loop=uvloop requires the uvloop package")
+        sys.exit(1)
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
 experiment = gplmtlib.Experiment.from_file(args.experiment_file, settings=args)
-experiment.run_synchronous()
+if args.dry:
+    dryrun.run(experiment, args)
+else:
+    experiment.run_synchronous()
 
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+#
+#  gplmt-light, a lightweight distributed testbed controller
+#  Copyright (C) 2015  Florian Dold
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Remote agent for gplmt.
+
+The agent is copied to SSH targets and runs a whole tasklist there in one
+session.  It reads one JSON request from stdin:
+
+  {"plan": <task>, "env": {...}, "timeout": <seconds or null>}
+
+where a task is one of
+
+  {"type": "seq", "children": [<task>, ...]}
+  {"type": "par", "children": [<task>, ...]}
+  {"type": "run", "id": <n>, "command": "...", "expected_status": <n or null>}
+  {"type": "fail"}
+
+and reports progress as JSON lines on stdout ("start", "output", "exit")
+followed by a final "done" event that carries an "error" if the tasklist
+failed, and "timeout": true if that is because the timeout ran out.
+Output data is latin-1 decoded, so that arbitrary bytes survive JSON.
+
+When stdin is closed, all running commands are killed.
+
+This file must only depend on the standard library, since it
+runs with whatever Python is installed on the target.
+"""
+
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+CHUNK = 4096
+
+
+class Failure(Exception):
+    pass
+
+
+class Timeout(Failure):
+    def __init__(self):
+        super().__init__("timeout")
+
+
+class Agent:
+    def __init__(self, env, timeout):
+        self.env = dict(os.environ)
+        self.env.update(env)
+        self.deadline = None
+        if timeout is not None:
+            self.deadline = time.time() + timeout
+        self.out_lock = threading.Lock()
+        self.procs = set()
+        self.procs_lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def emit(self, **event):
+        line = json.dumps(event) + '\n'
+        with self.out_lock:
+            sys.stdout.write(line)
+            sys.stdout.flush()
+
+    def kill_all(self):
+        self.stopped.set()
+        with self.procs_lock:
+            for proc in self.procs:
+                try:
+                    os.killpg(proc.pid, signal.SIGTERM)
+                except OSError:
+                    pass
+
+    def watch_stdin(self):
+        # The controller closes stdin when it is done with us,
+        # or ssh does it when the controller went away.
+        while os.read(sys.stdin.fileno(), CHUNK):
+            pass
+        self.kill_all()
+
+    def pump(self, task_id, stream, pipe):
+        fd = pipe.fileno()
+        while True:
+            data = os.read(fd, CHUNK)
+            if not data:
+                break
+            self.emit(event='output', id=task_id, stream=stream, data=data.decode('latin-1'))
+        pipe.close()
+
+    def run_task(self, task):
+        if self.stopped.is_set():
+            raise Failure("stopped")
+        if self.deadline is not None and time.time() >= self.deadline:
+            raise Timeout()
+        tp = task['type']
+        if tp == 'seq':
+            for child in task['children']:
+                self.run_task(child)
+            return
+        if tp == 'par':
+            errors = []
+
+            def run_child(child):
+                try:
+                    self.run_task(child)
+                except Failure as e:
+                    errors.append(e)
+            threads = [threading.Thread(target=run_child, args=(child,)) for child in task['children']]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            if errors:
+                raise errors[0]
+            return
+        if tp == 'fail':
+            raise Failure("user-requested fail")
+        if tp == 'run':
+            self.run_command(task)
+            return
+        raise Failure("Unknown task type '%s'" % (tp,))
+
+    def run_command(self, task):
+        task_id = task['id']
+        self.emit(event='start', id=task_id)
+        proc = subprocess.Popen(
+                task['command'], shell=True, env=self.env,
+                stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                start_new_session=True)
+        with self.procs_lock:
+            self.procs.add(proc)
+        pumps = [
+            threading.Thread(target=self.pump, args=(task_id, 'out', proc.stdout)),
+            threading.Thread(target=self.pump, args=(task_id, 'err', proc.stderr)),
+        ]
+        for t in pumps:
+            t.start()
+        timeout = None
+        if self.deadline is not None:
+            timeout = max(0, self.deadline - time.time())
+        timed_out = False
+        try:
+            status = proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            timed_out = True
+            try:
+                os.killpg(proc.pid, signal.SIGTERM)
+            except OSError:
+                pass
+            status = proc.wait()
+        for t in pumps:
+            t.join()
+        with self.procs_lock:
+            self.procs.discard(proc)
+        if status < 0:
+            # Report signals like a shell would
+            status = 128 - status
+        self.emit(event='exit', id=task_id, status=status)
+        if timed_out:
+            raise Timeout()
+        if self.stopped.is_set():
+            raise Failure("stopped")
+        expected = task.get('expected_status')
+        if expected is not None and expected != status:
+            raise Failure("Unexpected status")
+
+
+def main():
+    request = json.loads(sys.stdin.buffer.readline().decode('utf-8'))
+    agent = Agent(request.get('env', {}), request.get('timeout'))
+    watchdog = threading.Thread(target=agent.watch_stdin)
+    watchdog.daemon = True
+    watchdog.start()
+    try:
+        agent.run_task(request['plan'])
+    except Timeout as e:
+        agent.emit(event='done', error=str(e), timeout=True)
+    except Failure as e:
+        agent.emit(event='done', error=str(e))
+    except Exception as e:
+        agent.emit(event='done', error="Agent error: %r" % (e,))
+    else:
+        agent.emit(event='done')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+import asyncio
+from collections import OrderedDict
+
+__all__ = [
+    "Broadcast",
+]
+
+
+class Broadcast:
+    """
+    Distribution of one file to many nodes along a tree.
+
+    Every node that received and verified its copy becomes a holder
+    and forwards the file to up to 'width' other nodes at a time.  The
+    control host uploads the file to up to 'width' nodes at a time when
+    no holder is free.
+    """
+    def __init__(self, width):
+        self.width = max(int(width), 1)
+        # number of uploads by the control host in flight
+        self.direct = 0
+        # number of transfers in flight
+        self.pending = 0
+        # holder node -> number of forwards in flight
+        self.holders = OrderedDict()
+        self.cond = asyncio.Condition()
+
+    def _take_holder(self, node):
+        for holder, load in self.holders.items():
+            if holder is not node and load < self.width:
+                self.holders[holder] = load + 1
+                return holder
+        return None
+
+    def _others_hold(self, node):
+        return any(holder is not node for holder in self.holders)
+
+    def has_holder(self, node):
+        """Whether 'node' received and verified the file already."""
+        return node in self.holders
+
+    async def acquire(self, node):
+        """
+        Wait until a transfer to 'node' can be started, and return the
+        node the file should be received from.  None means the control
+        host.  'node' itself is never returned.
+        """
+        await self.cond.acquire()
+        try:
+            while True:
+                # Forwarding doesn't load the uplink of the control
+                # host, so holders go first
+                parent = self._take_holder(node)
+                if parent is None:
+                    if self.direct >= self.width and (self._others_hold(node) or self.pending):
+                        await self.cond.wait()
+                        continue
+                    # Either the control host has a free upload, or
+                    # nobody is left that could ever forward the
+                    # file to us, so we need a direct upload.
+                    self.direct += 1
+                self.pending += 1
+                return parent
+        finally:
+            self.cond.release()
+
+    async def done(self, parent, node, received, parent_failed=False):
+        """
+        Report that the transfer from 'parent' (acquired with 'acquire')
+        to 'node' is finished.  If 'parent_failed', the transfer failed
+        on the side of 'parent', which is not used for forwarding any
+        more.
+        """
+        await self.cond.acquire()
+        try:
+            self.pending -= 1
+            if parent is None:
+                self.direct -= 1
+            elif parent in self.holders:
+                if parent_failed:
+                    del self.holders[parent]
+                else:
+                    self.holders[parent] -= 1
+            if received:
+                self.holders[node] = 0
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    async def add_holder(self, node):
+        await self.cond.acquire()
+        try:
+            self.holders.setdefault(node, 0)
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    async def remove_holder(self, node):
+        """Don't use 'node' for forwarding any more, its copy is gone."""
+        await self.cond.acquire()
+        try:
+            self.holders.pop(node, None)
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
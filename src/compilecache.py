@@ -0,0 +1,128 @@
+"""
+On-disk cache of compiled experiments.
+
+Loading an experiment parses the schema, validates the document,
+names anonymous tasks, expands the includes and compiles the execution
+plan.  For an experiment that is run again and again without changes,
+all of that can be skipped: the plan and the targets are stored in the
+cache directory under a key that is a hash of
+
+  - the contents of the experiment file and its absolute path, which
+    relative includes are resolved against,
+  - the contents of the schema,
+  - the source of the code that compiles experiments and the Python
+    version, so that entries of an older gplmt are never used.
+
+The includes are only known after the experiment has been expanded, so
+every entry also lists the include files that were read, with a hash of
+their contents.  An entry is only used if all of them still resolve to
+the same files with the same contents.
+
+Nothing that depends on the environment of the control host is stored:
+'export-env' variables without a value are read when their step runs.
+"""
+
+import copy
+import hashlib
+import logging
+import os
+import pickle
+import sys
+import tempfile
+
+import lxml.etree
+
+from src.helper import resolve_include
+
+__all__ = [
+    "CompileCache",
+    "default_cache_dir",
+]
+
+# Modules whose code ends up in cache entries
+_COMPILER_SOURCES = [
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+    for name in ('compilecache.py', 'gplmtlib.py', 'helper.py', 'plan.py')
+]
+
+
+def default_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'gplmt')
+
+
+def file_digest(filename):
+    with open(filename, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class CacheEntry:
+    __slots__ = ('targets_xml', 'plan', 'includes')
+
+    def __init__(self, targets_xml, plan, includes):
+        self.targets_xml = targets_xml
+        self.plan = plan
+        # see process_includes
+        self.includes = includes
+
+
+class CompileCache:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def key(self, filename, rng_file):
+        h = hashlib.sha256()
+        h.update(sys.version.encode('utf-8'))
+        for name in _COMPILER_SOURCES:
+            h.update(file_digest(name).encode('ascii'))
+        h.update(file_digest(rng_file).encode('ascii'))
+        h.update(os.path.realpath(filename).encode('utf-8'))
+        h.update(file_digest(filename).encode('ascii'))
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.pickle')
+
+    def load(self, key):
+        """Return the entry stored under 'key' or None."""
+        try:
+            with open(self._path(key), 'rb') as f:
+                stored = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning("Ignoring broken compile cache entry %s (%s)", key, e)
+            return None
+        for parent, name, resolved, digest in stored['includes']:
+            try:
+                if resolve_include(name, parent) != resolved or file_digest(resolved) != digest:
+                    return None
+            except OSError:
+                return None
+        targets_xml = lxml.etree.ElementTree(lxml.etree.fromstring(stored['targets']))
+        return CacheEntry(targets_xml, stored['plan'], stored['includes'])
+
+    def store(self, key, includes, experiment_xml, plan):
+        """
+        Store the plan and the targets of an experiment.  'includes' is
+        the list that process_includes filled in.
+        """
+        root = lxml.etree.Element('experiment')
+        root.extend(copy.deepcopy(t) for t in experiment_xml.xpath('/experiment/targets'))
+        stored = {
+            'includes': includes,
+            'targets': lxml.etree.tostring(root),
+            'plan': plan,
+        }
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    pickle.dump(stored, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp, self._path(key))
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        except OSError as e:
+            logging.warning("Could not store experiment in compile cache (%s)", e)
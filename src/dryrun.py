@@ -0,0 +1,446 @@
+"""
+Dry run of an experiment in virtual time.
+
+The experiment is run by the same code as a real one, so with the same
+semantics of steps, loops, synchronization, start and stop times, and
+the same ssh connection limits, but on an event loop whose clock only
+moves forward when nothing is left to do until the next timer, and on
+simulated nodes: a command sleeps for as long as it is estimated to
+take and then succeeds, and so do transfers and setting up ssh master
+connections.  Nothing is started on the targets, and hours of experiment
+are simulated in a fraction of a second.
+
+How long commands take is estimated from traces of past runs (written
+with --trace), per node and run task, or over all nodes for a run task;
+commands without estimate that are just 'sleep N' take N seconds, all
+others --dry-default-duration.
+
+At the end, a report is printed: the predicted makespan, the critical
+path (the tasklists that the end of the experiment waited for, one after
+the other), how many ssh connections were open at most, and when the ssh
+connection limit (--ssh-parallelism) and the connection rate limits
+started to hold up sessions.
+"""
+
+import asyncio
+import bisect
+import collections
+import json
+import logging
+import re
+import selectors
+import statistics
+import sys
+import time
+
+from src.gplmtlib import LocalNode, SSHNode, Testbed, note_started
+from src.sshpool import MasterPool
+from src.trace import Tracer
+
+__all__ = [
+    "Estimates",
+    "VirtualTimeLoop",
+    "run",
+]
+
+# Commands that take a known time without estimate
+SLEEP = re.compile(r'^\s*sleep\s+(\d+(?:\.\d*)?)\s*;?\s*$')
+
+# Shortest time a simulated command takes, so that loops that run until
+# a deadline make progress
+MIN_DURATION = 0.001
+
+
+class _VirtualSelector(selectors.DefaultSelector):
+    def __init__(self, loop):
+        super().__init__()
+        self.loop = loop
+
+    def select(self, timeout=None):
+        loop = self.loop
+        if timeout is None or timeout <= 0 or loop.executing:
+            return super().select(timeout)
+        events = super().select(0)
+        if not events:
+            # Nothing to do until the next timer
+            loop.virtual_time += timeout
+        return events
+
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    """
+    Event loop whose clock starts at 0 and jumps to the next timer when
+    no callbacks are ready.  While functions run in the executor, the
+    loop waits for them in real time.
+    """
+    def __init__(self):
+        self.virtual_time = 0.0
+        # number of pending run_in_executor calls
+        self.executing = 0
+        super().__init__(_VirtualSelector(self))
+
+    def time(self):
+        return self.virtual_time
+
+    def run_in_executor(self, executor, func, *args):
+        fut = super().run_in_executor(executor, func, *args)
+        self.executing += 1
+        fut.add_done_callback(self._executed)
+        return fut
+
+    def _executed(self, fut):
+        self.executing -= 1
+
+
+class Estimates:
+    """
+    Durations of commands, transfers and ssh master setup, from traces
+    of past runs.
+    """
+    def __init__(self, default=1.0, ssh_setup=0.5):
+        self.default = default
+        self.ssh_setup = ssh_setup
+        # (node, task label) -> durations, task label -> durations
+        self.by_node = collections.defaultdict(list)
+        self.by_label = collections.defaultdict(list)
+        # node -> setup times of master connections
+        self.setup_by_node = collections.defaultdict(list)
+        self.setup_all = []
+        # where the estimates of commands came from -> count
+        self.sources = collections.Counter()
+
+    def load(self, filename):
+        """Add the durations in the trace 'filename'."""
+        with open(filename, 'r', encoding='utf-8') as f:
+            trace = json.load(f)
+        self.add_trace(trace['traceEvents'])
+
+    def add_trace(self, events):
+        # (pid, tid) -> process spans, sorted by start
+        processes = collections.defaultdict(list)
+        tasks = []
+        for ev in events:
+            if ev.get('ph') != 'X':
+                continue
+            cat = ev['cat']
+            if cat == 'process':
+                processes[(ev['pid'], ev['tid'])].append(ev)
+            elif cat == 'task':
+                tasks.append(ev)
+            elif cat == 'master setup' and 'error' not in ev['args']:
+                setup = ev['dur'] / 1e6
+                self.setup_by_node[ev['args']['node']].append(setup)
+                self.setup_all.append(setup)
+        starts = {}
+        for lane, spans in processes.items():
+            spans.sort(key=lambda ev: ev['ts'])
+            starts[lane] = [ev['ts'] for ev in spans]
+        for task in tasks:
+            if 'error' in task['args']:
+                continue
+            # The commands of a task run on its lane while it runs
+            lane = (task['pid'], task['tid'])
+            spans = processes.get(lane, ())
+            end = task['ts'] + task['dur']
+            i = bisect.bisect_left(starts.get(lane, ()), task['ts'])
+            duration = 0.0
+            found = False
+            while i < len(spans) and spans[i]['ts'] <= end:
+                duration += spans[i]['dur'] / 1e6
+                found = True
+                i += 1
+            if not found:
+                continue
+            self.by_node[(task['args']['node'], task['name'])].append(duration)
+            self.by_label[task['name']].append(duration)
+
+    def _lookup(self, node, label):
+        durations = self.by_node.get((node, label))
+        if not durations:
+            durations = self.by_label.get(label)
+        if not durations:
+            return None
+        return max(statistics.median(durations), MIN_DURATION)
+
+    def command(self, node, pol):
+        """Seconds that the command of 'pol' takes on 'node'."""
+        name = getattr(pol, 'task_name', None)
+        if name is not None:
+            duration = self._lookup(node, 'run ' + name)
+            if duration is not None:
+                self.sources['trace'] += 1
+                return duration
+        m = SLEEP.match(pol.command)
+        if m is not None:
+            self.sources['sleep'] += 1
+            return max(float(m.group(1)), MIN_DURATION)
+        self.sources['default'] += 1
+        return max(self.default, MIN_DURATION)
+
+    def transfer(self, node, kind):
+        """Seconds that a 'put', 'get' or 'transfer' task takes on 'node'."""
+        duration = self._lookup(node, kind)
+        if duration is None:
+            return max(self.default, MIN_DURATION)
+        return duration
+
+    def master_setup(self, node):
+        """Seconds that setting up the master connection to 'node' takes."""
+        setups = self.setup_by_node.get(node) or self.setup_all
+        if not setups:
+            return self.ssh_setup
+        return statistics.median(setups)
+
+
+class DryProcess:
+    """What an ssh session runs in a dry run."""
+    returncode = 0
+
+    async def wait(self):
+        return 0
+
+    def terminate(self):
+        pass
+
+
+class DryMasterPool(MasterPool):
+    """Master connections that take their estimated setup time, and always work."""
+    def __init__(self, estimates, **kwargs):
+        super().__init__(**kwargs)
+        self.estimates = estimates
+
+    async def _run(self, argv, quiet=False):
+        return 0
+
+    async def _establish(self, node, st, pause):
+        if self._fresh(st):
+            return
+        if not st.owned:
+            await asyncio.sleep(self.estimates.master_setup(node.name))
+        # else it is checked again, which takes no time here
+        st.alive = True
+        st.owned = True
+        st.verified = asyncio.get_running_loop().time()
+
+
+class DryLocalNode(LocalNode):
+    async def _execute(self, pol, output, env, span):
+        span.mark('spawn')
+        note_started(self)
+        try:
+            await asyncio.sleep(self.testbed.estimates.command(self.name, pol))
+        except asyncio.CancelledError:
+            logging.info("Local command terminated due to timeout or stop_time.")
+            raise
+
+
+class DrySSHNode(SSHNode):
+    def use_agent(self, tasklist):
+        return False
+
+    async def create_process(self, argv, stdin, stdout, stderr):
+        return DryProcess()
+
+    async def _simulate(self, duration):
+        """Run an ssh session that takes 'duration' seconds."""
+        return await self.session('true', handler=lambda proc: asyncio.sleep(duration))
+
+    async def execute(self, pol, output=None, var_env={}):
+        duration = self.testbed.estimates.command(self.name, pol)
+        try:
+            await self._simulate(duration)
+        except asyncio.CancelledError:
+            logging.info("SSH command terminated due to timeout or stop_time.")
+            raise
+
+    async def _run_task(self, task, var_env):
+        if task.kind not in ('put', 'get', 'transfer'):
+            await super()._run_task(task, var_env)
+            return
+        # Transfers are one session each, broadcasts are plain puts
+        with self.testbed.tracer.span('task', task.kind):
+            if task.kind == 'put':
+                puts = (task,)
+            elif task.kind == 'transfer':
+                puts = task.puts
+            else:
+                puts = ()
+            for put in puts:
+                self._register_put_cleanup(put, self._copy_paths(put)[1])
+            await self._simulate(self.testbed.estimates.transfer(self.name, task.kind))
+
+
+class DryTestbed(Testbed):
+    def __init__(self, targets_xml, settings, estimates):
+        self.estimates = estimates
+        super().__init__(targets_xml, settings)
+        loop = asyncio.get_running_loop()
+        self.loop = loop
+        self.origin = loop.time()
+        self.wall_start = time.time()
+        self.real_start = time.monotonic()
+        # virtual time when the teardowns started
+        self.steps_end = None
+        # Nothing is written but the trace, if asked for
+        self.logroot_dir = None
+        self.output = None
+        self.tracer = Tracer(clock=loop.time)
+        self.master_pool = DryMasterPool(
+                estimates,
+                check_interval=settings.ssh_master_check_interval,
+                retries=settings.ssh_master_retries,
+                max_sessions=settings.ssh_max_sessions)
+
+    def make_node(self, tp, el):
+        if tp == 'local':
+            return DryLocalNode(el, testbed=self)
+        return DrySSHNode(el, testbed=self)
+
+    def wall_time(self):
+        return self.wall_start + self.loop.time() - self.origin
+
+    def open_journal(self, filename, tasklists, includes=()):
+        pass
+
+    async def preflight(self):
+        # All targets are assumed to be reachable
+        await self.establish_masters()
+
+    async def run_teardowns(self):
+        self.steps_end = self.loop.time()
+        await super().run_teardowns()
+
+    async def close_output(self):
+        makespan = self.loop.time() - self.origin
+        for line in self.report(makespan):
+            print(line)
+        sys.stdout.flush()
+        await super().close_output()
+
+    def report(self, makespan):
+        """The predictions of the dry run, as lines."""
+        origin = self.origin
+        spans = self.tracer.spans
+        lines = []
+        lines.append("Dry run, simulated in %.3fs" % (time.monotonic() - self.real_start,))
+        makespan_line = "predicted makespan: %.3fs" % (makespan,)
+        if self.steps_end is not None:
+            makespan_line += " (steps %.3fs, teardowns %.3fs)" % (
+                    self.steps_end - origin, makespan - (self.steps_end - origin))
+        lines.append(makespan_line)
+        sources = self.estimates.sources
+        lines.append("commands: %d estimated from traces, %d sleeps, %d with the default of %.3fs" % (
+                sources['trace'], sources['sleep'], sources['default'], self.estimates.default))
+
+        if self._ssh_nodes():
+            ssh = self.ssh_limiter.stats()
+            lines.append("ssh connections: peak %(peak_in_use)d open at a time (limit %(limit)d)" % ssh)
+            for kind, what in (('semaphore wait', 'ssh connection limit'),
+                               ('cooldown wait', 'ssh connection rate limits')):
+                waits = [(s[4] - origin, s[5] - s[4]) for s in spans if s[0] == kind and s[5] > s[4]]
+                if not waits:
+                    lines.append("%s: never reached" % (what,))
+                    continue
+                lines.append("%s: reached at %.3fs, %d sessions waited %.3fs in total (at most %.3fs)" % (
+                        what, min(w[0] for w in waits), len(waits),
+                        sum(w[1] for w in waits), max(w[1] for w in waits)))
+
+        lines.append("critical path:")
+        lines.append("  %10s %10s  %-20s %-24s %-24s %s" % (
+                "start", "duration", "node", "tasklist", "longest task", "step"))
+        # Runs of the same tasklist on the same node in the same step,
+        # e.g. in a loop, are shown as one
+        rows = []
+        for start, end, step, node, label, longest in critical_path(spans, origin + makespan):
+            if rows and rows[-1][2:5] == [step, node, label] and start - rows[-1][1] <= 1e-6:
+                row = rows[-1]
+                row[1] = end
+                row[5] += 1
+                if longest is not None and (row[6] is None or longest[5] - longest[4] > row[6][5] - row[6][4]):
+                    row[6] = longest
+                continue
+            rows.append([start, end, step, node, label, 1, longest])
+        last = origin
+        for start, end, step, node, label, count, longest in rows:
+            if start - last > 1e-6:
+                # Setting up master connections, or a start delay
+                lines.append("  %10.3f %10.3f  %-20s %s" % (
+                        last - origin, start - last, "", "(setup)" if last == origin else "(waiting)"))
+            last = end
+            if count > 1:
+                label = "%s (%d times)" % (label, count)
+            task = ""
+            if longest is not None:
+                task = "%s (%.3fs)" % (longest[1] or longest[0], longest[5] - longest[4])
+            lines.append("  %10.3f %10.3f  %-20s %-24s %-24s %s" % (
+                    start - origin, end - start, node, label or "", task, step or ""))
+        return lines
+
+
+def critical_path(spans, end, eps=1e-9):
+    """
+    The tasklists that the end of the experiment waited for: going back
+    from 'end', the tasklist that finished last, then the one that
+    finished last before it started, and so on.  Returns (start, end,
+    step, node, label, longest task span) tuples, earliest first.
+    """
+    # Of tasklists that end at the same time, the longest one last,
+    # it contains the others (e.g. tasklists that it called)
+    tasklists = sorted((s for s in spans if s[0] == 'tasklist'), key=lambda s: (s[5], s[5] - s[4]))
+    ends = [s[5] for s in tasklists]
+    # node -> task spans
+    tasks = collections.defaultdict(list)
+    for s in spans:
+        if s[0] == 'task':
+            tasks[s[2]].append(s)
+    path = []
+    t = end
+    hi = len(tasklists)
+    node = None
+    while True:
+        i = bisect.bisect_right(ends, t + eps, 0, hi)
+        if i == 0:
+            break
+        # Of the tasklists that finished last, prefer one on the same
+        # node as the one after it, which it probably held up
+        chosen = i - 1
+        j = i - 1
+        while j >= 0 and ends[j] >= ends[i - 1] - eps:
+            if tasklists[j][2] == node:
+                chosen = j
+                break
+            j -= 1
+        kind, label, node, lane, start, finish, step, args = tasklists[chosen]
+        longest = None
+        for task in tasks[node]:
+            if task[4] >= start - eps and task[5] <= finish + eps:
+                if longest is None or task[5] - task[4] > longest[5] - longest[4]:
+                    longest = task
+        path.append((start, finish, step, node, label, longest))
+        t = start
+        hi = chosen
+    path.reverse()
+    return path
+
+
+def run(experiment, settings):
+    """Dry-run 'experiment' in virtual time and print the report."""
+    estimates = Estimates(settings.dry_default_duration, settings.dry_ssh_setup)
+    for filename in settings.dry_estimates or ():
+        try:
+            estimates.load(filename)
+        except (OSError, ValueError, KeyError) as e:
+            print("Could not read estimates from trace '%s' (%s)" % (filename, e))
+            sys.exit(1)
+
+    def make_testbed(targets_xml, settings):
+        return DryTestbed(targets_xml, settings, estimates)
+
+    loop = VirtualTimeLoop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(experiment._run(make_testbed))
+        loop.run_until_complete(loop.shutdown_asyncgens())
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
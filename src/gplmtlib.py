@@ -18,24 +18,44 @@
 #
 
 import asyncio
+import collections
+import contextvars
+import copy
 import getpass
-import isodate
+import hashlib
+import io
+import json
 import logging
 import lxml.etree
 import os.path
+import posixpath
 import shlex
 import signal
-import xmlrpc.client
+import tempfile
 import time
 import sys
 import subprocess
+import tarfile
 import re
-from concurrent.futures import FIRST_COMPLETED
 from lxml.builder import E
-from contextlib import contextmanager
-from dateutil.parser import parse
+from contextlib import contextmanager, nullcontext, ExitStack
 
 import src.helper as helper
+import src.planetlab as planetlab
+import src.preflight as preflight
+import src.transfer as transfer
+from src.broadcast import Broadcast
+from src.compilecache import CompileCache, file_digest
+from src.journal import Journal
+from src.plan import RunTask, compile_experiment, make_tasklist
+from src.ratelimit import AdaptiveLimiter, ConnectionScheduler
+from src.spawn import SpawnPool
+from src.sshpool import MasterPool
+from src.output import OutputMux, pump_output
+from src.tasklog import NodeLog
+from src.targets import TargetIndex
+from src.taskgroup import TaskGroup
+from src.trace import CONTROLLER, Tracer
 from src.error import ExperimentSyntaxError, ExperimentExecutionError, ExperimentSetupError, StopExperimentException
 
 __all__ = [
@@ -46,25 +66,55 @@ __all__ = [
     "process_includes",
 ]
 
+# Shipped to ssh targets for tasklists that are run with the agent
+AGENT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'agent.py')
+
+# Number of seconds before the start of a timed step that a connection
+# slot and a session are reserved for its first command on a node
+RESERVE_AHEAD = 1.0
+
+# The start of the timed step that the current task runs, see run_timed
+_timed_start = contextvars.ContextVar('gplmt_timed_start', default=None)
+
 
 class Experiment:
-    def __init__(self, experiment_xml, settings):
+    def __init__(self, experiment_xml, settings, plan=None, filename=None, includes=()):
+        # When the experiment comes from the compile cache, the document
+        # only has the targets
         self.experiment_xml = experiment_xml
         self.settings = settings
+        # Only experiments from a file can be journaled
+        self.filename = filename
+        # the files it includes, as filled in by process_includes
+        self.includes = includes
         self.targets = self.experiment_xml.findall('/targets/target')
-        self.steps = self.experiment_xml.find("steps")
-        if self.steps is None:
-            raise ExperimentSyntaxError("Element 'steps' missing.  Did you try to execute an extension library?")
-        self.tasklists_env = {}
-
-        for x in experiment_xml.xpath("/experiment/tasklists/tasklist[@name]"):
-            self.tasklists_env[x.get('name')] = x
+        # Tasklists and steps are only looked at through the plan
+        if plan is None:
+            plan = compile_experiment(experiment_xml)
+        self.plan = plan
 
     @classmethod
     def from_file(cls, filename, settings):
+        cache = None
+        if settings.compile_cache is not None:
+            cache = CompileCache(settings.compile_cache)
+            try:
+                key = cache.key(filename, settings.rng)
+            except OSError as e:
+                if e.filename == settings.rng:
+                    raise ExperimentSetupError("Could not read schema file '%s'\n" % (settings.rng,))
+                raise ExperimentSetupError("Could not read experiment file\n")
+            entry = cache.load(key)
+            if entry is not None:
+                return Experiment(entry.targets_xml, settings, plan=entry.plan, filename=filename,
+                                  includes=entry.includes)
+
+        rng_file = settings.rng
         try:
-            rng_file = settings.rng
             relaxng_doc = lxml.etree.parse(rng_file)
+        except OSError:
+            raise ExperimentSetupError("Could not read schema file '%s'\n" % (rng_file,))
+        try:
             relaxng = lxml.etree.RelaxNG(relaxng_doc)
             xml_parser = lxml.etree.XMLParser(remove_blank_text=True)
             document = lxml.etree.parse(filename, parser=xml_parser)
@@ -86,269 +136,557 @@ class Experiment:
             sys.exit(1)
 
         establish_names(document)
-        process_includes(document, parent_filename=filename)
-        return Experiment(document, settings)
-
-    @asyncio.coroutine
-    def _run(self):
-        testbed = Testbed(self.targets, self.settings)
-
+        included = []
+        library = process_includes(document, parent_filename=filename, included=included)
+        experiment = Experiment(document, settings, plan=compile_experiment(document, library), filename=filename,
+                                includes=included)
+        if cache is not None:
+            cache.store(key, included, document, experiment.plan)
+        return experiment
+
+    async def _run(self, testbed_class=None):
+        if testbed_class is None:
+            testbed_class = Testbed
+        testbed = testbed_class(self.targets, self.settings)
+        testbed.tracer.set_step("setup")
+        await testbed.discover()
+
+        finished = False
         try:
-            for step in self.steps:
-                yield from testbed.run_step(step, self.tasklists_env)
-            yield from testbed.join()
+            if self.filename is not None:
+                testbed.open_journal(self.filename, self.plan.tasklists, self.includes)
+            if self.settings.preflight is not None:
+                await testbed.preflight()
+            elif not self.settings.no_ssh_warmup:
+                await testbed.establish_masters()
+            for index, step in enumerate(self.plan.steps, 1):
+                testbed.tracer.set_step(step_label(index, step))
+                await testbed.run_step(step, unit=str(index))
+            testbed.tracer.set_step("end of steps")
+            await testbed.join()
+            finished = True
         except ExperimentSyntaxError as e:
             logging.error("Syntax error: %s", e.message)
         except StopExperimentException as e:
             logging.error("Stop requested (%s)", e.scope)
+        except ExperimentSetupError as e:
+            logging.error("Setup failed: %s", e.message)
 
-        yield from testbed.run_teardowns(self.tasklists_env)
+        testbed.tracer.set_step("teardown")
+        await testbed.run_teardowns()
+        testbed.close_journal(finished)
 
         # Take care of stuff that was aborted or background tasks
-        yield from testbed.cancel_pending()
+        await testbed.cancel_pending()
+
+        await testbed.close_masters()
+
+        testbed.close_spawn_pool()
+
+        await testbed.close_output()
 
     def run_synchronous(self):
-        loop = asyncio.get_event_loop()
-        try:
-            loop.run_until_complete(self._run())
-        finally:
-            # Necessary due to http://bugs.python.org/issue23548
-            loop.close()
+        asyncio.run(self._run())
+
+
+def step_label(index, step):
+    """Name of a top-level step in the trace."""
+    if step.kind == 'step':
+        return "step %d: tasklist '%s' on '%s'" % (index, step.tasklist_name, step.targets)
+    if step.kind == 'register-teardown':
+        return "step %d: teardown '%s' on '%s'" % (index, step.tasklist_name, step.targets)
+    return "step %d: %s" % (index, step.kind)
+
+
+class StartJitter:
+    """How late the first commands of a timed step started on its nodes."""
+    def __init__(self, label):
+        self.label = label
+        # node name -> seconds late, every time the step started
+        self.late = collections.defaultdict(list)
+
+    def stats(self):
+        late = sorted(x for times in self.late.values() for x in times)
+        if not late:
+            return {'step': self.label, 'starts': 0, 'p50': None, 'p99': None, 'max': None,
+                    'spread': None, 'latest_node': None, 'nodes': {}}
+        worst = max(self.late, key=lambda n: max(self.late[n]))
+        return {
+            'step': self.label,
+            'starts': len(late),
+            'p50': late[len(late) // 2],
+            'p99': late[min(len(late) - 1, int(0.99 * len(late)))],
+            'max': late[-1],
+            'spread': late[-1] - late[0],
+            'latest_node': worst,
+            'nodes': {name: max(times) for name, times in self.late.items()},
+        }
+
+
+class TimedStart:
+    """The start of a timed step on 'node', at loop time 'target'."""
+    __slots__ = ('jitter', 'node', 'target', 'reserved', 'started')
 
+    def __init__(self, jitter, node, target):
+        self.jitter = jitter
+        self.node = node
+        self.target = target
+        # a connection slot and a session are reserved, see SSHNode.prepare_start
+        self.reserved = False
+        self.started = False
+
+
+def note_started(node):
+    """
+    Note that a command was started on 'node'.  The first one of a
+    timed step tells how late the step started there.
+    """
+    start = _timed_start.get()
+    if start is None or start.started or start.node is not node:
+        return
+    start.started = True
+    now = asyncio.get_running_loop().time()
+    start.jitter.late[node.name].append(max(now - start.target, 0.0))
+    node.testbed.tracer.record('start delay', start.target, now)
+
+
+async def run_timed(coro, node, start):
+    """
+    Run 'coro', a tasklist of a timed step on 'node', at 'start.target'.
+    Before that, the node is prepared so that its first command starts
+    on time.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        await node.prepare_start(start)
+        await asyncio.sleep(max(start.target - loop.time(), 0))
+        _timed_start.set(start)
+        return await coro
+    finally:
+        node.release_start(start)
+
+
+def was_cancelled(task):
+    """
+    Was 'task' cancelled?  Commands that are cancelled are terminated,
+    but the cancellation doesn't propagate, see execute.
+    """
+    if getattr(task, 'gplmt_cancelled', False):
+        return True
+    # Python >= 3.11, this also covers Ctrl-C
+    cancelling = getattr(task, 'cancelling', None)
+    return cancelling is not None and cancelling() > 0
+
+
+async def run_journaled(coro, journal, unit, node):
+    """Run 'coro', the tasklist of 'unit' on 'node', and journal when it is done."""
+    try:
+        outcome = await coro
+    except StopExperimentException as e:
+        # Stopping the experiment leaves the unit to be done on resume
+        if e.scope != 'stop-experiment':
+            journal.done(unit, node.name, e.scope)
+        raise
+    if not was_cancelled(asyncio.current_task()):
+        journal.done(unit, node.name, outcome or 'ok')
+
+
+async def run_teardowns_on(node, tasklists):
+    """Run the teardown 'tasklists', (tasklist, env) pairs, on 'node' in order."""
+    for tasklist, env in tasklists:
+        try:
+            await node.run_tasklist(tasklist, env, None)
+        except StopExperimentException as e:
+            if e.scope == 'stop-experiment':
+                raise
+            # The other teardowns of the node still run
+
+
+async def run_queued(coro, tracer, node, ready):
+    """Run 'coro' and trace how long it waited after time 'ready'."""
+    with tracer.lane(node.name):
+        tracer.record('queue wait', ready, tracer.now())
+        return await coro
+
+
+class JoinWaiter:
+    """A pending call to ExecutionContext.join."""
+    def __init__(self, targets, remaining):
+        self.targets = targets
+        # number of pending tasks on the targets
+        self.remaining = remaining
+        self.future = None
+
+
+class LoopSkew:
+    """
+    Keeps the nodes of a loop with sync="per-node" at most 'max_skew'
+    iterations ahead of the slowest node (no limit if None).
+    """
+    def __init__(self, nodes, max_skew):
+        self.max_skew = max_skew
+        # node -> number of finished iterations, of the nodes in the loop
+        self.finished = dict.fromkeys(nodes, 0)
+        # number of finished iterations -> number of nodes, without zeros
+        self.counts = collections.Counter()
+        if self.finished:
+            self.counts[0] = len(self.finished)
+        # number of finished iterations of the slowest node
+        self.slowest = 0
+        # iteration -> futures of the nodes that wait to start it
+        self.waiting = {}
+
+    async def wait(self, iteration):
+        """Wait until a node may start 'iteration' (counted from 0)."""
+        if self.max_skew is None or iteration - self.slowest <= self.max_skew:
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self.waiting.setdefault(iteration, []).append(fut)
+        await fut
 
-@asyncio.coroutine
-def run_delayed(coro, delay):
-    yield from asyncio.sleep(delay)
-    res = yield from coro
-    return res
+    def _wake(self):
+        for iteration in sorted(self.waiting):
+            if iteration - self.slowest > self.max_skew:
+                break
+            for fut in self.waiting.pop(iteration):
+                if not fut.done():
+                    fut.set_result(None)
+
+    def _remove(self, n):
+        self.counts[n] -= 1
+        if not self.counts[n]:
+            del self.counts[n]
+
+    def advance(self, node):
+        """'node' finished an iteration."""
+        n = self.finished[node]
+        self.finished[node] = n + 1
+        self._remove(n)
+        self.counts[n + 1] += 1
+        if n == self.slowest and n not in self.counts:
+            self.slowest = n + 1
+            self._wake()
+
+    def leave(self, node):
+        """'node' is done with the loop, the others don't wait for it."""
+        self._remove(self.finished.pop(node))
+        if self.counts:
+            self.slowest = min(self.counts)
+        else:
+            self.slowest = float('inf')
+        self._wake()
 
 
 class ExecutionContext:
-    def __init__(self, testbed):
+    def __init__(self, testbed, only=None):
         self.testbed = testbed
-        self.tasks = []
+        # the node that steps are restricted to, in a loop with sync="per-node"
+        self.only = only
+        self.tasks = set()
+        # number of pending tasks that don't run in the background
+        self.foreground = 0
+        # node -> number of pending tasks on the node
+        self.node_pending = {}
+        # finished tasks with an exception that join didn't raise yet
+        self.failed = collections.deque()
+        self.waiter = None
         self.var = {}
+        # path of the step that is being run, see src/journal.py
+        self.unit = None
+
 
+    async def __aenter__(self):
+        return self
 
-    @asyncio.coroutine
-    def cancel_pending(self):
+    async def __aexit__(self, exc_type, exc, tb):
+        # Tasks of a nested context don't outlive it if it is
+        # stopped or cancelled, e.g. when the loop it belongs to is.
+        if exc_type is not None:
+            await self.cancel_pending()
+        return False
+
+    async def cancel_pending(self):
         """Cancel all pending tasks"""
         if not self.tasks:
             return
-        for p in self.tasks:
+        tasks = list(self.tasks)
+        for p in tasks:
+            p.gplmt_cancelled = True
             p.cancel()
-        yield asyncio.wait(self.tasks)
-
-    @asyncio.coroutine
-    def join(self, targets=None):
+        await asyncio.wait(tasks)
+
+    def _add_task(self, task, node, background):
+        task.gplmt_background = background
+        task.gplmt_node = node
+        self.tasks.add(task)
+        if not background:
+            self.foreground += 1
+        if node is not None:
+            self.node_pending[node] = self.node_pending.get(node, 0) + 1
+        task.add_done_callback(self._task_done)
+
+    def _task_done(self, task):
+        self.tasks.discard(task)
+        if not task.gplmt_background:
+            self.foreground -= 1
+        node = task.gplmt_node
+        if node is not None:
+            n = self.node_pending[node] - 1
+            if n:
+                self.node_pending[node] = n
+            else:
+                del self.node_pending[node]
+        if not task.cancelled() and task.exception() is not None:
+            self.failed.append(task)
+        w = self.waiter
+        if w is None or w.future.done():
+            return
+        if w.targets is not None and node in w.targets:
+            w.remaining -= 1
+        # Only wake up join if it has something to do
+        if self.failed or self._joined(w):
+            w.future.set_result(None)
+
+    def _joined(self, w):
+        # We can stop if we only wait on things from
+        # background tasks, or if no pending
+        # tasks belong to the targets we join on.
+        if self.foreground == 0:
+            return True
+        return w.targets is not None and w.remaining == 0
+
+    async def join(self, targets=None):
         """ Block on pending tasks until
         complete or requested to stop by an exception"""
-        if not len(self.tasks):
+        if not self.tasks and not self.failed:
             logging.info("Synchronized nodes (no tasks)")
             return
-        while self.tasks:
-            try:
-                done, ts = yield from asyncio.wait(self.tasks, return_when=FIRST_COMPLETED)
-                self.tasks = list(ts)
-                del ts
-                logging.info('%s tasks done, %s task pending', len(done), len(self.tasks))
-                for task in done:
+        tracer = self.testbed.tracer
+        with tracer.lane(CONTROLLER), tracer.span('join', tasks=len(self.tasks)):
+            await self._join(targets)
+
+    async def _join(self, targets):
+        w = JoinWaiter(None, 0)
+        if targets is not None:
+            w.targets = set(targets)
+            w.remaining = sum(self.node_pending.get(n, 0) for n in w.targets)
+        while True:
+            while self.failed:
+                task = self.failed.popleft()
+                try:
                     # throw potential exceptions
                     task.result()
-            except StopExperimentException as e:
-                logging.info("got stop experiment exception")
-                if e.scope in ('stop-tasklist', 'stop-step'):
-                    logging.info("stopped execution (%s)", e.scope)
-                elif e.scope == 'stop-experiment':
-                    logging.info("stopping experiment")
-                    raise
-            # We can break if no pending
-            # tasks belong to the targets we join on.
-            if targets is not None:
-                done = True
-                for p in self.tasks:
-                    if p.gplmt_node in targets:
-                        done = False
-                if done:
-                    break
-            # We can also stop if we only wait on things from
-            # background tasks.
-            done = True
-            for p in self.tasks:
-                if not p.gplmt_background:
-                    done = False
-            if done:
+                except StopExperimentException as e:
+                    logging.info("got stop experiment exception")
+                    if e.scope in ('stop-tasklist', 'stop-step'):
+                        logging.info("stopped execution (%s)", e.scope)
+                    elif e.scope == 'stop-experiment':
+                        logging.info("stopping experiment")
+                        raise
+            if self._joined(w):
                 break
+            w.future = asyncio.get_running_loop().create_future()
+            self.waiter = w
+            try:
+                await w.future
+            finally:
+                self.waiter = None
+            logging.info('%s tasks pending', len(self.tasks))
         logging.info("Synchronized nodes")
 
-    def schedule_tasklist(self, target_name, tasklist_xml, tasklists_env, background, delay=None, var_env={}, stop_time=None):
-        target_nodes = self.testbed._resolve_target(target_name)
-        for node in target_nodes:
-            coro = node.run_tasklist(tasklist_xml, tasklists_env, var_env, stop_time)
-            if delay is not None and delay > 0:
-                coro = run_delayed(coro, delay)
-            task = asyncio.async(coro)
-            task.gplmt_background = background
-            task.gplmt_node = node
-            self.tasks.append(task)
-
-    def schedule_loop_counted(self, loop_xml, tasklists_env, repetitions, var_env):
-        coro = self.run_loop_counted(loop_xml, tasklists_env, repetitions, var_env)
-        task = asyncio.async(coro)
-        task.gplmt_background = False
-        task.gplmt_node = []
-        self.tasks.append(task)
-
-    def schedule_loop_until(self, loop_xml, tasklists_env, deadline, var_env):
-        coro = self.run_loop_until(loop_xml, tasklists_env, deadline, var_env)
-        task = asyncio.async(coro)
-        task.gplmt_background = False
-        task.gplmt_node = []
-        self.tasks.append(task)
-
-    def schedule_loop_listing(self, loop_xml, tasklists_env, listing, listParam, var_env):
-        coro = self.run_loop_listing(loop_xml, tasklists_env, listing, listParam, var_env)
-        task = asyncio.async(coro)
-        task.gplmt_background = False
-        task.gplmt_node = []
-        self.tasks.append(task)        
-
-    @asyncio.coroutine
-    def run_loop_counted(self, loop_xml, tasklists_env, repetitions, var_env):
-        nested_ec = ExecutionContext(self.testbed)
-        for x in range(repetitions):
-            for step in list(loop_xml):
-                yield from nested_ec.run_step(step, tasklists_env, var_env)
-            yield from nested_ec.join()
-
-    @asyncio.coroutine
-    def run_loop_until(self, loop_xml, tasklists_env, deadline, var_env):
-        nested_ec = ExecutionContext(self.testbed)
-        while time.time() < deadline:
-            for step in list(loop_xml):
-                yield from nested_ec.run_step(step, tasklists_env, var_env)
-            yield from nested_ec.join()
-
-    @asyncio.coroutine
-    def run_loop_listing(self, loop_xml, tasklists_env, listing, listParam, var_env):
-        nested_ec = ExecutionContext(self.testbed)
-        
-        if ":" in listing:
-            rangeGiven = listing.split(":")
-            if len(rangeGiven) == 2 and helper.isInt(rangeGiven[0]) and helper.isInt(rangeGiven[1]):
-                loopList = range(int(rangeGiven[0]), int(rangeGiven[1])+1)
-                loopList = map(str, loopList)                
-            else:
-                raise ExperimentSyntaxError("Invalid Range declaration '%s'" % (loop_xml.tag,))
+    def schedule_tasklist(self, target_name, tasklist, background, delay=None, var_env={}, stop_time=None):
+        if self.only is not None:
+            # In a loop with sync="per-node"
+            if not self.testbed._target_contains(target_name, self.only):
+                return
+            target_nodes = (self.only,)
         else:
-            loopList = listing.split(" ")
-        for x in loopList:
-            loop_env = {}
-            loop_env[listParam] = x
-            composedEnv = {}
-            composedEnv.update(var_env)
-            composedEnv.update(loop_env)
-            nested_ec.var = composedEnv
-            for step in list(loop_xml):
-                yield from nested_ec.run_step(step, tasklists_env, composedEnv)
-            yield from nested_ec.join()
-
-
-    @asyncio.coroutine
-    def run_step(self, step_xml, tasklists_env, var_env={}):
-        if step_xml.tag not in self._step_table:
-            raise ExperimentSyntaxError("Invalid step '%s'" % (step_xml.tag,))
-        step_method = self._step_table[step_xml.tag]
-        yield from step_method(self, step_xml, tasklists_env, var_env)
-
-    @asyncio.coroutine
-    def _step_synchronize(self, step_xml, tasklists_env, var_env={}):
-        targets = None
-        targets_str = step_xml.get('targets')
-        if targets_str is not None:
-            targets = self.testbed._resolve_target(targets_str)
-        yield from self.join(targets)
-
-    @asyncio.coroutine
-    def _step_tasklist(self, step_xml, tasklists_env, var_env={}):
-        targets_def = step_xml.get("targets")
-        if targets_def is None:
-            logging.warn("step has no targets, skipping")
-            return
-        tasklist_name = step_xml.get("tasklist")
-        if tasklist_name is None:
-            logging.warn("step has no tasklist, skipping")
+            target_nodes = self.testbed._resolve_target(target_name)
+        tracer = self.testbed.tracer
+        ready = None
+        if tracer.enabled:
+            ready = tracer.now() + (delay or 0)
+        jitter = None
+        if delay is not None and delay > 0:
+            # All nodes start at the same time
+            target = asyncio.get_running_loop().time() + delay
+            jitter = self.testbed.start_jitter(
+                    "tasklist '%s' on '%s'" % (tasklist.name, target_name))
+        journal = self.testbed.journal
+        unit = self.unit
+        if journal is None:
+            unit = None
+        for node in target_nodes:
+            if unit is not None and journal.is_done(unit, node.name):
+                logging.info("Skipping step %s on '%s', it is done", unit, node.name)
+                continue
+            coro = node.run_tasklist(tasklist, var_env, stop_time)
+            if unit is not None:
+                coro = run_journaled(coro, journal, unit, node)
+            if ready is not None:
+                coro = run_queued(coro, tracer, node, ready)
+            if jitter is not None:
+                coro = run_timed(coro, node, TimedStart(jitter, node, target))
+            self._add_task(asyncio.ensure_future(coro), node, background)
+
+    def schedule_loop_counted(self, loop, repetitions, var_env):
+        coro = self.run_loop_counted(loop, repetitions, var_env, self.unit)
+        self._add_task(asyncio.ensure_future(coro), None, False)
+
+    def schedule_loop_until(self, loop, deadline, var_env):
+        coro = self.run_loop_until(loop, deadline, var_env, self.unit)
+        self._add_task(asyncio.ensure_future(coro), None, False)
+
+    def schedule_loop_listing(self, loop, var_env):
+        coro = self.run_loop_listing(loop, var_env, self.unit)
+        self._add_task(asyncio.ensure_future(coro), None, False)
+
+    async def run_iteration(self, loop, var_env, loop_unit, iteration):
+        """Run the body of 'loop' once, unless the journal says it was done."""
+        journal = self.testbed.journal
+        unit = None
+        # Iterations of a loop with sync="per-node" are done per node
+        node = None if self.only is None else self.only.name
+        if loop_unit is not None:
+            unit = "%s/%d" % (loop_unit, iteration)
+            if journal is not None and journal.is_done(unit, node):
+                logging.info("Skipping loop iteration %s, it is done", unit)
+                return
+        for index, step in enumerate(loop.body, 1):
+            await self.run_step(step, var_env, None if unit is None else "%s.%d" % (unit, index))
+        await self.join()
+        if unit is not None and journal is not None:
+            journal.done(unit, node)
+
+    async def run_loop(self, loop, iterations, unit=None):
+        """
+        Run 'loop' with the iterations from 'iterations()', pairs of the
+        number of the iteration and its variables.
+        """
+        if loop.sync == 'per-node':
+            await self.run_loop_per_node(loop, iterations, unit)
             return
-        tasklist = tasklists_env.get(tasklist_name)
-        if tasklist is None:
-            raise ExperimentSyntaxError("Tasklist '%s' not found" % (tasklist_name,))
-        background = False
-        bg_str = step_xml.get('background')
-        if bg_str is not None and bg_str.lower() == 'true':
-            background = True
-        delay = get_delay_attr(step_xml, 'start')
-        stop = get_delay_attr(step_xml, 'stop')
-        logging.info("delay for step with tl %s is %s", tasklist_name, delay)
+        async with ExecutionContext(self.testbed, self.only) as nested_ec:
+            for x, var_env in iterations():
+                nested_ec.var = var_env
+                await nested_ec.run_iteration(loop, var_env, unit, x)
+
+    def loop_nodes(self, loop):
+        """The nodes that the steps of 'loop' run on."""
+        nodes = {}
+        steps = list(loop.body)
+        while steps:
+            step = steps.pop(0)
+            if step.kind == 'loop':
+                steps.extend(step.body)
+            elif step.kind == 'step':
+                for node in self.testbed._resolve_target(step.targets):
+                    if self.only is None or node is self.only:
+                        nodes[node] = None
+        return list(nodes)
+
+    async def run_loop_per_node(self, loop, iterations, unit):
+        """
+        Run 'loop' with every node going through the iterations on its
+        own.  Only the end of the loop waits for all nodes.
+        """
+        nodes = self.loop_nodes(loop)
+        skew = LoopSkew(nodes, loop.max_skew)
+        async with TaskGroup() as group:
+            for node in nodes:
+                group.create_task(self._run_node_iterations(loop, node, iterations, unit, skew))
+
+    async def _run_node_iterations(self, loop, node, iterations, unit, skew):
+        try:
+            async with ExecutionContext(self.testbed, node) as nested_ec:
+                for x, var_env in iterations():
+                    await skew.wait(x)
+                    nested_ec.var = var_env
+                    await nested_ec.run_iteration(loop, var_env, unit, x)
+                    skew.advance(node)
+        finally:
+            skew.leave(node)
+
+    async def run_loop_counted(self, loop, repetitions, var_env, unit=None):
+        def iterations():
+            for x in range(repetitions):
+                yield x, var_env
+        await self.run_loop(loop, iterations, unit)
+
+    async def run_loop_until(self, loop, deadline, var_env, unit=None):
+        def iterations():
+            x = 0
+            while self.testbed.wall_time() < deadline:
+                yield x, var_env
+                x += 1
+        await self.run_loop(loop, iterations, unit)
+
+    async def run_loop_listing(self, loop, var_env, unit=None):
+        def iterations():
+            for x, value in enumerate(loop.listing):
+                composedEnv = {}
+                composedEnv.update(var_env)
+                composedEnv[loop.param] = value
+                yield x, composedEnv
+        await self.run_loop(loop, iterations, unit)
+
+
+    async def run_step(self, step, var_env={}, unit=None):
+        self.unit = unit
+        step_method = self._step_table[step.kind]
+        await step_method(self, step, var_env)
+
+    async def _step_synchronize(self, step, var_env={}):
+        targets = None
+        if step.targets is not None:
+            targets = self.testbed._resolve_target(step.targets)
+        await self.join(targets)
+
+    async def _step_tasklist(self, step, var_env={}):
+        if step.tasklist is None:
+            raise ExperimentSyntaxError("Tasklist '%s' not found" % (step.tasklist_name,))
+        delay = None
+        if step.start is not None:
+            delay = step.start.seconds(self.testbed.wall_time())
+        stop = None
+        if step.stop is not None:
+            stop = step.stop.seconds(self.testbed.wall_time())
+        logging.info("delay for step with tl %s is %s", step.tasklist_name, delay)
 
         composedEnv = {}
         composedEnv.update(var_env)
-        composedEnv.update(helper.exportEnv(step_xml))
-        
-        self.schedule_tasklist(targets_def, tasklist, tasklists_env, background, delay, composedEnv, stop)
-
-    @asyncio.coroutine
-    def _step_teardown(self, step_xml, tasklists_env, var_env):
-        targets_def = step_xml.get("targets")
-        if targets_def is None:
-            logging.warn("register-teardown has no targets, skipping")
-            return
-        tasklist_name = step_xml.get("tasklist")
-        if tasklist_name is None:
-            logging.warn("register-teardown has no tasklist, skipping")
-            return
-        tasklist = tasklists_env.get(tasklist_name)
-        if tasklist is None:
-            raise ExperimentSyntaxError("Tasklist '%s' not found" % (tasklist_name,))
-        logging.info("Registering teardown for '%s' on '%s'", tasklist_name, targets_def)
+        composedEnv.update(helper.resolveEnv(step.env))
 
-        composedEnv = {}
-        composedEnv.update(var_env)
-        composedEnv.update(helper.exportEnv(step_xml))
+        self.schedule_tasklist(step.targets, step.tasklist, step.background, delay, composedEnv, stop)
 
-        self.testbed.teardowns.append((targets_def, tasklist, composedEnv))
+    async def _step_teardown(self, step, var_env):
+        if step.tasklist is None:
+            raise ExperimentSyntaxError("Tasklist '%s' not found" % (step.tasklist_name,))
+        logging.info("Registering teardown for '%s' on '%s'", step.tasklist_name, step.targets)
 
-    @asyncio.coroutine
-    def _step_loop(self, step_xml, tasklists_env, var_env={}):
-        num_repeat_str = step_xml.get("repeat")
-        if num_repeat_str is not None:
-            try:
-                num_repeat = int(num_repeat_str)
-            except ValueError:
-                logging.error("counted loop has malformed attribute iterations (%s), skipping", num_repeat_str)
+        targets = step.targets
+        if self.only is not None:
+            # In a loop with sync="per-node", for the node of the context
+            if not self.testbed._target_contains(targets, self.only):
                 return
-            self.schedule_loop_counted(step_xml, tasklists_env, num_repeat, var_env)
-            return
-        duration = step_xml.get("duration")
-        if duration is not None:
-            deadline = time.time() + isodate.parse_duration(duration).total_seconds()
-            self.schedule_loop_until(step_xml, tasklists_env, deadline, var_env)
-            return
-        listing = step_xml.get("list")
-        listParam = step_xml.get("param")
-        if listing is not None and listParam is not None:
-            self.schedule_loop_listing(step_xml, tasklists_env, listing, listParam, var_env)
-            return
-        if listing is None and listParam is not None:
-            raise Exception("missing list definition")
-        if listParam is None and listing is not None:
-            raise Exception("missing parameter definition")
-        until = step_xml.get("until")
-        if until is not None:
-            deadline = parse(until)
-            deadline = time.mktime(deadline.timetuple())
-            self.schedule_loop_until(step_xml, tasklists_env, deadline, var_env)
-            return
-        raise Exception("not implemented")
+            targets = self.only.name
+
+        composedEnv = {}
+        composedEnv.update(var_env)
+        composedEnv.update(helper.resolveEnv(step.env))
+
+        self.testbed.add_teardown(targets, step.tasklist, composedEnv,
+                                  {'tasklist': step.tasklist_name, 'unit': self.unit})
+
+    async def _step_loop(self, loop, var_env={}):
+        if loop.repeat is not None:
+            self.schedule_loop_counted(loop, loop.repeat, var_env)
+        elif loop.duration is not None:
+            self.schedule_loop_until(loop, self.testbed.wall_time() + loop.duration, var_env)
+        elif loop.listing is not None:
+            self.schedule_loop_listing(loop, var_env)
+        else:
+            self.schedule_loop_until(loop, loop.until, var_env)
 
     _step_table = {
             'step': _step_tasklist,
@@ -367,51 +705,404 @@ class Testbed:
         self.nodes = {}
         self.groups = {}
         self.settings = settings
+        # PlanetLab slices, their nodes are added by discover()
+        self.pl_slices = []
+        # (api url, user) -> password
+        self.pl_passwords = {}
         for el in targets_xml:
             self._process_declaration(el)
+        self.target_index = None
 
         self.ec = ExecutionContext(self)
 
         self.teardowns = []
-
-        # counter for sequential numbering of task runs
-        self.run_counter = 0
-
-        self.ssh_cooldown_lock = asyncio.Lock()
-        self.ssh_parallel_sema = asyncio.Semaphore(settings.ssh_parallelism)
-
-    @asyncio.coroutine
-    def ssh_acquire(self):
-        yield from self.ssh_parallel_sema.acquire()
-        if self.ssh_cooldown is not None:
-            yield from self.ssh_cooldown_lock.acquire()
-            # as soon as we get the lock,
-            # we schedule a function that releases it
-            # after the cooldown period.
-            loop = asyncio.get_event_loop()
-            loop.call_later(
-                    self.ssh_cooldown,
-                    lambda: self.ssh_cooldown_lock.release())
-
-    @asyncio.coroutine
-    def run_teardowns(self, tasklists_env):
+        # teardowns that were registered again from the journal, see add_teardown
+        self.restored_teardowns = set()
+        # node name -> paths of files that put tasks copied there, as
+        # keys of a dict to keep their order
+        self.removals = {}
+        self.journal = None
+
+        # label of a timed step -> StartJitter
+        self.jitters = {}
+
+        # node name -> NodeLog
+        self.logs = {}
+        self.output = None
+        if self.logroot_dir is None and settings.output != 'raw':
+            self.output = OutputMux(
+                    collapse=settings.output == 'collapse',
+                    interval=settings.output_interval)
+
+        self.tracer = Tracer(enabled=settings.trace is not None or settings.trace_summary is not None)
+
+        self.spawn_pool = None
+        if settings.local_spawn == 'pool':
+            self.spawn_pool = SpawnPool(settings.local_spawn_workers)
+
+        # (destination, digest) -> Broadcast
+        self.broadcasts = {}
+        # (path, mtime, size) -> digest
+        self.digests = {}
+
+        host_rate = None
+        if self.ssh_cooldown:
+            host_rate = 1.0 / self.ssh_cooldown
+        self.ssh_scheduler = ConnectionScheduler(
+                rate=settings.ssh_rate,
+                burst=settings.ssh_burst,
+                host_rate=host_rate,
+                subnet_rate=settings.ssh_subnet_rate,
+                subnet_burst=settings.ssh_subnet_burst,
+                subnet_prefix=settings.ssh_subnet_prefix)
+        if settings.ssh_parallelism_adaptive:
+            self.ssh_limiter = AdaptiveLimiter(
+                    settings.ssh_parallelism,
+                    minimum=min(settings.ssh_parallelism_min, settings.ssh_parallelism),
+                    maximum=max(settings.ssh_parallelism_max, settings.ssh_parallelism))
+        else:
+            self.ssh_limiter = AdaptiveLimiter(settings.ssh_parallelism)
+        # names of nodes that we had a master connection to
+        self.ssh_reached = set()
+        self.master_pool = MasterPool(
+                check_interval=settings.ssh_master_check_interval,
+                retries=settings.ssh_master_retries,
+                max_sessions=settings.ssh_max_sessions)
+
+    async def ssh_acquire(self, node):
+        with self.tracer.span('semaphore wait'):
+            await self.ssh_limiter.acquire()
+        # Sessions on an established master connection are multiplexed
+        # over the existing TCP connection, so they don't count against
+        # the connection rate.
+        if self.master_pool.is_alive(node):
+            return
+        try:
+            with self.tracer.span('cooldown wait'):
+                await self.ssh_scheduler.acquire(node.host)
+        except asyncio.CancelledError:
+            self.ssh_limiter.release()
+            raise
+
+    async def run_teardowns(self):
+        """
+        Run the registered teardowns.  On every node, its teardowns run
+        in the order they were registered, followed by removing the files
+        that put tasks left there.  Nodes are torn down concurrently.
+        """
+        # Teardowns are not journaled, on resume they all run again
+        self.ec.unit = None
+        # node -> [(tasklist, env)]
+        chains = {}
         try:
             for target, tasklist, teardown_env in self.teardowns:
-                # run teardowns in the root execution context of
-                # the testbed
-                self.ec.schedule_tasklist(target, tasklist, tasklists_env, background=False, var_env=teardown_env)
-                yield from self.join()
+                for node in self._resolve_target(target):
+                    chains.setdefault(node, []).append((tasklist, teardown_env))
+        except ExperimentSyntaxError as e:
+            logging.error("Error during teardown:  %s" % (e.message))
+        for name, paths in self.removals.items():
+            node = self.nodes.get(name)
+            if node is None:
+                continue
+            chain = chains.setdefault(node, [])
+            for tasklist in cleanup_tasklists(list(paths)):
+                chain.append((tasklist, {}))
+        if not chains:
+            return
+        logging.info("Running teardowns on %d nodes", len(chains))
+        # run teardowns in the root execution context of the testbed
+        for node, tasklists in chains.items():
+            self.ec._add_task(asyncio.ensure_future(run_teardowns_on(node, tasklists)), node, False)
+        try:
+            await self.join()
         except ExperimentExecutionError as e:
             logging.error("Error during teardown:  %s" % (e.message))
+        except StopExperimentException as e:
+            logging.error("Teardown stopped (%s)", e.scope)
+
+    def add_teardown(self, targets, tasklist, env, record):
+        """
+        Register a teardown.  'record' describes the tasklist for the
+        journal: {'tasklist': name, 'unit': unit}.  A teardown
+        that was registered again from the journal isn't registered twice.
+        """
+        record = dict(record, targets=targets, env=env)
+        key = json.dumps(record, sort_keys=True)
+        if key in self.restored_teardowns:
+            return
+        self.teardowns.append((targets, tasklist, env))
+        if self.journal is not None:
+            self.journal.teardown(record)
+
+    def add_removal(self, node_name, destination):
+        """
+        Register removing the file 'destination' from node 'node_name' at
+        the end of the experiment.  The removals of a node are merged
+        into as few 'rm' commands as possible.
+        """
+        paths = self.removals.setdefault(node_name, {})
+        if destination in paths:
+            return
+        paths[destination] = None
+        if self.journal is not None:
+            self.journal.teardown({'remove': destination, 'targets': node_name, 'env': {}})
+
+    def open_journal(self, filename, tasklists, includes=()):
+        """
+        Journal the progress of the experiment in 'filename', if a journal
+        is configured.  'includes' are the files it includes, as filled in
+        by process_includes.  On resume, register the teardowns in the
+        journal again, looking up their tasklists in 'tasklists'.
+        """
+        journal_file = self.settings.journal
+        if journal_file is None and self.logroot_dir is not None:
+            journal_file = os.path.join(self.logroot_dir, 'journal')
+        if journal_file is None:
+            if self.settings.resume:
+                raise ExperimentSetupError("--resume needs --journal or --logroot-dir")
+            return
+        if self.logroot_dir is not None:
+            os.makedirs(self.logroot_dir, exist_ok=True)
+        try:
+            digest = file_digest(filename)
+        except OSError:
+            raise ExperimentSetupError("Could not read experiment file\n")
+        if includes:
+            # A change of an included file makes it another experiment
+            h = hashlib.sha256(digest.encode('ascii'))
+            for parent, name, resolved, include_digest in includes:
+                h.update(('\n%s\n%s' % (resolved, include_digest)).encode('utf-8'))
+            digest = h.hexdigest()
+        journal = Journal(journal_file)
+        journal.open(filename, digest, resume=self.settings.resume)
+        self.journal = journal
+        for record in journal.teardowns:
+            if 'remove' in record:
+                self.removals.setdefault(record['targets'], {})[record['remove']] = None
+                continue
+            tasklist = tasklists.get(record['tasklist'])
+            if tasklist is None:
+                raise ExperimentSyntaxError("Tasklist '%s' not found" % (record['tasklist'],))
+            self.teardowns.append((record['targets'], tasklist, record['env']))
+            del record['event'], record['time']
+            self.restored_teardowns.add(json.dumps(record, sort_keys=True))
+        if self.settings.resume:
+            logging.warning("Resuming experiment, %d units are done", len(journal.completed))
+
+    def close_journal(self, finished):
+        """Close the journal, 'finished' if all steps and teardowns ran."""
+        if self.journal is None:
+            return
+        if finished:
+            self.journal.end()
+        self.journal.close()
 
     def ssh_release(self):
-        # Note that the cooldown lock will
-        # be released by a timer.
-        self.ssh_parallel_sema.release()
+        self.ssh_limiter.release()
+
+    async def ensure_master(self, node, paused=nullcontext):
+        """
+        Make sure that 'node' has a live master connection, and tell the
+        ssh limiter how long it took to set it up, or that it failed.
+        The caller holds an ssh slot (see ssh_acquire); it is given up
+        while we back off between attempts, inside 'paused()'.
+        """
+        pool = self.master_pool
+        if pool.is_alive(node):
+            return
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+
+        async def backoff(delay):
+            nonlocal start
+            self.ssh_release()
+            try:
+                with paused(), self.tracer.span('master backoff'):
+                    await asyncio.sleep(delay)
+                    await self.ssh_acquire(node)
+            except asyncio.CancelledError:
+                # The caller gives back the slot it thinks it holds
+                self.ssh_limiter.reclaim()
+                raise
+            start = loop.time()
+
+        try:
+            with self.tracer.span('master setup'):
+                await pool.ensure(node, backoff)
+        except ExperimentExecutionError:
+            # A host that was never reachable is probably down,
+            # that says nothing about the load we put on the network
+            if node.name in self.ssh_reached:
+                self.ssh_limiter.failure()
+            raise
+        self.ssh_reached.add(node.name)
+        self.ssh_limiter.success(loop.time() - start)
+
+    def start_jitter(self, label):
+        """The StartJitter of the timed step 'label'."""
+        jitter = self.jitters.get(label)
+        if jitter is None:
+            jitter = self.jitters[label] = StartJitter(label)
+        return jitter
+
+    def stats(self):
+        """Statistics of the run, as a dict."""
+        stats = {}
+        if self._ssh_nodes():
+            stats['ssh_concurrency'] = self.ssh_limiter.stats()
+        jitters = [j.stats() for j in self.jitters.values() if j.late]
+        if jitters:
+            stats['start_jitter'] = jitters
+        return stats
+
+    def stats_summary(self):
+        """Statistics of the run, as lines for the summary."""
+        lines = []
+        ssh = self.stats().get('ssh_concurrency')
+        if ssh is not None:
+            lines.append("ssh concurrency: limit %(limit)d (%(lowest)d-%(highest)d, bounds %(minimum)d-%(maximum)d), "
+                         "peak %(peak_in_use)d in use, %(increases)d increases, %(decreases)d decreases" % ssh)
+        for jitter in self.stats().get('start_jitter', ()):
+            lines.append("start of %(step)s: %(starts)d starts, late p50 %(p50).3fs, p99 %(p99).3fs, "
+                         "max %(max).3fs (%(latest_node)s), spread %(spread).3fs" % jitter)
+        return lines
+
+    def broadcast(self, destination, digest):
+        key = (destination, digest)
+        bc = self.broadcasts.get(key)
+        if bc is None:
+            bc = self.broadcasts[key] = Broadcast(self.settings.broadcast_width)
+        return bc
+
+    async def file_digest(self, path):
+        st = os.stat(path)
+        key = (path, st.st_mtime, st.st_size)
+        digest = self.digests.get(key)
+        if digest is None:
+            loop = asyncio.get_running_loop()
+            digests = await loop.run_in_executor(None, transfer.digest_files, [path])
+            digest = self.digests[key] = digests[0]
+        return digest
+
+    def node_log(self, node):
+        """Return the output log of 'node', or None if output isn't logged."""
+        if self.logroot_dir is None:
+            return None
+        log = self.logs.get(node.name)
+        if log is None:
+            log = self.logs[node.name] = NodeLog(
+                    os.path.join(self.logroot_dir, node.name),
+                    segment_size=self.settings.log_segment_size,
+                    buffer_size=self.settings.log_buffer_size,
+                    compress=self.settings.log_compress)
+        return log
+
+    def begin_output(self, node, task_name):
+        """Return a record for the output of a run of a task, or None."""
+        log = self.node_log(node)
+        if log is not None:
+            return log.begin(task_name)
+        if self.output is not None:
+            return self.output.begin(node.name, task_name)
+        return None
+
+    async def close_output(self):
+        for log in self.logs.values():
+            log.close()
+        self.logs = {}
+        if self.logroot_dir is not None:
+            self._write_stats()
+        if self.output is not None:
+            await self.output.close(self.stats_summary())
+        self._write_trace()
+
+    def _write_trace(self):
+        if self.settings.trace is not None:
+            self.tracer.write(self.settings.trace)
+        if self.settings.trace_summary is None:
+            return
+        summary = "".join(line + "\n" for line in self.tracer.summary())
+        if self.settings.trace_summary == '-':
+            sys.stdout.write(summary)
+            sys.stdout.flush()
+            return
+        try:
+            with open(self.settings.trace_summary, 'w', encoding='utf-8') as f:
+                f.write(summary)
+        except OSError as e:
+            logging.warning("Could not write trace summary (%s)", e)
+
+    def _write_stats(self):
+        try:
+            os.makedirs(self.logroot_dir, exist_ok=True)
+            with open(os.path.join(self.logroot_dir, 'stats.json'), 'w', encoding='utf-8') as f:
+                json.dump(self.stats(), f, indent=2, sort_keys=True)
+        except OSError as e:
+            logging.warning("Could not write statistics (%s)", e)
+
+    def _ssh_nodes(self):
+        return [n for n in self.nodes.values() if isinstance(n, SSHNode)]
+
+    async def _warm_master(self, node):
+        await self.ssh_acquire(node)
+        try:
+            await self.ensure_master(node)
+        except ExperimentExecutionError as e:
+            logging.warning("Warmup failed: %s", e.message)
+        finally:
+            self.ssh_release()
+
+    async def _check_node(self, node, probes, bounded):
+        async with probes:
+            reason = await preflight.tcp_probe(node.host, int(node.port), self.settings.preflight_connect_timeout)
+        if reason is not None:
+            return reason
+        # Waiting for our own connection limits doesn't count against the deadline
+        await self.ssh_acquire(node)
+        try:
+            await bounded(self.ensure_master(node, bounded.paused))
+        except ExperimentExecutionError as e:
+            return e.message
+        finally:
+            self.ssh_release()
+        return None
+
+    async def preflight(self):
+        """
+        Check that all SSH nodes are reachable and have a master
+        connection, and quarantine the ones that don't.  Raises an
+        ExperimentSetupError if the policy doesn't allow to go on.
+        """
+        nodes = self._ssh_nodes()
+        if not nodes:
+            return
+        logging.info("Pre-flight check of %s ssh nodes", len(nodes))
+        probes = asyncio.Semaphore(preflight.MAX_PROBES)
+        failed = await preflight.check_nodes(
+                nodes, lambda n, bounded: self._check_node(n, probes, bounded),
+                self.settings.preflight_deadline)
+        self.target_index.quarantine(failed)
+        preflight.apply_policy(self.settings.preflight, len(nodes), failed)
+
+    async def establish_masters(self):
+        """Start the master connections of all SSH nodes in parallel."""
+        nodes = self._ssh_nodes()
+        if not nodes:
+            return
+        logging.info("Establishing %s master connections", len(nodes))
+        async with TaskGroup() as group:
+            for n in nodes:
+                group.create_task(self._warm_master(n))
+
+    async def close_masters(self):
+        await self.master_pool.close_all(self._ssh_nodes())
 
-    @asyncio.coroutine
-    def cancel_pending(self):
-        yield from self.ec.cancel_pending()
+    def close_spawn_pool(self):
+        if self.spawn_pool is not None:
+            self.spawn_pool.close()
+
+    async def cancel_pending(self):
+        await self.ec.cancel_pending()
 
     def _process_group(self, els):
         members = []
@@ -428,6 +1119,16 @@ class Testbed:
             self._process_declaration(el)
         self.groups[els.get('name')] = members
 
+    def make_node(self, tp, el):
+        """Create the node of target 'el', of type 'local' or 'ssh'."""
+        if tp == 'local':
+            return LocalNode(el, testbed=self)
+        return SSHNode(el, testbed=self)
+
+    def wall_time(self):
+        """The time of day, that absolute start times and loops refer to."""
+        return time.time()
+
     def _process_declaration(self, el):
         name = el.get('name')
         if name is None:
@@ -435,11 +1136,8 @@ class Testbed:
         tp = el.get('type')
         if tp is None:
             raise Exception("target needs type")
-        if tp == 'local':
-            self.nodes[name] = LocalNode(el, testbed=self)
-            return
-        if tp == 'ssh':
-            self.nodes[name] = SSHNode(el, testbed=self)
+        if tp in ('local', 'ssh'):
+            self.nodes[name] = self.make_node(tp, el)
             return
         if tp == 'group':
             self._process_group(el)
@@ -461,62 +1159,74 @@ class Testbed:
         if groupname is None:
             groupname = slicename
 
-        server = xmlrpc.client.ServerProxy(api_url)
-
         user = find_text(el, 'user')
         if user is None:
             raise ExperimentSyntaxError("Planetlab slice requires 'user'")
         pw = find_text(el, 'password')
+        self.pl_slices.append((groupname, api_url, slicename, user, pw))
+
+    def _pl_auth(self, index):
+        groupname, api_url, slicename, user, pw = self.pl_slices[index]
+        if pw is None:
+            # Only asked once for all slices of the same account
+            pw = self.pl_passwords.get((api_url, user))
         if pw is None:
-            # XXX: check if interaction is allowed
-            pw = getpass.getpass("Planetlab Password: ")
+            if self.batch:
+                raise ExperimentSetupError("Planetlab slice '%s' needs a password, but interaction is disabled" % (slicename,))
+            pw = getpass.getpass("Planetlab Password (%s at %s): " % (user, api_url))
+            self.pl_passwords[(api_url, user)] = pw
         auth = {}
         auth['Username'] = user
         auth['AuthString'] = pw
         auth['AuthMethod'] = "password"
-
-        logging.info("Making RPC call to planetlab")
-
-        try:
-            node_ids = server.GetSlices(auth, [slicename], ['node_ids'])[0]['node_ids']
-
-            node_hostnames = [node['hostname'] for node in server.GetNodes(auth, node_ids, ['hostname'])]
-        except Exception as e:
-            raise ExperimentSetupError("PlanetLab API call failed")
-
-        logging.info("Got response from planetlab")
-
-        members = []
-        for num, hostname in enumerate(node_hostnames):
-            name = "_pl_" + slicename + "." + str(num)
-            cfg = E.target(
-                    {"type": "ssh", "name": name},
-                    E.host(hostname), E.user(slicename))
-            self.nodes[name] = SSHNode(cfg, testbed=self)
-            members.append(name)
-        self.groups[groupname] = members
+        return auth
+
+    async def discover(self):
+        """
+        Add the nodes of all PlanetLab slices, and index the targets.
+        Must be called before anything is run on the testbed.
+        """
+        if self.pl_slices:
+            settings = self.settings
+            cache = None
+            if settings.pl_cache_dir is not None:
+                cache = planetlab.SliceCache(settings.pl_cache_dir, settings.pl_cache_ttl)
+            slices = [(api_url, slicename) for groupname, api_url, slicename, user, pw in self.pl_slices]
+            results = await planetlab.discover(
+                    slices, cache, offline=settings.pl_offline,
+                    get_auth=self._pl_auth)
+            now = time.time()
+            for (groupname, api_url, slicename, user, pw), pl_nodes in zip(self.pl_slices, results):
+                members = []
+                for num, pl_node in enumerate(pl_nodes):
+                    # Numbered in the order of the API, dead nodes
+                    # don't change the names of the others
+                    name = "_pl_" + slicename + "." + str(num)
+                    if not settings.pl_all_nodes and not planetlab.is_alive(pl_node, settings.pl_max_contact_age, now):
+                        logging.info("Skipping PlanetLab node %s (%s), it is not up", name, pl_node['hostname'])
+                        continue
+                    cfg = E.target(
+                            {"type": "ssh", "name": name},
+                            E.host(pl_node['hostname']), E.user(slicename))
+                    self.nodes[name] = self.make_node('ssh', cfg)
+                    members.append(name)
+                if len(members) < len(pl_nodes):
+                    logging.warning("Slice '%s': using %d of %d nodes, the others are not up",
+                                    slicename, len(members), len(pl_nodes))
+                self.groups[groupname] = members
+        self.target_index = TargetIndex(self.nodes, self.groups)
 
     def _resolve_target(self, target_name):
-        target_nodes = []
-        unresolved_names = set(target_name.split(' '))
-
-        while len(unresolved_names):
-            n = unresolved_names.pop()
-            if n in self.nodes:
-                target_nodes.append(self.nodes[n])
-            elif n in self.groups:
-                unresolved_names.update(self.groups[n])
-            else:
-                raise Exception("Unknown target %s" % (n,))
+        return self.target_index.resolve(target_name)
 
-        return target_nodes
+    def _target_contains(self, target_name, node):
+        return self.target_index.contains(target_name, node)
 
-    @asyncio.coroutine
-    def run_step(self, step_xml, tasklists_env, var_env={}):
-        yield from self.ec.run_step(step_xml, tasklists_env, {})
+    async def run_step(self, step, var_env={}, unit=None):
+        await self.ec.run_step(step, {}, unit)
 
-    def join(self, targets=None):
-        yield from self.ec.join(targets)
+    async def join(self, targets=None):
+        await self.ec.join(targets)
 
 
 def find_text(node, query):
@@ -526,19 +1236,6 @@ def find_text(node, query):
     return res.text
 
 
-def get_delay_attr(node, prefix):
-    t_relative = node.get(prefix + '_relative')
-    if t_relative is not None:
-        return isodate.parse_duration(t_relative).total_seconds()
-    t_absolute = node.get(prefix + '_absolute')
-    if t_absolute is not None:
-        st = parse(t_absolute)
-        st = time.mktime(st.timetuple())
-        diff = st - time.time()
-        return diff
-    return None
-
-
 class ExpectSuccessPolicy:
     def __init__(self, command):
         self.command = command
@@ -549,38 +1246,34 @@ class ExpectSuccessPolicy:
 
 
 class RunTaskPolicy:
-    def __init__(self, node, run_xml):
+    def __init__(self, node, run_task):
         self.node = node
-        self.command = run_xml.text
-        self.task_name = run_xml.get('name')
-        expected_status_el = run_xml.get('expected-status')
-        if expected_status_el is None:
-            self.expected_status = None
-        else:
-            try:
-                self.expected_status = int(expected_status_el)
-            except ValueError:
-                expected_status = None
-                logging.error(
-                        "Invalid number '%s'",
-                        expected_status_el)
-
-    def _mklogdir(self):
-        dir = os.path.join(self.node.testbed.logroot_dir, self.node.name)
-        os.makedirs(dir, exist_ok=True)
-        return dir
+        self.command = run_task.command
+        self.task_name = run_task.name
+        self.expected_status = run_task.expected_status
 
     @contextmanager
-    def open_stdout(self):
-        if self.node.testbed.logroot_dir is None:
+    def open_output(self):
+        """
+        Record the output of the command in the log of the node, or
+        show it on the terminal.  Yields None if the command should
+        write to the terminal directly.
+        """
+        # XXX: also include tasklist name
+        record = self.node.testbed.begin_output(self.node, self.task_name)
+        if record is None:
             yield None
             return
-        outfilename = os.path.join(
-                # XXX: also include tasklist name
-                self._mklogdir(),
-                "%s.%s.out" % (self.task_name, self.node.testbed.run_counter))
-        with open(outfilename, "w") as f:
-            yield f
+        try:
+            yield record
+        except (ExperimentExecutionError, OSError):
+            if record.status is None:
+                # Most likely no connection to the node, the command
+                # wasn't killed, it never ran
+                record.status = 'not started'
+            raise
+        finally:
+            record.close()
 
     def check_status(self, status):
         if self.expected_status is None:
@@ -591,17 +1284,6 @@ class RunTaskPolicy:
         logging.error("Unexpected status")
         raise ExperimentExecutionError("Unexpected status")
 
-    @contextmanager
-    def open_stderr(self):
-        if self.node.testbed.logroot_dir is None:
-            yield None
-            return
-        errfilename = os.path.join(
-                self._mklogdir(),
-                "%s.%s.err" % (self.task_name, self.node.testbed.run_counter))
-        with open(errfilename, "w") as f:
-            yield f
-
 
 class Node:
     def __init__(self, node_xml, testbed):
@@ -614,69 +1296,93 @@ class Node:
         return self._env.copy()
 
 
-    @asyncio.coroutine
-    def _run_list(self, tasklist_xml, testbed, tasklists_env, var_env):
-        for task_xml in tasklist_xml:
-            yield from self._run_task(task_xml, testbed, tasklists_env, var_env)
+    async def _run_list(self, tasks, var_env):
+        for task in tasks:
+            await self._run_task(task, var_env)
 
-    @asyncio.coroutine
-    def run_cleanup(self, tasklist_xml, tasklists_env, var_env):
-        cleanup_task = None
-        cleanup_name = tasklist_xml.get('cleanup')
-        if cleanup_name is not None:
-            cleanup_task = tasklists_env.get(cleanup_name)
-            if cleanup_task is None:
-                raise ExperimentSyntaxError("cleanup task %s not found\n" % (cleanup_name,))
-        if cleanup_task is None:
+    async def _run_task(self, task, var_env):
+        if task.kind not in _TRACED_TASKS:
+            await self._task_table[task.kind](self, task, var_env)
+            return
+        label = 'run ' + task.name if task.kind == 'run' else task.kind
+        with self.testbed.tracer.span('task', label):
+            await self._task_table[task.kind](self, task, var_env)
+
+    async def _run_forked(self, task, var_env):
+        # A branch of 'par', traced on its own lane
+        with self.testbed.tracer.lane(self.name, fork=True):
+            await self._run_task(task, var_env)
+
+    async def prepare_start(self, start):
+        """Prepare the node for a timed step that starts at 'start.target'."""
+        pass
+
+    def release_start(self, start):
+        """Release what prepare_start kept for the timed step."""
+        pass
+
+    async def run_cleanup(self, tasklist, var_env):
+        if tasklist.cleanup_name is None:
             return
-        #coro = self._run_list(cleanup_task, self.testbed, tasklists_env, var_env)
-        coro = self.run_tasklist(cleanup_task, tasklists_env, var_env, None)
+        cleanup_task = tasklist.cleanup
+        if cleanup_task is None:
+            raise ExperimentSyntaxError("cleanup task %s not found\n" % (tasklist.cleanup_name,))
         try:
-            yield from asyncio.async(coro)
+            await self.run_tasklist(cleanup_task, var_env, None)
         except asyncio.TimeoutError:
             # XXX: be more verbose!
             logging.warning(
                     "Cleanup tasklist %s on node %s timed out",
-                    cleanup_name,
+                    tasklist.cleanup_name,
                     self.name)
         except StopExperimentException as e:
             logging.warning(
                     "Cleanup tasklist %s on node %s stopped (%s)",
-                    cleanup_name,
+                    tasklist.cleanup_name,
                     self.name,
                     e.scope)
         except ExperimentExecutionError as e:
             logging.warning(
                     "Cleanup tasklist %s on node %s failed (%s)",
-                    cleanup_name,
+                    tasklist.cleanup_name,
                     self.name,
                     e.message)
 
 
-    @asyncio.coroutine
-    def run_tasklist(self, tasklist_xml, tasklists_env, var_env, stop_time):
-        list_name = tasklist_xml.get('name', '(unnamed)')
+    async def run_tasklist(self, tasklist, var_env, stop_time):
+        """Run 'tasklist', return 'timeout' if it timed out, otherwise None."""
+        tracer = self.testbed.tracer
+        with tracer.lane(self.name), tracer.span('tasklist', 'tasklist ' + tasklist.name):
+            return await self._run_tasklist(tasklist, var_env, stop_time)
+
+    async def _run_tasklist(self, tasklist, var_env, stop_time):
+        list_name = tasklist.name
         logging.info("running tasklist '%s'", list_name)
-        # actual tasks, with declarations stripped
-        error_policy = tasklist_xml.get('on-error')
-        if error_policy is None:
-            error_policy = 'stop-tasklist'
-        timeout_str = tasklist_xml.get('timeout')
+        error_policy = tasklist.on_error
         timeout = stop_time
-        if timeout_str is not None:
-            timeout_tl = isodate.parse_duration(timeout_str).total_seconds()
+        if tasklist.timeout is not None:
             if timeout is None:
-                timeout = timeout_tl
+                timeout = tasklist.timeout
             else:
-                times = [timeout_tl, timeout]
-                timeout = min(times)
+                timeout = min(tasklist.timeout, timeout)
 
-        coro = self._run_list(tasklist_xml, self.testbed, tasklists_env, var_env)
+        coro = None
+        if self.use_agent(tasklist):
+            if tasklist.agent_plan is not None:
+                coro = self.run_agent(tasklist.agent_plan, tasklist.agent_runs, var_env, timeout)
+            else:
+                logging.info("Tasklist %s can't be run by the agent", list_name)
+        if coro is None:
+            coro = self._run_list(tasklist.body, var_env)
         try:
             logging.info(
                     "Running tasklist %s with timeout of %s.",
                     list_name, timeout)
-            yield from asyncio.wait_for(asyncio.async(coro), timeout)
+            if timeout is None:
+                # No need for a separate task that could be cancelled
+                await coro
+            else:
+                await asyncio.wait_for(coro, timeout)
         except asyncio.TimeoutError:
             # XXX: be more verbose!
             logging.warning(
@@ -684,6 +1390,7 @@ class Node:
                     list_name,
                     self.name)
             # XXX: cleanup!
+            return 'timeout'
         except StopExperimentException as e:
             if e.scope == 'stop-experiment':
                 raise
@@ -691,110 +1398,147 @@ class Node:
         except ExperimentExecutionError as e:
             logging.error("Tasklist execution (%s on %s) raised exception (%s)", list_name, self.name, e.message)
             if error_policy in ('stop-experiment', 'stop-step', 'stop-tasklist'):
-                yield from self.run_cleanup(tasklist_xml, tasklists_env, var_env)
+                await self.run_cleanup(tasklist, var_env)
                 raise StopExperimentException(error_policy)
             else:
                 raise ExperimentSyntaxError("Unexpected error policy '%s'" % (error_policy,))
-        yield from self.run_cleanup(tasklist_xml, tasklists_env, var_env)
+        await self.run_cleanup(tasklist, var_env)
 
-    @asyncio.coroutine
-    def _run_task_run(self, task_xml, var_env):
-        pol = RunTaskPolicy(self, task_xml)
+    def use_agent(self, tasklist):
+        return False
 
-        with pol.open_stdout() as stdout, pol.open_stderr() as stderr:
-            yield from self.execute(pol, stdout, stderr, var_env)
+    def _copy_paths(self, task):
+        # XXX: Just replace all environment variables
+        source = task.source.replace("$GPLMT_TARGET", self.name)
+        destination = task.destination.replace("$GPLMT_TARGET", self.name)
+        return source, destination
 
-    @asyncio.coroutine
-    def _run_task(self, task_xml, testbed, tasklists_env, var_env):
-        name = task_xml.get('name', '(unnamed-task)')
-        if task_xml.get('enabled', 'true').lower() == 'false':
-            logging.info("Task %s disabled", name)
-            return
-        if task_xml.tag == 'run':
-            yield from self._run_task_run(task_xml, var_env)
-            return
-        if task_xml.tag == 'get':
-            source = find_text(task_xml, 'source')
-            destination = find_text(task_xml, 'destination')
-            # XXX: Just replace all environment variables
-            source = source.replace("$GPLMT_TARGET", self.name)
-            destination = destination.replace("$GPLMT_TARGET", self.name)
-            yield from self.get(source, destination)
-            return
-        if task_xml.tag == 'put':
-            source = find_text(task_xml, 'source')
-            destination = find_text(task_xml, 'destination')
-            kp_str = task_xml.attrib.get("keep")
-            # XXX: Just replace all environment variables
-            source = source.replace("$GPLMT_TARGET", self.name)
-            destination = destination.replace("$GPLMT_TARGET", self.name)
-
-            if kp_str is None or kp_str.lower() == 'false':
-                #Check for invalid characters, whitelisting
-                valid = re.compile("^([\.a-zA-Z][\-\.a-zA-Z]+)$")
-                if valid.match(destination):
-                    composedEnv = []
-                    tasklist = lxml.etree.Element("tasklist", name="cleanup")#on error?
-                    child1 = lxml.etree.SubElement(tasklist, "seq")
-                    child2 = lxml.etree.SubElement(child1, "run", name="_anon2")
-                    child2.text = ("rm " + destination)
-                    self.testbed.teardowns.append((self.name, tasklist, composedEnv))
-                else:
-                    logging.warning("no automated removal, invalid characters in destination: %s", destination)
-
-            yield from self.put(source, destination)
-            return
-        if task_xml.tag in ('sequence', 'seq'):
-            for child_task in task_xml:
-                yield from self._run_task(child_task, testbed, tasklists_env, var_env)
-            return
-        if task_xml.tag == 'fail':
-            raise ExperimentExecutionError("user-requested fail")
-        if task_xml.tag == 'call':
-            tl = task_xml.get('tasklist')
-            if tl is None:
-                raise ExperimentSyntaxError("no tasklist name in 'call'")
-            tasklist_xml = tasklists_env.get(tl)
-            if tasklist_xml is None:
-                raise ExperimentSyntaxError("Tasklist '%s' not defined" % (tl,))
-            yield from self.run_tasklist(tasklist_xml, tasklists_env, var_env)
-        if task_xml.tag in ('par', 'parallel'):
-            parallel_tasks = []
-            for child_task in task_xml:
-                coro = self._run_task(child_task, testbed, tasklists_env, var_env)
-                task = asyncio.async(coro)
-                parallel_tasks.append(task)
-            done, pending = yield from asyncio.wait(parallel_tasks)
-            for task in done:
-                task.result()
+    def _register_put_cleanup(self, task, destination):
+        if task.keep:
             return
+        #Check for invalid characters, whitelisting
+        valid = re.compile("^([\.a-zA-Z][\-\.a-zA-Z]+)$")
+        if valid.match(destination):
+            self.testbed.add_removal(self.name, destination)
+        else:
+            logging.warning("no automated removal, invalid characters in destination: %s", destination)
+
+    async def put_batch(self, files, compress=False):
+        for source, destination in files:
+            await self.put(source, destination)
+
+    async def put_broadcast(self, source, destination):
+        await self.put(source, destination)
+
+    async def get_batch(self, files, compress=False):
+        for source, destination in files:
+            await self.get(source, destination)
+
+    async def _task_run(self, task, var_env):
+        pol = RunTaskPolicy(self, task)
+
+        with pol.open_output() as output:
+            await self.execute(pol, output, var_env)
+
+    async def _task_get(self, task, var_env):
+        source, destination = self._copy_paths(task)
+        await self.get(source, destination)
+
+    async def _task_put(self, task, var_env):
+        source, destination = self._copy_paths(task)
+        self._register_put_cleanup(task, destination)
+        if task.broadcast:
+            await self.put_broadcast(source, destination)
+        else:
+            await self.put(source, destination)
+
+    async def _task_transfer(self, task, var_env):
+        """Run a batch of 'put' and 'get' tasks, puts first."""
+        puts = []
+        for put in task.puts:
+            source, destination = self._copy_paths(put)
+            self._register_put_cleanup(put, destination)
+            puts.append((source, destination))
+        gets = [self._copy_paths(get) for get in task.gets]
+        if puts:
+            await self.put_batch(puts, task.compress)
+        if gets:
+            await self.get_batch(gets, task.compress)
+
+    async def _task_seq(self, task, var_env):
+        await self._run_list(task.children, var_env)
+
+    async def _task_par(self, task, var_env):
+        run = self._run_forked if self.testbed.tracer.enabled else self._run_task
+        async with TaskGroup() as group:
+            for child_task in task.children:
+                group.create_task(run(child_task, var_env))
+
+    async def _task_fail(self, task, var_env):
+        raise ExperimentExecutionError("user-requested fail")
+
+    async def _task_call(self, task, var_env):
+        if task.tasklist is None:
+            raise ExperimentSyntaxError("Tasklist '%s' not defined" % (task.name,))
+        await self.run_tasklist(task.tasklist, var_env, None)
+
+    _task_table = {
+            'run': _task_run,
+            'get': _task_get,
+            'put': _task_put,
+            'transfer': _task_transfer,
+            'seq': _task_seq,
+            'par': _task_par,
+            'fail': _task_fail,
+            'call': _task_call,
+    }
+
+
+# Tasks that get a span of their own, the others consist of them
+_TRACED_TASKS = frozenset(['run', 'get', 'put', 'transfer'])
 
 
 class LocalNode(Node):
     def __init__(self, node_xml, testbed):
         super().__init__(node_xml, testbed)
 
-    @asyncio.coroutine
-    def execute(self, pol, stderr, stdout, var_env = {}):
+    async def execute(self, pol, output=None, var_env = {}):
         logging.info("Locally executing command '%s'", pol.command)
         env = self.env
         env.update(var_env)
-        proc = yield from asyncio.create_subprocess_shell(
-                pol.command, stdout=stdout, stderr=stderr, env=env, start_new_session=True)
+        with self.testbed.tracer.span('process') as span:
+            await self._execute(pol, output, env, span)
+
+    async def _execute(self, pol, output, env, span):
+        pipe = None if output is None else subprocess.PIPE
+        pool = self.testbed.spawn_pool
+        if pool is not None:
+            proc = await pool.create_subprocess_shell(pol.command, env, stdout=pipe, stderr=pipe)
+        else:
+            proc = await asyncio.create_subprocess_shell(
+                    pol.command, stdout=pipe, stderr=pipe, env=env, start_new_session=True)
+        span.mark('spawn')
+        note_started(self)
         try:
-            ret = yield from proc.wait()
+            if output is not None:
+                await pump_output(proc, output)
+            ret = await proc.wait()
+            if output is not None:
+                output.status = ret
             pol.check_status(ret)
         except asyncio.CancelledError as e:
-                os.killpg(os.getpgid(proc.pid), signal.SIGTERM)
-                logging.info("Local command terminated due to timeout or stop_time.")
-            
+            # The command runs in its own session, its process group has its pid
+            try:
+                os.killpg(proc.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+            logging.info("Local command terminated due to timeout or stop_time.")
+            raise
 
-    @asyncio.coroutine
-    def put(self, source, destination):
+    async def put(self, source, destination):
         logging.warn("Task type 'put' not available for local nodes, ignoring.")
 
-    @asyncio.coroutine
-    def get(self, source, destination):
+    async def get(self, source, destination):
         logging.warn("Task type 'get' not available for local nodes, ignoring.")
 
 
@@ -819,30 +1563,38 @@ class SSHNode(Node):
         if self.port is None:
             self.port = 22
         self.target = "%s@%s" % (self.user, self.host)
+        # remote path of the agent, once it is installed
+        self.agent_path = None
+        self.agent_lock = asyncio.Lock()
 
+    def _ssh_options(self):
+        argv = []
+        # XXX: make optional
+        argv.extend(['-o', 'StrictHostKeyChecking=no'])
+        # XXX: make optional
+        argv.extend(['-o', 'BatchMode=yes'])
+        argv.extend(['-o', 'ControlPath='+self.get_control_path()])
+        return argv
 
-    @asyncio.coroutine
-    def establish_master(self):
-        control_path = self.get_control_path()
-        # XXX: maybe check that the master process is actually running
-        if os.path.exists(control_path):
-            logging.info("Using existing master")
-            # XXX: increase semaphore
-            return
-        logging.info("Creating new master")
+    def master_command(self):
         argv = ['ssh']
-        argv.extend(['-o', 'BatchMode=yes'])
-        argv.extend(['-o', 'StrictHostKeyChecking=no'])
-        argv.extend(['-o', 'ControlPath='+control_path])
+        argv.extend(self._ssh_options())
         argv.extend(['-o', 'ControlMaster=yes'])
-        # We could also specify a timeout here ...
+        # The pool tears the master down with '-O exit'
         argv.extend(['-o', 'ControlPersist=yes'])
+        argv.extend(['-p', str(self.port)])
+        argv.extend(self.extra)
         argv.extend([self.target, 'true'])
-        proc = yield from asyncio.create_subprocess_exec(
-                *argv)
-        ret = yield from proc.wait()
-        if ret != 0:
-            raise ExperimentExecutionError("Failed to create SSH master connection to '%s'" % (self.name,))
+        return argv
+
+    def control_command(self, op):
+        argv = ['ssh']
+        argv.extend(self._ssh_options())
+        argv.extend(['-O', op])
+        argv.extend(['-p', str(self.port)])
+        argv.extend(self.extra)
+        argv.append(self.target)
+        return argv
 
     def get_control_path(self):
         # FIXME: other directory (e.g. ~/.config/gplmt)?
@@ -851,10 +1603,141 @@ class SSHNode(Node):
         }
         return os.path.expanduser(p)
 
-    @asyncio.coroutine
-    def execute(self, pol, stdout=None, stderr=None, var_env = {}):
-        yield from self.testbed.ssh_acquire()
+    async def session(self, cmd, stdin=None, stdout=None, stderr=None, options=(), handler=None):
+        """
+        Run a shell command on the node over the master connection
+        and return its exit status.  If given, the coroutine 'handler'
+        is run with the process before waiting for it.
+        """
+        pool = self.testbed.master_pool
+        limiter = self.testbed.ssh_limiter
+        tracer = self.testbed.tracer
+        start = _timed_start.get()
+        if start is not None and start.reserved and start.node is self:
+            # The first command of a timed step, prepare_start has
+            # reserved a connection slot and a session for it
+            start.reserved = False
+        else:
+            await self.testbed.ssh_acquire(self)
+            try:
+                await self.testbed.ensure_master(self)
+                with tracer.span('session wait'):
+                    await pool.acquire_session(self)
+            except:
+                self.testbed.ssh_release()
+                raise
+
+        argv = ['ssh']
+        argv.extend(self._ssh_options())
+        argv.extend(['-o', 'ControlMaster=no'])
+        argv.extend(options)
+        argv.extend(['-p', str(self.port)])
+        argv.extend(self.extra)
+        argv.extend([self.target])
+        argv.extend(['--', cmd])
+        logging.info("SSH command '%s'", repr(argv))
+        try:
+            with tracer.span('process') as span:
+                try:
+                    proc = await self.create_process(argv, stdin, stdout, stderr)
+                except OSError:
+                    # Most likely out of file descriptors or processes
+                    limiter.failure()
+                    raise
+                span.mark('spawn')
+                note_started(self)
+                logging.info("waiting ...")
+                try:
+                    if handler is not None:
+                        await handler(proc)
+                    ret = await proc.wait()
+                except asyncio.CancelledError:
+                    proc.terminate()
+                    raise
+                span.set(status=ret)
+            if ret == 255:
+                # Could be the command, but could also be a dead master.
+                pool.invalidate(self)
+                limiter.failure()
+            else:
+                limiter.success()
+            return ret
+        finally:
+            pool.release_session(self)
+            self.testbed.ssh_release()
+
+    async def prepare_start(self, start):
+        """
+        Set up the master connection --start-prewarm seconds before a timed
+        step starts, and reserve a connection slot and a session for its
+        first command shortly before, so that it doesn't wait for them or
+        for the connection rate limits at the start time.
+        """
+        lead = self.testbed.settings.start_prewarm
+        if not lead:
+            return
+        with self.testbed.tracer.lane(self.name):
+            await self._prepare_start(start, lead)
+
+    async def _prepare_start(self, start, lead):
+        loop = asyncio.get_running_loop()
+        await asyncio.sleep(max(start.target - lead - loop.time(), 0))
+        # Not cancelled when the step starts, a master that is still
+        # being set up then keeps its place in the rate limits
+        warm = asyncio.ensure_future(self._warm())
+        try:
+            if not await asyncio.wait_for(asyncio.shield(warm),
+                                          max(start.target - RESERVE_AHEAD - loop.time(), 0)):
+                return
+        except asyncio.TimeoutError:
+            logging.info("Master for '%s' not ready before the start of the step", self.name)
+            return
+        await asyncio.sleep(max(start.target - RESERVE_AHEAD - loop.time(), 0))
+        try:
+            await asyncio.wait_for(self._reserve(start), max(start.target - loop.time(), 0))
+        except asyncio.TimeoutError:
+            logging.info("Could not reserve a session on '%s' before the start of the step", self.name)
+        except ExperimentExecutionError as e:
+            logging.warning("Reserving a session on '%s' failed: %s", self.name, e.message)
+
+    async def _warm(self):
+        testbed = self.testbed
+        try:
+            await testbed.ssh_acquire(self)
+            try:
+                await testbed.ensure_master(self)
+            finally:
+                testbed.ssh_release()
+        except ExperimentExecutionError as e:
+            # The step tries again when it starts
+            logging.warning("Preparing '%s' for the start of the step failed: %s", self.name, e.message)
+            return False
+        return True
+
+    async def _reserve(self, start):
+        testbed = self.testbed
+        await testbed.ssh_acquire(self)
+        try:
+            await testbed.ensure_master(self)
+            await testbed.master_pool.acquire_session(self)
+        except:
+            testbed.ssh_release()
+            raise
+        start.reserved = True
+
+    def release_start(self, start):
+        if start.reserved:
+            start.reserved = False
+            self.testbed.master_pool.release_session(self)
+            self.testbed.ssh_release()
+
+    async def create_process(self, argv, stdin, stdout, stderr):
+        """Start the ssh command 'argv' of a session."""
+        return await asyncio.create_subprocess_exec(
+                *argv,
+                stdin=stdin, stdout=stdout, stderr=stderr)
 
+    async def execute(self, pol, output=None, var_env = {}):
         cmd = pol.command
 
         logging.info("Executing command '%s' on '%s'", pol.command, self.name)
@@ -867,78 +1750,316 @@ class SSHNode(Node):
         if env:
             cmd = helper.wrap_env(cmd, env)
 
-        yield from self.establish_master()
+        pipe = None
+        handler = None
+        if output is not None:
+            pipe = subprocess.PIPE
+            handler = lambda proc: pump_output(proc, output)
+        try:
+            ret = await self.session(cmd, stdout=pipe, stderr=pipe, handler=handler)
+        except asyncio.CancelledError:
+            logging.info("SSH command terminated due to timeout or stop_time.")
+            raise
+        logging.info("SSH command terminated with status %s", ret)
+        if output is not None:
+            output.status = ret
+        pol.check_status(ret)
+
+    async def put(self, source, destination):
+        # Stream the file over the master connection, so that
+        # creating the directory and copying only takes one session.
+        try:
+            mode = os.stat(source).st_mode & 0o777
+            f = open(source, 'rb')
+        except OSError as e:
+            raise ExperimentExecutionError("Can't read '%s' (%s)" % (source, e.strerror))
+        cmd = receive_command(destination, mode)
+        logging.info("Copying '%s' to '%s:%s'", source, self.name, destination)
+        with f, self.testbed.tracer.span('transfer', 'put ' + destination) as span:
+            ret = await self.session(cmd, stdin=f)
+            span.set(bytes=os.fstat(f.fileno()).st_size)
+        if ret != 0:
+            raise ExperimentExecutionError("Copy from '%s' to '%s:%s' failed" % (source, self.name, destination))
+
+    async def _verify(self, destination, digest):
+        """Check that the copy of 'destination' on the node has the right digest."""
+        try:
+            home, digests = await self._manifest([destination])
+        except ExperimentExecutionError:
+            return False
+        return digests.get(destination) == digest
 
+    async def _forward(self, parent, destination, mode):
+        """Let 'parent' copy its 'destination' to the same location on this node."""
         argv = ['ssh']
         # XXX: make optional
         argv.extend(['-o', 'StrictHostKeyChecking=no'])
-        # XXX: make optional
         argv.extend(['-o', 'BatchMode=yes'])
-        argv.extend(['-o', 'ControlMaster=no'])
-        control_path = self.get_control_path()
-        argv.extend(['-o', 'ControlPath='+control_path])
         argv.extend(['-p', str(self.port)])
-        argv.extend(self.extra)
-        argv.extend([self.target])
-        argv.extend(['--', cmd])
-        logging.info("SSH command '%s'", repr(argv))
-        proc = yield from asyncio.create_subprocess_exec(
-                *argv,
-                stdout=stdout, stderr=stderr)
-        logging.info("waiting ...")
+        argv.extend([self.target, '--', receive_command(destination, mode)])
+        dest = shlex.quote(destination)
+        cmd = '[ -r %s ] || exit %d; %s < %s || exit %d' % (
+                dest, FORWARD_NO_SOURCE, ' '.join(shlex.quote(a) for a in argv), dest, FORWARD_FAILED)
+        logging.info("Forwarding '%s' from '%s' to '%s'", destination, parent.name, self.name)
+        # The parent authenticates to us with our agent
+        return await parent.session(cmd, options=['-o', 'ForwardAgent=yes'])
+
+    async def put_broadcast(self, source, destination):
         try:
-            ret = yield from proc.wait()
-            logging.info("SSH command terminated with status %s", ret)
-            pol.check_status(ret)
-        except asyncio.CancelledError as e:
-            proc.terminate()
-            logging.info("SSH command terminated due to timeout or stop_time.")
+            mode = os.stat(source).st_mode & 0o777
+            digest = await self.testbed.file_digest(source)
+        except OSError as e:
+            raise ExperimentExecutionError("Can't read '%s' (%s)" % (source, e.strerror))
+        bc = self.testbed.broadcast(destination, digest)
+        if bc.has_holder(self):
+            # Broadcast to us before, e.g. in an earlier loop iteration
+            if (await self._verify(destination, digest)):
+                return
+            await bc.remove_holder(self)
+        parent = await bc.acquire(self)
+        received = False
+        # Whether the parent itself can't forward any more: it is
+        # unreachable (status 255 of its session) or lost its copy
+        parent_failed = False
+        try:
+            if parent is None:
+                await self.put(source, destination)
+                received = await self._verify(destination, digest)
+            else:
+                # until its session returns a status
+                parent_failed = True
+                ret = await self._forward(parent, destination, mode)
+                parent_failed = ret not in (0, FORWARD_FAILED)
+                if ret == 0:
+                    received = await self._verify(destination, digest)
         finally:
-            self.testbed.ssh_release()
+            await bc.done(parent, self, received, parent_failed)
+        if parent is not None and not received:
+            logging.warning(
+                    "Forwarding '%s' from '%s' to '%s' failed, uploading directly",
+                    destination, parent.name, self.name)
+            await self.put(source, destination)
+            if (await self._verify(destination, digest)):
+                await bc.add_holder(self)
 
-    @asyncio.coroutine
-    def scp_copy(self, scp_source, scp_destination):
-        yield from self.testbed.ssh_acquire()
-        yield from self.establish_master()
-        argv = ['scp']
-        # XXX: make optional
-        argv.extend(['-o', 'StrictHostKeyChecking=no'])
-        # XXX: make optional
-        argv.extend(['-o', 'BatchMode=yes'])
-        # XXX: make optional
-        argv.extend(['-o', 'BatchMode=yes'])
-        argv.extend(['-o', 'ControlMaster=no'])
-        argv.extend(['-P', str(self.port)])
-        argv.extend(self.extra)
-        argv.extend(['--', scp_source, scp_destination])
-        logging.info("SCP command '%s'", repr(argv))
-        proc = yield from asyncio.create_subprocess_exec(*argv)
-        ret = yield from proc.wait()
-        self.testbed.ssh_release()
+    async def get(self, source, destination):
+        # Ensure that target directory exists
+        os.makedirs(os.path.dirname(os.path.realpath(destination)), exist_ok=True)
+        # Don't leave a truncated file behind if the copy fails
+        partial = destination + '.part'
+        cmd = 'cat -- %s' % (shlex.quote(source),)
+        logging.info("Copying '%s:%s' to '%s'", self.name, source, destination)
+        with open(partial, 'wb') as f, self.testbed.tracer.span('transfer', 'get ' + source) as span:
+            ret = await self.session(cmd, stdout=f)
+            span.set(bytes=os.fstat(f.fileno()).st_size)
         if ret != 0:
-            raise ExperimentExecutionError("Copy from '%s' to '%s' failed" % (scp_source, scp_destination))
+            os.unlink(partial)
+            raise ExperimentExecutionError("Copy from '%s:%s' to '%s' failed" % (self.name, source, destination))
+        os.replace(partial, destination)
+
+    def use_agent(self, tasklist):
+        if tasklist.agent is not None:
+            return tasklist.agent
+        return self.testbed.settings.agent
+
+    async def _install_agent(self):
+        """Copy the agent to the node, unless it is already there."""
+        if self.agent_path is not None:
+            return self.agent_path
+        await self.agent_lock.acquire()
+        try:
+            if self.agent_path is not None:
+                return self.agent_path
+            digest = await self.testbed.file_digest(AGENT_SCRIPT)
+            path = '.gplmt/agent-%s.py' % (digest[:16],)
+            cmd = '[ -f {0} ] || {{ mkdir -p .gplmt && cat > {0}.$$ && mv {0}.$$ {0}; }}'.format(path)
+            with open(AGENT_SCRIPT, 'rb') as f:
+                ret = await self.session(cmd, stdin=f)
+            if ret != 0:
+                raise ExperimentExecutionError("Installing the agent on '%s' failed" % (self.name,))
+            self.agent_path = path
+            return path
+        finally:
+            self.agent_lock.release()
 
-    @asyncio.coroutine
-    def put(self, source, destination):
-        if os.path.isabs(source):
-            scp_source = source
-        else:
-            scp_source = './' + source
-        scp_destination = '%s:%s' % (self.target, destination)
-        pol = ExpectSuccessPolicy("mkdir -p $(dirname $(readlink -fm %s))" % (shlex.quote(destination)))
-        yield from self.execute(pol)
-        yield from self.scp_copy(scp_source, scp_destination)
-
-    @asyncio.coroutine
-    def get(self, source, destination):
-        scp_source = '%s:%s' % (self.target, source)
-        if os.path.isabs(source):
-            scp_destination = destination
+    async def run_agent(self, plan, runs, var_env, timeout):
+        """Run a serialized tasklist with the remote agent in one session."""
+        path = await self._install_agent()
+        env = self.env
+        env.update(var_env)
+        request = json.dumps({'plan': plan, 'env': env, 'timeout': timeout})
+        outcome = {}
+
+        async def talk(proc):
+            proc.stdin.write(request.encode('utf-8') + b'\n')
+            await proc.stdin.drain()
+            # Output files of the commands that are currently running
+            outputs = {}
+            try:
+                while True:
+                    line = await proc.stdout.readline()
+                    if not line:
+                        break
+                    event = json.loads(line.decode('utf-8'))
+                    kind = event['event']
+                    if kind == 'start':
+                        pol = RunTaskPolicy(self, runs[event['id']])
+                        logging.info("Agent on '%s' runs '%s'", self.name, pol.command)
+                        stack = ExitStack()
+                        output = stack.enter_context(pol.open_output())
+                        outputs[event['id']] = (stack, output)
+                    elif kind == 'output':
+                        stack, output = outputs[event['id']]
+                        data = event['data'].encode('latin-1')
+                        if output is None:
+                            f = sys.stdout if event['stream'] == 'out' else sys.stderr
+                            f.buffer.write(data)
+                            f.flush()
+                        else:
+                            output.write(event['stream'], data)
+                            await output.drain()
+                    elif kind == 'exit':
+                        logging.info("Agent command on '%s' terminated with status %s", self.name, event['status'])
+                        stack, output = outputs.pop(event['id'])
+                        if output is not None:
+                            output.status = event['status']
+                        stack.close()
+                    elif kind == 'done':
+                        outcome.update(event)
+            finally:
+                for stack, output in outputs.values():
+                    stack.close()
+                proc.stdin.close()
+
+        cmd = '%s %s' % (shlex.quote(self.testbed.settings.agent_python), path)
+        ret = await self.session(
+                cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, handler=talk)
+        if not outcome:
+            raise ExperimentExecutionError("Agent on '%s' failed with status %s" % (self.name, ret))
+        if outcome.get('timeout'):
+            # Same as a timeout of a tasklist that we run ourselves
+            raise asyncio.TimeoutError()
+        if 'error' in outcome:
+            raise ExperimentExecutionError(outcome['error'])
+
+    async def _manifest(self, paths):
+        """Get the remote home directory and the digests of existing 'paths'."""
+        with tempfile.TemporaryFile() as out:
+            ret = await self.session(transfer.manifest_command(paths), stdout=out)
+            if ret != 0:
+                raise ExperimentExecutionError("Reading checksums on '%s' failed" % (self.name,))
+            out.seek(0)
+            return transfer.parse_manifest(out.read())
+
+    async def put_batch(self, files, compress=False):
+        """
+        Copy several files to the node as one tar stream,
+        skipping files that are already up to date.
+        """
+        loop = asyncio.get_running_loop()
+        home, remote_digests = await self._manifest([d for s, d in files])
+        try:
+            local_digests = await loop.run_in_executor(
+                    None, transfer.digest_files, [s for s, d in files])
+        except OSError as e:
+            raise ExperimentExecutionError("Can't read '%s' (%s)" % (e.filename, e.strerror))
+        members = []
+        for (source, destination), digest in zip(files, local_digests):
+            if remote_digests.get(destination) == digest:
+                logging.info("'%s' on '%s' is up to date", destination, self.name)
+                continue
+            # Relative destinations are relative to the home directory
+            members.append((source, posixpath.join(home, destination)))
+        if not members:
+            return
+        logging.info("Copying %s of %s files to '%s'", len(members), len(files), self.name)
+        with tempfile.TemporaryFile() as archive, \
+                self.testbed.tracer.span('transfer', 'put %d files' % (len(members),)) as span:
+            await loop.run_in_executor(None, transfer.write_archive, archive, members, compress)
+            span.set(bytes=os.fstat(archive.fileno()).st_size)
+            archive.seek(0)
+            cmd = 'tar -x%s -o -C / -f -' % ('z' if compress else '',)
+            ret = await self.session(cmd, stdin=archive)
+        if ret != 0:
+            raise ExperimentExecutionError("Copy of %s files to '%s' failed" % (len(members), self.name))
+
+    async def get_batch(self, files, compress=False):
+        """
+        Copy several files from the node as one tar stream,
+        skipping files whose local copy is up to date.
+        """
+        loop = asyncio.get_running_loop()
+        existing = [(s, d) for s, d in files if os.path.isfile(d)]
+        if existing:
+            home, remote_digests = await self._manifest([s for s, d in existing])
+            local_digests = await loop.run_in_executor(
+                    None, transfer.digest_files, [d for s, d in existing])
+            unchanged = set()
+            for (source, destination), digest in zip(existing, local_digests):
+                if remote_digests.get(source) == digest:
+                    logging.info("'%s' from '%s' is up to date", destination, self.name)
+                    unchanged.add((source, destination))
+            files = [f for f in files if f not in unchanged]
+        if not files:
+            return
+        logging.info("Copying %s files from '%s'", len(files), self.name)
+        sources = ' '.join(shlex.quote(s) for s, d in files)
+        cmd = 'tar -cP%s -f - -- %s' % ('z' if compress else '', sources)
+        with tempfile.TemporaryFile() as archive, \
+                self.testbed.tracer.span('transfer', 'get %d files' % (len(files),)) as span:
+            ret = await self.session(cmd, stdout=archive)
+            span.set(bytes=os.fstat(archive.fileno()).st_size)
+            archive.seek(0)
+            try:
+                missing = await loop.run_in_executor(
+                        None, transfer.extract_archive, archive, files, compress)
+            except tarfile.TarError:
+                missing = [s for s, d in files]
+        if ret != 0 or missing:
+            missing = missing or [s for s, d in files]
+            raise ExperimentExecutionError("Copy of '%s' from '%s' failed" % ("', '".join(missing), self.name))
+
+
+# Longest 'rm' command for removing copied files, well below the limit
+# of the length of a single argument of the shell (128 KiB on Linux)
+CLEANUP_COMMAND_MAX = 65536
+
+# Name of the run tasks of these commands in the output and the logs.
+# Not like the '_anonN' names that establish_names gives to anonymous
+# run tasks, so that their output isn't mixed up.
+CLEANUP_TASK = "cleanup rm"
+
+
+def cleanup_tasklists(destinations):
+    """
+    Tasklists that remove files that were copied to a node, as few as
+    the length of the commands allows.
+    """
+    tasklists = []
+    command = None
+    for destination in destinations:
+        if command is not None and len(command) + 1 + len(destination) > CLEANUP_COMMAND_MAX:
+            tasklists.append(make_tasklist("cleanup", [RunTask(CLEANUP_TASK, command)]))
+            command = None
+        if command is None:
+            command = "rm " + destination
         else:
-            scp_destination = './' + destination
-        # Ensure that target directory exists
-        os.makedirs(os.path.dirname(os.path.realpath(destination)), exist_ok=True)
-        yield from self.scp_copy(scp_source, scp_destination)
+            command += " " + destination
+    if command is not None:
+        tasklists.append(make_tasklist("cleanup", [RunTask(CLEANUP_TASK, command)]))
+    return tasklists
+
+
+# Exit statuses of the forwarding command run on the parent: the parent
+# doesn't have the file, or sending it to the receiving node failed
+FORWARD_NO_SOURCE = 3
+FORWARD_FAILED = 4
+
+
+def receive_command(destination, mode):
+    """Shell command that stores its standard input in 'destination'."""
+    dest = shlex.quote(destination)
+    return 'mkdir -p -- "$(dirname -- %s)" && cat > %s && chmod %o %s' % (dest, dest, mode, dest)
 
 
 def establish_names(el):
@@ -955,71 +2076,91 @@ def establish_names(el):
     # XXX: check for uniqueness
 
 
-def augment_experiment(experiment, extension, prefix=None):
-    # XXX: prefixing is not complete,
-    # all references to tasklists / targets within the
-    # extension experiment should also be prefixed.
+class IncludedFile:
+    """An included experiment file, parsed once however often it is included."""
+    __slots__ = ('filename', 'digest', 'xml', 'targets', 'tasklists')
 
-    res = experiment.xpath('/experiment/targets')
-    if not res:
-        raise ExperimentSyntaxError("Element 'targets' missing in experiment")
-    targets = res[0]
-    res = extension.xpath('/experiment/targets')
-    if not res:
-        raise ExperimentSyntaxError("Element 'targets' missing in experiment")
-    ext_targets = res[0]
-    if prefix is not None:
-        for t in ext_targets:
-            t.set('name', "{0}.{1}".format(prefix, t.get('name', '_unknown')))
-    targets.extend(list(ext_targets))
-
-    del targets, ext_targets
-
-    res = experiment.xpath('/experiment/tasklists')
-    if not res:
-        raise ExperimentSyntaxError("Element 'tasklists' missing in experiment")
-    tasklists = res[0]
-    res = extension.xpath('/experiment/tasklists')
-    if not res:
-        raise ExperimentSyntaxError("Element 'tasklists' missing in experiment")
-    ext_tasklists = res[0]
-    if prefix is not None:
-        for t in ext_tasklists:
-            t.set('name', "{0}.{1}".format(prefix, t.get('name', '_unknown')))
-    tasklists.extend(list(ext_tasklists))
-
-    if extension.find('/experiment/steps'):
-        logging.warn("Extension tasklist has 'steps'.  These steps will not be executed")
-
-
-
-def process_includes(experiment_xml, parent_filename, env=None, memo=None):
-    includes = experiment_xml.xpath('/experiment/include')
-    for el in includes:
-        filename = el.get('file')
-        if filename is None:
-            raise ExperimentSyntaxError("Attribute 'file' missing in include")
-        # XXX: Implement defaulting, shell style?
-        filename = os.path.expandvars(filename)
-        # Search relative paths relative to parent document
-        if not os.path.isabs(filename):
-            parent_dir = os.path.dirname(os.path.realpath(parent_filename))
-            filename = os.path.join(parent_dir, filename)
-        filename = os.path.realpath(filename)
-        if memo is not None and filename in memo:
-            raise ExperimentSyntaxError("recursive include detected")
+    def __init__(self, filename):
+        self.filename = filename
         xml_parser = lxml.etree.XMLParser(remove_blank_text=True)
         # XXX: we only try one filename, but we may want to specify include
         # locations, like compilers do.
-        extension_xml = lxml.etree.parse(filename, parser=xml_parser)
+        with open(filename, 'rb') as f:
+            data = f.read()
+        self.digest = hashlib.sha256(data).hexdigest()
+        self.xml = lxml.etree.parse(io.BytesIO(data), parser=xml_parser)
         # XXX: Maybe we want to keep the comments?
         # XXX: If that is then case, our processing logic needs to be more careful.
-        lxml.etree.strip_elements(extension_xml, [lxml.etree.Comment])
+        lxml.etree.strip_elements(self.xml, [lxml.etree.Comment])
         # XXX: some validation wouldn't hurt here
-        new_memo = {filename}
-        if memo is not None:
-            new_memo.update(memo)
-        establish_names(extension_xml)
-        process_includes(extension_xml, filename, memo=new_memo)
-        prefix = el.get('prefix')
-        augment_experiment(experiment_xml, extension_xml, prefix)
+        establish_names(self.xml)
+        root = self.xml.getroot()
+        self.targets = root.find('targets')
+        if self.targets is None:
+            raise ExperimentSyntaxError("Element 'targets' missing in experiment")
+        self.tasklists = root.find('tasklists')
+        if self.tasklists is None:
+            raise ExperimentSyntaxError("Element 'tasklists' missing in experiment")
+        steps = root.find('steps')
+        if steps is not None and len(steps):
+            logging.warn("Extension tasklist has 'steps'.  These steps will not be executed")
+
+
+def _prefixed(prefix, name):
+    if prefix is None:
+        return name
+    return "{0}.{1}".format(prefix, name)
+
+
+def _expand_includes(experiment_xml, parent_filename, prefix, targets, library, files, chain, included):
+    # XXX: prefixing is not complete,
+    # all references to tasklists / targets within the
+    # extension experiment should also be prefixed.
+    for el in experiment_xml.xpath('/experiment/include'):
+        name = el.get('file')
+        if name is None:
+            raise ExperimentSyntaxError("Attribute 'file' missing in include")
+        filename = helper.resolve_include(name, parent_filename)
+        if filename in chain:
+            raise ExperimentSyntaxError("recursive include detected")
+        ext = files.get(filename)
+        if ext is None:
+            ext = files[filename] = IncludedFile(filename)
+        if included is not None:
+            included.append((parent_filename, name, filename, ext.digest))
+        ext_prefix = prefix
+        if el.get('prefix') is not None:
+            ext_prefix = _prefixed(prefix, el.get('prefix'))
+        # Targets are copied, the same file can be included with different prefixes
+        for t in ext.targets:
+            t = copy.deepcopy(t)
+            if ext_prefix is not None:
+                t.set('name', _prefixed(ext_prefix, t.get('name', '_unknown')))
+            targets.append(t)
+        for t in ext.tasklists:
+            library[_prefixed(ext_prefix, t.get('name', '_unknown'))] = t
+        _expand_includes(ext.xml, filename, ext_prefix, targets, library, files,
+                         chain | {filename}, included)
+
+
+def process_includes(experiment_xml, parent_filename, included=None):
+    """
+    Expand the includes of an experiment.  The targets of included
+    files are added to the experiment.  Their tasklists are not, they are
+    returned as a dict from the (prefixed) name to the tasklist element,
+    for compile_experiment, which only compiles the ones that are used.
+    Every file is parsed only once, even if it is included several times.
+
+    If 'included' is a list, a tuple (parent filename, include, absolute
+    filename, sha256 of the contents) is appended to it for every include.
+    """
+    targets = []
+    library = {}
+    chain = frozenset([os.path.realpath(parent_filename)])
+    _expand_includes(experiment_xml, parent_filename, None, targets, library, {}, chain, included)
+    if targets:
+        res = experiment_xml.xpath('/experiment/targets')
+        if not res:
+            raise ExperimentSyntaxError("Element 'targets' missing in experiment")
+        res[0].extend(targets)
+    return library
@@ -6,17 +6,29 @@ import shlex
 from src.error import ExperimentSyntaxError
 
 def exportEnv(structure):
-    envVar = {}
+    return resolveEnv(exportEnvSpec(structure))
+
+def exportEnvSpec(structure):
+    """
+    The 'export-env' elements of 'structure' as (name, value) pairs, with
+    a value of None for variables that are taken from the environment of
+    the control host when resolveEnv is called.
+    """
+    spec = []
     for env_xml in structure.findall('export-env'):
         name = env_xml.get('var')
         if name is None:
             raise ExperimentSyntaxError("export-env misses 'var' attribute")
-        value = env_xml.get('value')
+        spec.append((name, env_xml.get('value')))
+    return tuple(spec)
+
+def resolveEnv(spec):
+    envVar = {}
+    for name, value in spec:
         if value is None:
-            v = os.environ.get(name)
-            if v is None:
+            value = os.environ.get(name)
+            if value is None:
                 raise ExperimentSyntaxError("variable '%s' not found in environment of GPLMT control host" % (name,))
-            value = v
         envVar[name] = value
 
     return envVar
@@ -42,3 +54,16 @@ def isInt(value):
     return True
   except ValueError:
     return False
+
+def resolve_include(filename, parent_filename):
+    """
+    Absolute path of the file that an include of 'filename' in the
+    experiment file 'parent_filename' refers to.
+    """
+    # XXX: Implement defaulting, shell style?
+    filename = os.path.expandvars(filename)
+    # Search relative paths relative to parent document
+    if not os.path.isabs(filename):
+        parent_dir = os.path.dirname(os.path.realpath(parent_filename))
+        filename = os.path.join(parent_dir, filename)
+    return os.path.realpath(filename)
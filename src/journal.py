@@ -0,0 +1,151 @@
+"""
+Journal of the progress of an experiment, for resuming it.
+
+The journal is an append-only file with one JSON record per line.  Every
+record is written with a single write(2) to a file opened with O_APPEND,
+so that it survives the control process being killed; it is synced to
+disk at most every 'sync_interval' seconds, and when the journal is
+closed.  A record that was cut off by a crash is ignored.
+
+Units of work are identified by the path of the step in the experiment:
+'3' is the third top-level step, '3/0' the first iteration of the loop in
+step 3, and '3/0.2' the second step in that iteration.  The records are
+
+  begin     the experiment (its file and a digest of its contents and
+            of the files it includes)
+  resume    the experiment was resumed
+  done      a tasklist on a node, or with no node a whole loop iteration,
+            has finished (with the outcome of the tasklist: 'ok',
+            'timeout' or the error policy that stopped it); iterations
+            of loops with sync="per-node" are done per node
+  teardown  a teardown was registered
+  end       the experiment and its teardowns have finished
+
+When an experiment is resumed, units that are done are skipped, and the
+teardowns that were registered are registered again.
+"""
+
+import json
+import logging
+import os
+import time
+
+from src.error import ExperimentSetupError
+
+__all__ = [
+    "Journal",
+]
+
+
+class Journal:
+    def __init__(self, filename, sync_interval=1.0):
+        self.filename = filename
+        self.sync_interval = sync_interval
+        self.fd = None
+        self.last_sync = 0.0
+        # (unit, node name or None) that are done
+        self.completed = set()
+        # records of the teardowns that were registered before resuming
+        self.teardowns = []
+        self.ended = False
+        # the last record was cut off by a crash
+        self.cut_off = False
+
+    def _load(self, digest):
+        try:
+            with open(self.filename, 'r', encoding='utf-8') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            raise ExperimentSetupError("No journal '%s' to resume from" % (self.filename,))
+        except OSError as e:
+            raise ExperimentSetupError("Could not read journal '%s' (%s)" % (self.filename, e.strerror))
+        self.cut_off = bool(lines) and not lines[-1].endswith('\n')
+        for lineno, line in enumerate(lines, 1):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Cut off by a crash while it was written
+                logging.warning("Ignoring broken record in line %d of journal '%s'", lineno, self.filename)
+                continue
+            event = record['event']
+            if event == 'begin':
+                if record['digest'] != digest:
+                    raise ExperimentSetupError("Journal '%s' is of a different experiment" % (self.filename,))
+            elif event == 'done':
+                self.completed.add((record['unit'], record.get('node')))
+            elif event == 'teardown':
+                self.teardowns.append(record)
+            elif event == 'end':
+                self.ended = True
+
+    def open(self, experiment, digest, resume=False):
+        """
+        Start journaling the experiment in the file 'experiment' whose
+        contents have the digest 'digest'.  With 'resume', the existing
+        journal is read first, otherwise it is overwritten.
+        """
+        if resume:
+            self._load(digest)
+            if self.ended:
+                raise ExperimentSetupError("Experiment has finished already according to journal '%s'"
+                                           % (self.filename,))
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+        if not resume:
+            flags |= os.O_TRUNC
+        try:
+            self.fd = os.open(self.filename, flags, 0o644)
+        except OSError as e:
+            raise ExperimentSetupError("Could not open journal '%s' (%s)" % (self.filename, e.strerror))
+        if resume:
+            if self.cut_off:
+                # Don't continue the line that was cut off
+                os.write(self.fd, b'\n')
+            self._append({'event': 'resume'})
+        else:
+            self._append({'event': 'begin', 'experiment': os.path.abspath(experiment), 'digest': digest})
+        self.sync()
+
+    def _append(self, record):
+        record['time'] = time.time()
+        line = json.dumps(record, sort_keys=True) + '\n'
+        try:
+            os.write(self.fd, line.encode('utf-8'))
+        except OSError as e:
+            logging.warning("Could not write to journal (%s)", e)
+            return
+        if time.monotonic() - self.last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        try:
+            os.fsync(self.fd)
+        except OSError as e:
+            logging.warning("Could not sync journal (%s)", e)
+        self.last_sync = time.monotonic()
+
+    def is_done(self, unit, node=None):
+        return (unit, node) in self.completed
+
+    def done(self, unit, node=None, outcome=None):
+        """Record that 'unit' is done on 'node', or as a whole."""
+        self.completed.add((unit, node))
+        record = {'event': 'done', 'unit': unit}
+        if node is not None:
+            record['node'] = node
+            record['outcome'] = outcome
+        self._append(record)
+
+    def teardown(self, record):
+        """Record a registered teardown, described by the dict 'record'."""
+        self._append(dict(record, event='teardown'))
+
+    def end(self):
+        self.ended = True
+        self._append({'event': 'end'})
+
+    def close(self):
+        if self.fd is None:
+            return
+        self.sync()
+        os.close(self.fd)
+        self.fd = None
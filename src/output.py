@@ -0,0 +1,240 @@
+"""
+Output of commands on the terminal of the control host.
+
+Commands don't write to the terminal directly.  Their output is read
+from pipes and passed through an OutputMux, which either prefixes every
+line with the node and the task ('prefix'), or collects the output of
+whole commands and shows nodes with identical output only once
+('collapse', like dshbak -c).  Writing to the terminal happens in a
+thread, and readers of pipes wait when too much output is queued.
+"""
+
+import asyncio
+import collections
+import re
+import sys
+
+__all__ = [
+    "OutputMux",
+    "fold_names",
+    "pump_output",
+]
+
+CHUNK = 1 << 16
+
+
+def fold_names(names):
+    """
+    Describe a list of node names compactly, by folding names that
+    only differ in a number at the end into ranges, like 'pl[1-3,7]'.
+    """
+    numbered = collections.OrderedDict()
+    for name in names:
+        m = re.match(r'^(.*?)(\d+)$', name)
+        if m is None or (len(m.group(2)) > 1 and m.group(2).startswith('0')):
+            numbered.setdefault(name, None)
+            continue
+        numbered.setdefault(m.group(1), set())
+        numbered[m.group(1)].add(int(m.group(2)))
+    parts = []
+    for prefix, numbers in numbered.items():
+        if numbers is None:
+            parts.append(prefix)
+            continue
+        if len(numbers) == 1:
+            parts.append('%s%d' % (prefix, next(iter(numbers))))
+            continue
+        ranges = []
+        for n in sorted(numbers):
+            if ranges and ranges[-1][1] == n - 1:
+                ranges[-1][1] = n
+            else:
+                ranges.append([n, n])
+        parts.append('%s[%s]' % (prefix, ','.join(
+                str(a) if a == b else '%d-%d' % (a, b) for a, b in ranges)))
+    return ','.join(parts)
+
+
+class OutputRecord:
+    """The output of one run of a task."""
+    def __init__(self, mux, node, task):
+        self.mux = mux
+        self.node = node
+        self.task = task
+        self.buffers = {'out': bytearray(), 'err': bytearray()}
+        # too much output to collapse it, show it directly
+        self.direct = False
+        # exit status, if the command finished
+        self.status = None
+
+    def write(self, stream, data):
+        self.mux._write(self, stream, data)
+
+    async def drain(self):
+        await self.mux.drain()
+
+    def close(self):
+        self.mux._close(self)
+
+
+class OutputMux:
+    def __init__(self, collapse=False, interval=1.0, high_water=1 << 20, max_output=CHUNK):
+        self.collapse = collapse
+        # seconds between showing collapsed output
+        self.interval = interval
+        self.high_water = high_water
+        self.max_output = max_output
+        # (stream, data) waiting to be written to the terminal
+        self.queue = collections.deque()
+        self.queued = 0
+        self.writer = None
+        self.writable = asyncio.Event()
+        self.writable.set()
+        # (task, stream, output) -> node names
+        self.groups = collections.OrderedDict()
+        self.flush_handle = None
+        # task -> status -> node names
+        self.statuses = collections.OrderedDict()
+
+    def _emit(self, stream, data):
+        self.queue.append((stream, data))
+        self.queued += len(data)
+        if self.queued > self.high_water:
+            self.writable.clear()
+        if self.writer is None:
+            self.writer = asyncio.ensure_future(self._write_queue())
+
+    async def _write_queue(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self.queue:
+                items = list(self.queue)
+                self.queue.clear()
+                await loop.run_in_executor(None, _write_terminal, items)
+                self.queued -= sum(len(data) for stream, data in items)
+                if self.queued <= self.high_water:
+                    self.writable.set()
+        finally:
+            self.writer = None
+
+    async def drain(self):
+        """Wait until the terminal has caught up with the output."""
+        if not self.writable.is_set():
+            await self.writable.wait()
+
+    def begin(self, node, task):
+        return OutputRecord(self, node, task)
+
+    def _prefix(self, record):
+        return ('%s %s: ' % (record.node, record.task)).encode('utf-8', 'replace')
+
+    def _emit_lines(self, record, stream, final):
+        buf = record.buffers[stream]
+        end = len(buf) if final else buf.rfind(b'\n') + 1
+        if end == 0 and len(buf) >= self.max_output:
+            # a very long line
+            end = len(buf)
+        if end == 0:
+            return
+        prefix = self._prefix(record)
+        lines = bytes(buf[:end]).split(b'\n')
+        if lines[-1] == b'':
+            lines.pop()
+        del buf[:end]
+        self._emit(stream, b''.join(prefix + line + b'\n' for line in lines))
+
+    def _emit_group(self, names, task, stream, data):
+        header = '%s (%s%s)' % (fold_names(names), task, ', stderr' if stream == 'err' else '')
+        rule = '-' * min(max(len(header), 15), 79)
+        text = '%s\n%s\n%s\n' % (rule, header, rule)
+        if not data.endswith(b'\n'):
+            data += b'\n'
+        self._emit(stream, text.encode('utf-8', 'replace') + data)
+
+    def _write(self, record, stream, data):
+        buf = record.buffers[stream]
+        buf += data
+        if not self.collapse:
+            self._emit_lines(record, stream, False)
+        elif record.direct or len(buf) > self.max_output:
+            # Too big to compare with the output of other nodes
+            record.direct = True
+            self._emit_group([record.node], record.task, stream, bytes(buf))
+            del buf[:]
+
+    def _close(self, record):
+        for stream, buf in record.buffers.items():
+            if not buf:
+                continue
+            if not self.collapse:
+                self._emit_lines(record, stream, True)
+            elif record.direct:
+                self._emit_group([record.node], record.task, stream, bytes(buf))
+            else:
+                key = (record.task, stream, bytes(buf))
+                self.groups.setdefault(key, []).append(record.node)
+                if self.flush_handle is None:
+                    loop = asyncio.get_running_loop()
+                    self.flush_handle = loop.call_later(self.interval, self.flush)
+            del buf[:]
+        status = 'killed' if record.status is None else record.status
+        by_status = self.statuses.setdefault(record.task, collections.OrderedDict())
+        by_status.setdefault(status, []).append(record.node)
+
+    def flush(self):
+        """Show the collapsed output collected so far."""
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        groups = self.groups
+        self.groups = collections.OrderedDict()
+        for (task, stream, data), names in groups.items():
+            self._emit_group(names, task, stream, data)
+
+    def summary(self):
+        """Number of runs of every task, and the nodes of runs with an unusual status."""
+        lines = []
+        for task, by_status in self.statuses.items():
+            runs = sum(len(names) for names in by_status.values())
+            ordered = sorted(by_status.items(), key=lambda item: -len(item[1]))
+            parts = []
+            for i, (status, names) in enumerate(ordered):
+                if i == 0:
+                    parts.append('status %s: %d' % (status, len(names)))
+                else:
+                    parts.append('status %s: %s' % (status, fold_names(names)))
+            lines.append('%s: %d runs, %s' % (task, runs, ', '.join(parts)))
+        return lines
+
+    async def close(self, stats=()):
+        """Show the remaining output and the summary, followed by the lines 'stats'."""
+        self.flush()
+        if self.statuses or stats:
+            text = '\n'.join(['== summary'] + self.summary() + list(stats)) + '\n'
+            self._emit('out', text.encode('utf-8', 'replace'))
+        while self.writer is not None:
+            await self.writer
+
+
+def _write_terminal(items):
+    for stream, data in items:
+        f = sys.stdout if stream == 'out' else sys.stderr
+        f.buffer.write(data)
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+
+async def _pump(reader, record, stream):
+    while True:
+        data = await reader.read(CHUNK)
+        if not data:
+            break
+        record.write(stream, data)
+        await record.drain()
+
+
+async def pump_output(proc, record):
+    """Copy stdout and stderr of 'proc' into 'record' until both are closed."""
+    await asyncio.gather(
+            _pump(proc.stdout, record, 'out'),
+            _pump(proc.stderr, record, 'err'))
@@ -0,0 +1,500 @@
+import isodate
+import logging
+import time
+from dateutil.parser import parse
+
+import src.helper as helper
+from src.error import ExperimentSyntaxError
+
+__all__ = [
+    "Plan",
+    "Tasklist",
+    "compile_experiment",
+    "make_tasklist",
+]
+
+# The execution plan is a compact representation of the tasklists and
+# steps of an experiment.  It is compiled once from the experiment
+# document, so that the interpreter doesn't have to look at XML elements,
+# their attributes and their tags for every node and loop iteration.
+#
+# Tasks and steps have a 'kind', which the interpreter uses to
+# look up the method that runs them.
+
+
+class RunTask:
+    kind = 'run'
+    __slots__ = ('name', 'command', 'expected_status')
+
+    def __init__(self, name, command, expected_status=None):
+        self.name = name
+        self.command = command
+        self.expected_status = expected_status
+
+
+class PutTask:
+    kind = 'put'
+    __slots__ = ('source', 'destination', 'keep', 'broadcast')
+
+    def __init__(self, source, destination, keep=False, broadcast=False):
+        self.source = source
+        self.destination = destination
+        self.keep = keep
+        self.broadcast = broadcast
+
+
+class GetTask:
+    kind = 'get'
+    __slots__ = ('source', 'destination')
+
+    def __init__(self, source, destination):
+        self.source = source
+        self.destination = destination
+
+
+class TransferTask:
+    """Batch of puts and gets, from a 'sync' or adjacent transfers in a 'seq'."""
+    kind = 'transfer'
+    __slots__ = ('puts', 'gets', 'compress')
+
+    def __init__(self, puts, gets, compress=False):
+        self.puts = puts
+        self.gets = gets
+        self.compress = compress
+
+
+class SeqTask:
+    kind = 'seq'
+    __slots__ = ('children',)
+
+    def __init__(self, children):
+        self.children = children
+
+
+class ParTask:
+    kind = 'par'
+    __slots__ = ('children',)
+
+    def __init__(self, children):
+        self.children = children
+
+
+class FailTask:
+    kind = 'fail'
+    __slots__ = ()
+
+
+class CallTask:
+    kind = 'call'
+    __slots__ = ('name', 'tasklist')
+
+    def __init__(self, name, tasklist):
+        self.name = name
+        # None if the tasklist is not defined
+        self.tasklist = tasklist
+
+
+class Tasklist:
+    __slots__ = ('name', 'on_error', 'cleanup_name', 'cleanup', 'timeout',
+                 'agent', 'body', 'agent_plan', 'agent_runs')
+
+    def __init__(self, name):
+        self.name = name
+        self.on_error = 'stop-tasklist'
+        self.cleanup_name = None
+        # None if there is no cleanup or it is not defined
+        self.cleanup = None
+        # seconds, or None
+        self.timeout = None
+        # True/False if the tasklist says whether to use the agent
+        self.agent = None
+        self.body = ()
+        # The tasklist serialized for the remote agent (None if the
+        # agent can't run it), and the run tasks in the order of their id.
+        self.agent_plan = None
+        self.agent_runs = ()
+
+
+class Delay:
+    """A start or stop time of a step."""
+    __slots__ = ('relative', 'absolute')
+
+    def __init__(self, relative=None, absolute=None):
+        self.relative = relative
+        self.absolute = absolute
+
+    def seconds(self, now=None):
+        """Number of seconds from 'now', by default the current time."""
+        if self.relative is not None:
+            return self.relative
+        if now is None:
+            now = time.time()
+        return self.absolute - now
+
+
+class TasklistStep:
+    kind = 'step'
+    __slots__ = ('targets', 'tasklist_name', 'tasklist', 'background', 'start', 'stop', 'env')
+
+    # 'env' is from helper.exportEnvSpec, so that variables from the
+    # environment are read when the step runs and not cached with the plan
+    def __init__(self, targets, tasklist_name, tasklist, background, start, stop, env):
+        self.targets = targets
+        self.tasklist_name = tasklist_name
+        self.tasklist = tasklist
+        self.background = background
+        self.start = start
+        self.stop = stop
+        self.env = env
+
+
+class SynchronizeStep:
+    kind = 'synchronize'
+    __slots__ = ('targets',)
+
+    def __init__(self, targets):
+        self.targets = targets
+
+
+class TeardownStep:
+    kind = 'register-teardown'
+    __slots__ = ('targets', 'tasklist_name', 'tasklist', 'env')
+
+    def __init__(self, targets, tasklist_name, tasklist, env):
+        self.targets = targets
+        self.tasklist_name = tasklist_name
+        self.tasklist = tasklist
+        self.env = env
+
+
+class LoopStep:
+    kind = 'loop'
+    __slots__ = ('repeat', 'duration', 'until', 'listing', 'param', 'body', 'sync', 'max_skew')
+
+    def __init__(self, body):
+        self.body = body
+        # exactly one of repeat, duration, listing (with param) and until is set
+        self.repeat = None
+        self.duration = None
+        self.until = None
+        self.listing = None
+        self.param = None
+        # 'iteration': all nodes finish an iteration before the next one
+        # starts, 'per-node': every node goes through the iterations on
+        # its own, at most 'max_skew' iterations ahead of the slowest
+        self.sync = 'iteration'
+        self.max_skew = None
+
+
+class Plan:
+    __slots__ = ('tasklists', 'steps')
+
+    def __init__(self, tasklists, steps):
+        self.tasklists = tasklists
+        self.steps = steps
+
+
+def parse_time(s):
+    st = parse(s)
+    return time.mktime(st.timetuple())
+
+
+def get_delay(node, prefix):
+    t_relative = node.get(prefix + '_relative')
+    if t_relative is not None:
+        return Delay(relative=isodate.parse_duration(t_relative).total_seconds())
+    t_absolute = node.get(prefix + '_absolute')
+    if t_absolute is not None:
+        return Delay(absolute=parse_time(t_absolute))
+    return None
+
+
+def find_text(node, query):
+    res = node.find(query)
+    if res is None:
+        return None
+    return res.text
+
+
+def is_enabled(task_xml):
+    if task_xml.get('enabled', 'true').lower() == 'false':
+        logging.info("Task %s disabled", task_xml.get('name', '(unnamed-task)'))
+        return False
+    return True
+
+
+def _compile_transfer(task_xml):
+    source = find_text(task_xml, 'source')
+    destination = find_text(task_xml, 'destination')
+    if task_xml.tag == 'get':
+        return GetTask(source, destination)
+    if task_xml.tag != 'put':
+        raise ExperimentSyntaxError("Only 'put' and 'get' are allowed in 'sync', not '%s'" % (task_xml.tag,))
+    kp_str = task_xml.get("keep")
+    keep = kp_str is not None and kp_str.lower() != 'false'
+    broadcast = task_xml.get('broadcast', 'false').lower() == 'true'
+    return PutTask(source, destination, keep, broadcast)
+
+
+def _transfer_batch(tasks, compress=False):
+    puts = tuple(t for t in tasks if t.kind == 'put')
+    gets = tuple(t for t in tasks if t.kind == 'get')
+    return TransferTask(puts, gets, compress)
+
+
+def _compile_seq(seq_xml, tasklists):
+    """Compile the children of a sequence, grouping runs of adjacent 'put' or 'get' tasks."""
+    children = []
+    batch = []
+
+    def flush():
+        if len(batch) > 1:
+            children.append(_transfer_batch(batch))
+        else:
+            children.extend(batch)
+        del batch[:]
+
+    for child_xml in seq_xml:
+        if not is_enabled(child_xml):
+            continue
+        child = _compile_task(child_xml, tasklists)
+        if child is None:
+            continue
+        if batch and child.kind != batch[0].kind:
+            flush()
+        if child.kind in ('put', 'get') and not getattr(child, 'broadcast', False):
+            batch.append(child)
+        else:
+            flush()
+            children.append(child)
+    flush()
+    return SeqTask(tuple(children))
+
+
+def _compile_task(task_xml, tasklists):
+    """Compile an (enabled) task, returns None for tasks that do nothing."""
+    tag = task_xml.tag
+    if tag == 'run':
+        expected_status = None
+        expected_status_el = task_xml.get('expected-status')
+        if expected_status_el is not None:
+            try:
+                expected_status = int(expected_status_el)
+            except ValueError:
+                logging.error(
+                        "Invalid number '%s'",
+                        expected_status_el)
+        return RunTask(task_xml.get('name'), task_xml.text, expected_status)
+    if tag in ('put', 'get'):
+        return _compile_transfer(task_xml)
+    if tag == 'sync':
+        compress = task_xml.get('compress', 'false').lower() == 'true'
+        tasks = [_compile_transfer(t) for t in task_xml if is_enabled(t)]
+        return _transfer_batch(tasks, compress)
+    if tag in ('sequence', 'seq'):
+        return _compile_seq(task_xml, tasklists)
+    if tag in ('par', 'parallel'):
+        children = [_compile_task(t, tasklists) for t in task_xml if is_enabled(t)]
+        return ParTask(tuple(c for c in children if c is not None))
+    if tag == 'fail':
+        return FailTask()
+    if tag == 'call':
+        tl = task_xml.get('tasklist')
+        if tl is None:
+            raise ExperimentSyntaxError("no tasklist name in 'call'")
+        return CallTask(tl, tasklists.get(tl))
+    return None
+
+
+def agent_plan(task, runs):
+    """
+    Serialize a task for the remote agent, or return None if it
+    contains tasks that the agent can't run.  All 'run' tasks are
+    appended to 'runs', their index is the task id.
+    """
+    if task.kind in ('seq', 'par'):
+        children = []
+        for child_task in task.children:
+            child = agent_plan(child_task, runs)
+            if child is None:
+                return None
+            children.append(child)
+        return {'type': task.kind, 'children': children}
+    if task.kind == 'run':
+        runs.append(task)
+        return {
+            'type': 'run',
+            'id': len(runs) - 1,
+            'command': task.command,
+            'expected_status': task.expected_status,
+        }
+    if task.kind == 'fail':
+        return {'type': 'fail'}
+    return None
+
+
+def _finish_tasklist(tasklist, body):
+    tasklist.body = tuple(body)
+    runs = []
+    tasklist.agent_plan = agent_plan(SeqTask(tasklist.body), runs)
+    tasklist.agent_runs = tuple(runs)
+
+
+def make_tasklist(name, tasks):
+    """Create a tasklist that runs 'tasks' in sequence."""
+    tasklist = Tasklist(name)
+    _finish_tasklist(tasklist, [SeqTask(tuple(tasks))])
+    return tasklist
+
+
+def _compile_tasklist(tasklist, tasklist_xml, tasklists):
+    error_policy = tasklist_xml.get('on-error')
+    if error_policy is not None:
+        tasklist.on_error = error_policy
+    cleanup_name = tasklist_xml.get('cleanup')
+    if cleanup_name is not None:
+        tasklist.cleanup_name = cleanup_name
+        tasklist.cleanup = tasklists.get(cleanup_name)
+    timeout_str = tasklist_xml.get('timeout')
+    if timeout_str is not None:
+        tasklist.timeout = isodate.parse_duration(timeout_str).total_seconds()
+    agent = tasklist_xml.get('agent')
+    if agent is not None:
+        tasklist.agent = agent.lower() == 'true'
+    body = []
+    for task_xml in tasklist_xml:
+        if not is_enabled(task_xml):
+            continue
+        task = _compile_task(task_xml, tasklists)
+        if task is not None:
+            body.append(task)
+    _finish_tasklist(tasklist, body)
+
+
+def _compile_loop(step_xml, tasklists):
+    loop = LoopStep(compile_steps(step_xml, tasklists))
+    sync = step_xml.get("sync")
+    if sync is not None:
+        loop.sync = sync
+    max_skew = step_xml.get("max-skew")
+    if max_skew is not None:
+        if loop.sync != 'per-node':
+            raise ExperimentSyntaxError("loop attribute 'max-skew' needs sync=\"per-node\"")
+        loop.max_skew = int(max_skew)
+    num_repeat_str = step_xml.get("repeat")
+    if num_repeat_str is not None:
+        try:
+            loop.repeat = int(num_repeat_str)
+        except ValueError:
+            logging.error("counted loop has malformed attribute iterations (%s), skipping", num_repeat_str)
+            return None
+        return loop
+    duration = step_xml.get("duration")
+    if duration is not None:
+        loop.duration = isodate.parse_duration(duration).total_seconds()
+        return loop
+    listing = step_xml.get("list")
+    listParam = step_xml.get("param")
+    if listing is not None and listParam is not None:
+        if ":" in listing:
+            rangeGiven = listing.split(":")
+            if len(rangeGiven) == 2 and helper.isInt(rangeGiven[0]) and helper.isInt(rangeGiven[1]):
+                loop.listing = tuple(str(x) for x in range(int(rangeGiven[0]), int(rangeGiven[1])+1))
+            else:
+                raise ExperimentSyntaxError("Invalid Range declaration '%s'" % (listing,))
+        else:
+            loop.listing = tuple(listing.split(" "))
+        loop.param = listParam
+        return loop
+    if listing is None and listParam is not None:
+        raise ExperimentSyntaxError("missing list definition")
+    if listParam is None and listing is not None:
+        raise ExperimentSyntaxError("missing parameter definition")
+    until = step_xml.get("until")
+    if until is not None:
+        loop.until = parse_time(until)
+        return loop
+    raise ExperimentSyntaxError("loop needs one of 'repeat', 'duration', 'list' or 'until'")
+
+
+def _compile_step(step_xml, tasklists):
+    tag = step_xml.tag
+    if tag == 'synchronize':
+        return SynchronizeStep(step_xml.get('targets'))
+    if tag == 'loop':
+        return _compile_loop(step_xml, tasklists)
+    if tag in ('step', 'register-teardown'):
+        what = 'step' if tag == 'step' else tag
+        targets_def = step_xml.get("targets")
+        if targets_def is None:
+            logging.warn("%s has no targets, skipping", what)
+            return None
+        tasklist_name = step_xml.get("tasklist")
+        if tasklist_name is None:
+            logging.warn("%s has no tasklist, skipping", what)
+            return None
+        tasklist = tasklists.get(tasklist_name)
+        env = helper.exportEnvSpec(step_xml)
+        if tag == 'register-teardown':
+            return TeardownStep(targets_def, tasklist_name, tasklist, env)
+        bg_str = step_xml.get('background')
+        background = bg_str is not None and bg_str.lower() == 'true'
+        return TasklistStep(
+                targets_def, tasklist_name, tasklist, background,
+                get_delay(step_xml, 'start'), get_delay(step_xml, 'stop'), env)
+    raise ExperimentSyntaxError("Invalid step '%s'" % (tag,))
+
+
+def compile_steps(steps_xml, tasklists):
+    steps = []
+    for step_xml in steps_xml:
+        step = _compile_step(step_xml, tasklists)
+        if step is not None:
+            steps.append(step)
+    return tuple(steps)
+
+
+class _Tasklists(dict):
+    """
+    Compiled tasklists by name.  Tasklists are compiled from their
+    definitions when they are first looked up, so that tasklists of
+    included libraries that are never used are never compiled.
+    """
+    def __init__(self, definitions):
+        super().__init__()
+        self.definitions = definitions
+
+    def get(self, name, default=None):
+        if name not in self:
+            tasklist_xml = self.definitions.get(name)
+            if tasklist_xml is None:
+                return default
+            # Registered before compiling, for recursive references
+            tasklist = self[name] = Tasklist(name)
+            _compile_tasklist(tasklist, tasklist_xml, self)
+        return self[name]
+
+
+def compile_experiment(experiment_xml, library=None):
+    """
+    Compile the tasklists and steps of an experiment document into a plan.
+    'library' maps the names of included tasklists to their elements,
+    see process_includes.  They override tasklists of the experiment with
+    the same name and are only compiled if they are referenced.
+    """
+    definitions = {}
+    for x in experiment_xml.xpath("/experiment/tasklists/tasklist[@name]"):
+        definitions[x.get('name')] = x
+    own = list(definitions)
+    if library is not None:
+        definitions.update(library)
+    tasklists = _Tasklists(definitions)
+    # The experiment's own tasklists are always compiled,
+    # so that errors in them are found even if they are unused.
+    for name in own:
+        tasklists.get(name)
+    steps_xml = experiment_xml.find("steps")
+    if steps_xml is None:
+        raise ExperimentSyntaxError("Element 'steps' missing.  Did you try to execute an extension library?")
+    steps = compile_steps(steps_xml, tasklists)
+    return Plan(dict(tasklists), steps)
@@ -0,0 +1,162 @@
+"""
+Discovery of the nodes of PlanetLab slices.
+
+The nodes of a slice are fetched from the PLC API of the slice
+(GetSlices, then GetNodes) in a thread of an executor, so that
+the slices of an experiment are fetched concurrently and the event loop
+isn't blocked.  Besides the host name, the boot state, run level and
+last contact time of every node are fetched, so that nodes that are
+not up can be left out before any ssh connection is spent on them.
+
+The node list of a slice is stored in a cache directory, one JSON file
+per API URL and slice.  A cached node list that is younger than the TTL
+is used without asking the API.  In offline mode, cached node lists
+are used however old they are, and the API is never asked.
+"""
+
+import asyncio
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+import xmlrpc.client
+
+from src.error import ExperimentSetupError
+
+__all__ = [
+    "NODE_FIELDS",
+    "SliceCache",
+    "fetch_slice",
+    "is_alive",
+    "discover",
+]
+
+NODE_FIELDS = ['hostname', 'boot_state', 'run_level', 'last_contact']
+
+# Maximum number of slices that are fetched at the same time
+MAX_FETCHES = 16
+
+
+def fetch_slice(api_url, auth, slicename):
+    """
+    Return the nodes of a slice as dicts with NODE_FIELDS, in the order
+    the API returns them.  Blocks, run it in an executor.
+    """
+    # ServerProxy isn't thread-safe, every call gets its own
+    server = xmlrpc.client.ServerProxy(api_url)
+    try:
+        node_ids = server.GetSlices(auth, [slicename], ['node_ids'])[0]['node_ids']
+        return server.GetNodes(auth, node_ids, NODE_FIELDS)
+    except Exception as e:
+        logging.error("PlanetLab API call for slice '%s' failed (%s)", slicename, e)
+        raise ExperimentSetupError("PlanetLab API call failed")
+
+
+def is_alive(node, max_contact_age=None, now=None):
+    """
+    Is the node booted into production and, if 'max_contact_age' is
+    given, has it contacted PLC within that many seconds?
+    """
+    if node.get('boot_state') != 'boot':
+        return False
+    # run_level is only reported by newer PLC versions
+    if node.get('run_level') not in (None, 'boot'):
+        return False
+    if max_contact_age:
+        last_contact = node.get('last_contact')
+        if last_contact is None:
+            return False
+        if now is None:
+            now = time.time()
+        if now - last_contact > max_contact_age:
+            return False
+    return True
+
+
+class SliceCache:
+    def __init__(self, directory, ttl):
+        self.directory = directory
+        self.ttl = ttl
+
+    def _path(self, api_url, slicename):
+        key = hashlib.sha256(("%s\n%s" % (api_url, slicename)).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key + '.json')
+
+    def load(self, api_url, slicename, max_age=None):
+        """
+        Return the cached nodes of the slice, or None if there are none
+        or they are older than 'max_age' seconds.
+        """
+        try:
+            with open(self._path(api_url, slicename), 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logging.warning("Ignoring broken cached node list of slice '%s' (%s)", slicename, e)
+            return None
+        if max_age is not None and time.time() - cached['time'] > max_age:
+            return None
+        return cached['nodes']
+
+    def store(self, api_url, slicename, nodes):
+        cached = {
+            'api_url': api_url,
+            'slicename': slicename,
+            'time': time.time(),
+            'nodes': nodes,
+        }
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump(cached, f)
+                os.replace(tmp, self._path(api_url, slicename))
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        except OSError as e:
+            logging.warning("Could not cache node list of slice '%s' (%s)", slicename, e)
+
+
+async def discover(slices, cache=None, offline=False, get_auth=None):
+    """
+    Fetch the nodes of all 'slices', a list of (api_url, slicename)
+    pairs, concurrently.  Return a list with the nodes of each slice.
+
+    'get_auth' is called with the index of every slice that has to be
+    fetched from the API and returns its auth struct.  This happens
+    before anything is fetched, since it might prompt for a password.
+    """
+    results = [None] * len(slices)
+    missing = []
+    for i, (api_url, slicename) in enumerate(slices):
+        if cache is not None:
+            results[i] = cache.load(api_url, slicename, None if offline else cache.ttl)
+        if results[i] is not None:
+            logging.info("Using cached node list of slice '%s'", slicename)
+            continue
+        if offline:
+            raise ExperimentSetupError("No cached node list of PlanetLab slice '%s' for offline mode" % (slicename,))
+        missing.append((i, api_url, slicename, get_auth(i)))
+    if not missing:
+        return results
+
+    loop = asyncio.get_running_loop()
+    logging.info("Making RPC calls to planetlab for %d slices", len(missing))
+    # The calls mostly wait for the API, the default executor
+    # has too few threads on small control hosts
+    with concurrent.futures.ThreadPoolExecutor(min(len(missing), MAX_FETCHES)) as executor:
+        fetched = await asyncio.gather(*[
+            loop.run_in_executor(executor, fetch_slice, api_url, auth, slicename)
+            for i, api_url, slicename, auth in missing])
+    logging.info("Got responses from planetlab")
+    for (i, api_url, slicename, auth), nodes in zip(missing, fetched):
+        results[i] = nodes
+        if cache is not None:
+            cache.store(api_url, slicename, nodes)
+    return results
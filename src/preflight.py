@@ -0,0 +1,158 @@
+"""
+Pre-flight check of SSH nodes.
+
+Before the first step, every SSH node gets a TCP connect probe to its
+ssh port, followed by the setup of its master connection.  All nodes
+are checked concurrently.  The setup of the master connection has a
+deadline, which starts when the connection slots and rate limits of
+gplmt itself let the node connect, so that a node isn't blamed for
+waiting behind the others, and it stands still while the node waits
+between attempts.  Nodes that fail, or that aren't done when
+their deadline passes, are put into quarantine: they are left out of all targets for the rest of the
+experiment, so that they don't tie up ssh connection slots with
+connection attempts that time out.
+
+Whether the experiment runs on the healthy nodes is decided by the
+policy:
+
+  fail   stop if any node is in quarantine
+  skip   run on the healthy nodes, however few there are
+  N%     run on the healthy nodes if they are at least N% of all nodes
+"""
+
+import asyncio
+import contextlib
+import logging
+
+from src.error import ExperimentSetupError
+
+__all__ = [
+    "policy",
+    "tcp_probe",
+    "Deadline",
+    "check_nodes",
+    "apply_policy",
+]
+
+# Maximum number of TCP probes in flight
+MAX_PROBES = 256
+
+
+def policy(s):
+    """
+    Parse a policy: 'fail', 'skip' or a percentage like '80%', which
+    is returned as a fraction.  Raises ValueError for anything else.
+    """
+    if s in ('fail', 'skip'):
+        return s
+    if not s.endswith('%'):
+        raise ValueError("invalid policy '%s'" % (s,))
+    percent = float(s[:-1])
+    if not 0 <= percent <= 100:
+        raise ValueError("invalid percentage '%s'" % (s,))
+    return percent / 100
+
+
+async def tcp_probe(host, port, timeout):
+    """
+    Try to open a TCP connection to host:port.  Return None on success,
+    or the reason why it failed.
+    """
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except asyncio.TimeoutError:
+        return "TCP connect to port %s timed out" % (port,)
+    except OSError as e:
+        return "TCP connect to port %s failed (%s)" % (port, e.strerror or e)
+    writer.close()
+    return None
+
+
+class Deadline:
+    """
+    Runs a coroutine with a time limit that doesn't run down while
+    the coroutine is inside 'paused()'.  Raises asyncio.TimeoutError
+    when the time is up.
+    """
+    def __init__(self, seconds):
+        self.remaining = seconds
+        self.task = None
+        self.handle = None
+        self.started = None
+        self.expired = False
+
+    def _start(self):
+        loop = asyncio.get_running_loop()
+        self.started = loop.time()
+        self.handle = loop.call_later(max(self.remaining, 0), self._expire)
+
+    def _stop(self):
+        self.handle.cancel()
+        self.remaining -= asyncio.get_running_loop().time() - self.started
+
+    def _expire(self):
+        self.expired = True
+        self.task.cancel()
+
+    async def __call__(self, coro):
+        self.task = asyncio.ensure_future(coro)
+        self._start()
+        try:
+            return await self.task
+        except asyncio.CancelledError:
+            if self.expired:
+                raise asyncio.TimeoutError() from None
+            raise
+        finally:
+            self.handle.cancel()
+
+    @contextlib.contextmanager
+    def paused(self):
+        if self.task is None or self.task.done() or self.expired:
+            yield
+            return
+        self._stop()
+        try:
+            yield
+        finally:
+            self._start()
+
+
+async def check_nodes(nodes, check, deadline):
+    """
+    Run 'check' for all 'nodes' concurrently.  It is called with the
+    node and a Deadline 'bounded' that it passes the part of the check
+    that has to finish within 'deadline' seconds, and returns None for a
+    healthy node, or the reason why the node is not.  Return a dict from
+    the names of the nodes that aren't healthy to the reason.
+    """
+    tasks = {asyncio.ensure_future(check(n, Deadline(deadline))): n for n in nodes}
+    await asyncio.wait(tasks)
+    failed = {}
+    for t, n in tasks.items():
+        if isinstance(t.exception(), asyncio.TimeoutError):
+            failed[n.name] = "not ready after %ss" % (deadline,)
+        elif t.exception() is not None:
+            failed[n.name] = "check failed (%s)" % (t.exception(),)
+        elif t.result() is not None:
+            failed[n.name] = t.result()
+    return failed
+
+
+def apply_policy(pol, total, failed):
+    """
+    Log the nodes in 'failed' (see check_nodes) and raise an
+    ExperimentSetupError if the policy doesn't allow to go on without them.
+    """
+    if not failed:
+        return
+    for name in sorted(failed):
+        logging.warning("Quarantined node '%s': %s", name, failed[name])
+    healthy = total - len(failed)
+    logging.warning("%d of %d ssh nodes are healthy", healthy, total)
+    if pol == 'fail':
+        raise ExperimentSetupError("%d ssh nodes failed the pre-flight check" % (len(failed),))
+    if pol != 'skip' and healthy < pol * total:
+        raise ExperimentSetupError(
+                "Only %d of %d ssh nodes passed the pre-flight check, %g%% are required"
+                % (healthy, total, pol * 100))
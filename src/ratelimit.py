@@ -0,0 +1,287 @@
+import asyncio
+import collections
+import ipaddress
+import logging
+import os
+import resource
+
+__all__ = [
+    "TokenBucket",
+    "ConnectionScheduler",
+    "AdaptiveLimiter",
+    "subnet_key",
+]
+
+
+class TokenBucket:
+    """
+    Token bucket in its GCRA ("virtual scheduling") form.
+
+    Instead of counting tokens, we remember the theoretical arrival
+    time of the next request.  This makes a reservation O(1) and
+    lets several buckets agree on one common start time.
+    """
+    def __init__(self, rate, burst=1):
+        self.interval = 1.0 / rate
+        self.tolerance = (max(int(burst), 1) - 1) * self.interval
+        self.tat = 0.0
+
+    def earliest(self, now):
+        """Earliest time at which a request conforms to this bucket."""
+        return max(now, self.tat - self.tolerance)
+
+    def reserve(self, when):
+        """Account for a request that is started at 'when'."""
+        self.tat = max(self.tat, when) + self.interval
+
+    def cancel(self):
+        """Give back a reservation that wasn't used."""
+        self.tat -= self.interval
+
+
+def subnet_key(host, prefix=24):
+    """
+    Key used to group hosts that share a network.
+
+    IP literals are grouped by their network prefix (IPv6 always uses /64),
+    host names by their parent domain, which usually corresponds to the
+    site that hosts the node.
+    """
+    try:
+        addr = ipaddress.ip_address(host)
+    except ValueError:
+        labels = host.split('.', 1)
+        if len(labels) == 1:
+            return host
+        return labels[1]
+    if addr.version == 6:
+        prefix = 64
+    return str(ipaddress.ip_network("%s/%s" % (addr, prefix), strict=False))
+
+
+class ConnectionScheduler:
+    """
+    Rate limiter for new SSH connections.
+
+    A connection has to conform to a global bucket, a bucket for its
+    host and a bucket for the subnet of its host.  Buckets with a rate
+    of None are unlimited.
+    """
+    def __init__(self, rate=None, burst=1, host_rate=None, host_burst=1,
+                 subnet_rate=None, subnet_burst=1, subnet_prefix=24):
+        self.global_bucket = None
+        if rate:
+            self.global_bucket = TokenBucket(rate, burst)
+        self.host_rate = host_rate
+        self.host_burst = host_burst
+        self.subnet_rate = subnet_rate
+        self.subnet_burst = subnet_burst
+        self.subnet_prefix = subnet_prefix
+        self.host_buckets = {}
+        self.subnet_buckets = {}
+
+    def _buckets(self, host):
+        buckets = []
+        if self.global_bucket is not None:
+            buckets.append(self.global_bucket)
+        if self.host_rate:
+            b = self.host_buckets.get(host)
+            if b is None:
+                b = self.host_buckets[host] = TokenBucket(self.host_rate, self.host_burst)
+            buckets.append(b)
+        if self.subnet_rate:
+            key = subnet_key(host, self.subnet_prefix)
+            b = self.subnet_buckets.get(key)
+            if b is None:
+                b = self.subnet_buckets[key] = TokenBucket(self.subnet_rate, self.subnet_burst)
+            buckets.append(b)
+        return buckets
+
+    def reserve(self, host, now):
+        """
+        Reserve a connection slot for 'host' and return
+        the time at which the connection may be started.
+        """
+        buckets = self._buckets(host)
+        start = now
+        for b in buckets:
+            start = max(start, b.earliest(now))
+        for b in buckets:
+            b.reserve(start)
+        return start
+
+    def cancel(self, host):
+        """Give back a reservation for 'host' whose connection wasn't started."""
+        for b in self._buckets(host):
+            b.cancel()
+
+    async def acquire(self, host):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        start = self.reserve(host, now)
+        if start > now:
+            logging.info("Delaying connection to '%s' by %.3fs", host, start - now)
+            try:
+                await asyncio.sleep(start - now)
+            except asyncio.CancelledError:
+                # e.g. the step was stopped, don't hold back later connections
+                self.cancel(host)
+                raise
+
+
+def open_fds():
+    """Number of open file descriptors of this process, or None if unknown."""
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None
+
+
+class AdaptiveLimiter:
+    """
+    Limits the number of concurrent SSH sessions, like a semaphore
+    whose size adapts to how well the sessions go (AIMD).
+
+    Every session that starts without an SSH error lets the limit grow
+    by 1/limit, i.e. by about one per round of 'limit' sessions, as long
+    as the limit is actually used up.  The time it takes to set up new
+    master connections is compared against the lowest setup time seen
+    so far: while it is more than 'tolerance' times as high, the
+    remote side or the network is congested and the limit doesn't grow.
+    An SSH error, or more than 'fd_pressure' of the file descriptor
+    limit in use, halves the limit, at most once per smoothed setup time,
+    so that a burst of failures only counts once.
+
+    With 'minimum' == 'maximum', the limit never changes.
+    """
+    def __init__(self, limit, minimum=None, maximum=None, decrease=0.5, tolerance=2.0, fd_pressure=0.8):
+        self.minimum = limit if minimum is None else minimum
+        self.maximum = limit if maximum is None else maximum
+        self.limit = float(min(max(limit, self.minimum), self.maximum))
+        self.decrease = decrease
+        self.tolerance = tolerance
+        self.fd_pressure = fd_pressure
+        self.in_use = 0
+        self.waiters = collections.deque()
+        # lowest and smoothed setup time of master connections
+        self.baseline = None
+        self.smoothed = None
+        self.last_decrease = None
+        self.last_fd_check = None
+        # statistics
+        self.peak = 0
+        self.lowest = self.highest = int(self.limit)
+        self.increases = 0
+        self.decreases = 0
+
+    @property
+    def adaptive(self):
+        return self.minimum < self.maximum
+
+    def _grant(self):
+        self.in_use += 1
+        self.peak = max(self.peak, self.in_use)
+
+    async def acquire(self):
+        if not self.waiters and self.in_use < int(self.limit):
+            self._grant()
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self.waiters.append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # Granted, but we were cancelled before we could use it
+                self.release()
+            elif fut in self.waiters:
+                # _wake() drops cancelled waiters it comes across
+                self.waiters.remove(fut)
+            raise
+
+    def release(self):
+        self.in_use -= 1
+        self._wake()
+
+    def reclaim(self):
+        """Take back a slot that was released for a while, without waiting."""
+        self._grant()
+
+    def _wake(self):
+        while self.waiters and self.in_use < int(self.limit):
+            fut = self.waiters.popleft()
+            if not fut.done():
+                self._grant()
+                fut.set_result(None)
+
+    def _set_limit(self, limit):
+        old = int(self.limit)
+        self.limit = min(max(limit, self.minimum), self.maximum)
+        new = int(self.limit)
+        if new > old:
+            self.increases += 1
+            self.highest = max(self.highest, new)
+            self._wake()
+        elif new < old:
+            self.decreases += 1
+            self.lowest = min(self.lowest, new)
+            logging.info("Reducing ssh concurrency to %d", new)
+
+    def _under_fd_pressure(self, now):
+        if self.last_fd_check is not None and now - self.last_fd_check < 1.0:
+            return False
+        self.last_fd_check = now
+        used = open_fds()
+        if used is None:
+            return False
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        return soft != resource.RLIM_INFINITY and used > self.fd_pressure * soft
+
+    def success(self, setup_time=None):
+        """
+        Report a session that started fine.  'setup_time' is the number
+        of seconds it took to set up a new master connection for it.
+        """
+        if not self.adaptive:
+            return
+        now = asyncio.get_running_loop().time()
+        if self._under_fd_pressure(now):
+            self.failure()
+            return
+        if setup_time is not None:
+            if self.baseline is None:
+                self.baseline = self.smoothed = setup_time
+            else:
+                # Let the baseline creep up, a single fast
+                # connection shouldn't pin it forever
+                self.baseline = min(setup_time, self.baseline * 1.01)
+                self.smoothed = 0.8 * self.smoothed + 0.2 * setup_time
+            if self.smoothed > self.tolerance * self.baseline:
+                return
+        # Only grow a limit that is actually reached
+        if self.in_use + len(self.waiters) < int(self.limit):
+            return
+        self._set_limit(self.limit + 1.0 / self.limit)
+
+    def failure(self):
+        """Report a session that failed with an SSH error."""
+        if not self.adaptive:
+            return
+        now = asyncio.get_running_loop().time()
+        hold = self.smoothed or 1.0
+        if self.last_decrease is not None and now - self.last_decrease < hold:
+            return
+        self.last_decrease = now
+        self._set_limit(self.limit * self.decrease)
+
+    def stats(self):
+        return {
+            'limit': int(self.limit),
+            'minimum': self.minimum,
+            'maximum': self.maximum,
+            'lowest': self.lowest,
+            'highest': self.highest,
+            'peak_in_use': self.peak,
+            'increases': self.increases,
+            'decreases': self.decreases,
+        }
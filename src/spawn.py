@@ -0,0 +1,199 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+
+from src.error import ExperimentExecutionError
+
+__all__ = [
+    "SpawnPool",
+]
+
+# Started by the pool, see there for the protocol
+SPAWN_WORKER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'spawnworker.py')
+
+MAX_MESSAGE = 1 << 16
+
+
+class SpawnedProcess:
+    """A command started by a spawn worker, like asyncio.subprocess.Process."""
+    def __init__(self, pid, stdout, stderr, exited):
+        self.pid = pid
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = None
+        self._exited = exited
+
+    async def wait(self):
+        if self.returncode is None:
+            self.returncode = await asyncio.shield(self._exited)
+        return self.returncode
+
+
+class Worker:
+    def __init__(self):
+        self.sock, child_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.proc = subprocess.Popen(
+                [sys.executable, SPAWN_WORKER, str(child_sock.fileno())],
+                pass_fds=[child_sock.fileno()])
+        child_sock.close()
+        self.sock.setblocking(False)
+        # request id -> future for the pid
+        self.starting = {}
+        # request id -> future for the exit status
+        self.exiting = {}
+        # only one sender can wait for the socket to become writable
+        self.send_lock = asyncio.Lock()
+        asyncio.get_running_loop().add_reader(self.sock.fileno(), self._read)
+
+    @property
+    def load(self):
+        return len(self.exiting)
+
+    def _read(self):
+        while True:
+            try:
+                data = self.sock.recv(MAX_MESSAGE)
+            except BlockingIOError:
+                return
+            if not data:
+                self._lost()
+                return
+            msg = json.loads(data.decode('utf-8'))
+            req_id = msg['id']
+            if 'status' in msg:
+                fut = self.exiting.pop(req_id, None)
+                if fut is not None and not fut.done():
+                    fut.set_result(msg['status'])
+                continue
+            fut = self.starting.pop(req_id, None)
+            if fut is None or fut.done():
+                continue
+            if 'error' in msg:
+                self.exiting.pop(req_id, None)
+                fut.set_exception(ExperimentExecutionError("Starting command failed (%s)" % (msg['error'],)))
+            else:
+                fut.set_result(msg['pid'])
+
+    def _lost(self):
+        asyncio.get_running_loop().remove_reader(self.sock.fileno())
+        error = ExperimentExecutionError("Spawn worker died")
+        for fut in list(self.starting.values()) + list(self.exiting.values()):
+            if not fut.done():
+                fut.set_exception(error)
+        self.starting = {}
+        self.exiting = {}
+
+    async def _send(self, data, fds):
+        loop = asyncio.get_running_loop()
+        async with self.send_lock:
+            await self._send_locked(loop, data, fds)
+
+    async def _send_locked(self, loop, data, fds):
+        while True:
+            try:
+                socket.send_fds(self.sock, [data], fds)
+                return
+            except BlockingIOError:
+                ready = loop.create_future()
+                loop.add_writer(self.sock.fileno(), ready.set_result, None)
+                try:
+                    await ready
+                finally:
+                    loop.remove_writer(self.sock.fileno())
+
+    async def spawn(self, req_id, command, env, fds):
+        loop = asyncio.get_running_loop()
+        started = self.starting[req_id] = loop.create_future()
+        exited = self.exiting[req_id] = loop.create_future()
+        data = json.dumps({'id': req_id, 'command': command, 'env': env}).encode('utf-8')
+        try:
+            await self._send(data, fds)
+            pid = await started
+        except BaseException:
+            self.starting.pop(req_id, None)
+            self.exiting.pop(req_id, None)
+            raise
+        return pid, exited
+
+    def close(self):
+        asyncio.get_running_loop().remove_reader(self.sock.fileno())
+        self.sock.close()
+
+
+class SpawnPool:
+    """
+    Runs shell commands through a pool of spawn worker processes
+    (src/spawnworker.py) instead of forking from the event loop.
+
+    Workers are started on first use.  Commands go to the worker with
+    the fewest running commands.  Their output is read from pipes
+    on the event loop like that of asyncio subprocesses.
+    """
+    def __init__(self, size=4):
+        self.size = max(int(size), 1)
+        self.workers = []
+        self.next_id = 0
+
+    def _worker(self):
+        if len(self.workers) < self.size:
+            w = Worker()
+            self.workers.append(w)
+            return w
+        return min(self.workers, key=lambda w: w.load)
+
+    async def _reader(self, fd):
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(
+                lambda: asyncio.StreamReaderProtocol(reader),
+                os.fdopen(fd, 'rb', 0))
+        return reader
+
+    async def create_subprocess_shell(self, command, env, stdout=None, stderr=None):
+        """
+        Start 'command' with the environment 'env' in a new session.
+        'stdout' and 'stderr' can be subprocess.PIPE or None, which
+        means the terminal of the control host.
+        """
+        self.next_id += 1
+        req_id = self.next_id
+        # file descriptors that the command gets, and our ends of the pipes
+        fds = []
+        ours = []
+        try:
+            for std, target in ((stdout, 1), (stderr, 2)):
+                if std == subprocess.PIPE:
+                    r, w = os.pipe()
+                    ours.append(r)
+                    fds.append(w)
+                else:
+                    ours.append(None)
+                    fds.append(os.dup(target))
+            pid, exited = await self._worker().spawn(req_id, command, env, fds)
+        except BaseException:
+            for fd in ours:
+                if fd is not None:
+                    os.close(fd)
+            raise
+        finally:
+            for fd in fds:
+                os.close(fd)
+        readers = []
+        for fd in ours:
+            readers.append(None if fd is None else (await self._reader(fd)))
+        return SpawnedProcess(pid, readers[0], readers[1], exited)
+
+    def close(self):
+        for w in self.workers:
+            w.close()
+        for w in self.workers:
+            try:
+                w.proc.wait(5)
+            except subprocess.TimeoutExpired:
+                logging.warning("Spawn worker %s doesn't exit, killing it", w.proc.pid)
+                w.proc.kill()
+        self.workers = []
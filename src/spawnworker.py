@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+#
+#  gplmt-light, a lightweight distributed testbed controller
+#  Copyright (C) 2015  Florian Dold
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Spawn worker for local commands.
+
+The controller starts a few of these and hands them the commands of
+local nodes, so that process creation and reaping doesn't happen on the
+thread of the event loop.  A worker talks to the controller over a
+SOCK_SEQPACKET socket (the file descriptor is the only argument).  Every
+request is a JSON object
+
+  {"id": <n>, "command": "...", "env": {...}}
+
+that carries the file descriptors for stdout and stderr of the command
+as SCM_RIGHTS.  The command is started with posix_spawn in a new session
+and the worker answers with
+
+  {"id": <n>, "pid": <pid>}  or  {"id": <n>, "error": "..."}
+
+and later, when the command has exited,
+
+  {"id": <n>, "status": <exit status, negative for signals>}
+
+The worker exits when the controller closes the socket.
+"""
+
+import json
+import os
+import selectors
+import signal
+import socket
+import sys
+
+MAX_MESSAGE = 1 << 20
+
+
+def exit_status(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def main():
+    sock = socket.socket(fileno=int(sys.argv[1]))
+    sock.set_inheritable(False)
+    sock.setblocking(False)
+    rfd, wfd = os.pipe()
+    os.set_blocking(rfd, False)
+    os.set_blocking(wfd, False)
+    signal.set_wakeup_fd(wfd)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    # Don't die when the controller is interrupted, it will stop us
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    sel = selectors.DefaultSelector()
+    sel.register(sock, selectors.EVENT_READ)
+    sel.register(rfd, selectors.EVENT_READ)
+    # pid -> request id
+    children = {}
+    outgoing = []
+
+    def send(msg):
+        outgoing.append(json.dumps(msg).encode('utf-8'))
+
+    def reap():
+        while children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            req_id = children.pop(pid, None)
+            if req_id is not None:
+                send({'id': req_id, 'status': exit_status(status)})
+
+    def spawn(req, fds):
+        actions = []
+        for target, fd in zip((1, 2), fds):
+            actions.append((os.POSIX_SPAWN_DUP2, fd, target))
+        try:
+            pid = os.posix_spawn(
+                    '/bin/sh', ['/bin/sh', '-c', req['command']], req['env'],
+                    file_actions=actions, setsid=True)
+        except OSError as e:
+            send({'id': req['id'], 'error': str(e)})
+            return
+        children[pid] = req['id']
+        send({'id': req['id'], 'pid': pid})
+
+    running = True
+    while running or children:
+        for key, events in sel.select():
+            if key.fileobj is sock:
+                while True:
+                    try:
+                        data, fds, flags, addr = socket.recv_fds(sock, MAX_MESSAGE, 2)
+                    except BlockingIOError:
+                        break
+                    except ConnectionResetError:
+                        data = None
+                    if not data:
+                        # controller went away
+                        sel.unregister(sock)
+                        running = False
+                        break
+                    try:
+                        # Other commands must not inherit them, or their
+                        # pipes would stay open after this command exits
+                        for fd in fds:
+                            os.set_inheritable(fd, False)
+                        spawn(json.loads(data.decode('utf-8')), fds)
+                    finally:
+                        for fd in fds:
+                            os.close(fd)
+            else:
+                try:
+                    while os.read(rfd, 4096):
+                        pass
+                except BlockingIOError:
+                    pass
+        reap()
+        if running:
+            sock.setblocking(True)
+            try:
+                for msg in outgoing:
+                    sock.send(msg)
+            except OSError:
+                running = False
+            sock.setblocking(False)
+        del outgoing[:]
+
+
+if __name__ == '__main__':
+    main()
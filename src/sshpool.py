@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import os
+import subprocess
+import tempfile
+
+from src.error import ExperimentExecutionError
+
+__all__ = [
+    "MasterPool",
+]
+
+
+class MasterState:
+    def __init__(self, max_sessions):
+        self.alive = False
+        # loop time of the last time we know the master was alive
+        self.verified = None
+        # did we start the master ourselves?
+        self.owned = False
+        self.lock = asyncio.Lock()
+        self.sessions = asyncio.Semaphore(max_sessions)
+
+
+class MasterPool:
+    """
+    Keeps track of the SSH master connections of all SSH nodes
+    in a testbed.
+
+    Masters are only probed (with 'ssh -O check') when we don't
+    know whether they are alive, i.e. when a control socket exists that
+    we haven't verified yet, when a command on the master failed with an
+    SSH error, or when the last verification is older than
+    'check_interval' seconds.
+    """
+    def __init__(self, check_interval=300.0, retries=3, backoff=1.0, max_backoff=30.0, max_sessions=10):
+        self.check_interval = check_interval
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_sessions = max_sessions
+        self.masters = {}
+
+    def _state(self, node):
+        st = self.masters.get(node.name)
+        if st is None:
+            st = self.masters[node.name] = MasterState(self.max_sessions)
+        return st
+
+    def _fresh(self, st):
+        if not st.alive:
+            return False
+        if self.check_interval is None:
+            return True
+        return asyncio.get_running_loop().time() - st.verified < self.check_interval
+
+    def is_alive(self, node):
+        st = self.masters.get(node.name)
+        return st is not None and self._fresh(st)
+
+    def invalidate(self, node):
+        """Forget that the master of 'node' is alive, it will be checked on next use."""
+        st = self.masters.get(node.name)
+        if st is not None:
+            st.alive = False
+
+    async def _run(self, argv, quiet=False):
+        out = subprocess.DEVNULL if quiet else None
+        proc = await asyncio.create_subprocess_exec(*argv, stdout=out, stderr=out)
+        try:
+            ret = await proc.wait()
+        except asyncio.CancelledError:
+            proc.terminate()
+            raise
+        return ret
+
+    async def check(self, node):
+        """Return True if the master connection of 'node' is alive."""
+        ret = await self._run(node.control_command('check'), quiet=True)
+        return ret == 0
+
+    async def _start_master(self, node):
+        # With ControlPersist the master stays in the background with the
+        # descriptors it was started with, so it must not get our terminal.
+        # Its error output goes to an (unlinked) file that it can keep open.
+        with tempfile.TemporaryFile() as err:
+            proc = await asyncio.create_subprocess_exec(
+                    *node.master_command(),
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=err)
+            try:
+                ret = await proc.wait()
+            except asyncio.CancelledError:
+                proc.terminate()
+                raise
+            if ret != 0:
+                err.seek(0)
+                msg = err.read().decode(errors='replace').strip()
+                if msg:
+                    logging.warning("ssh master for '%s': %s", node.name, msg)
+        return ret
+
+    async def ensure(self, node, pause=None):
+        """
+        Make sure that 'node' has a live master connection.  Between
+        attempts, 'pause' is awaited with the backoff delay instead of
+        just sleeping, so that the caller can give up what it holds
+        while it waits.
+        """
+        st = self._state(node)
+        if self._fresh(st):
+            return
+        await st.lock.acquire()
+        try:
+            await self._establish(node, st, pause or asyncio.sleep)
+        finally:
+            st.lock.release()
+
+    async def _establish(self, node, st, pause):
+        # Somebody else might have (re-)established
+        # the master while we were waiting for the lock.
+        if self._fresh(st):
+            return
+        loop = asyncio.get_running_loop()
+        control_path = node.get_control_path()
+        if os.path.exists(control_path):
+            alive = await self.check(node)
+            if alive:
+                logging.info("Using existing master for '%s'", node.name)
+                st.alive = True
+                st.verified = loop.time()
+                return
+            logging.warning("Removing stale master socket '%s'", control_path)
+            try:
+                os.unlink(control_path)
+            except FileNotFoundError:
+                pass
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            logging.info("Creating new master for '%s'", node.name)
+            ret = await self._start_master(node)
+            if ret == 0:
+                st.alive = True
+                st.owned = True
+                st.verified = loop.time()
+                return
+            if attempt < self.retries:
+                logging.warning(
+                        "Creating master for '%s' failed, retrying in %ss",
+                        node.name, delay)
+                await pause(delay)
+                delay = min(delay * 2, self.max_backoff)
+        st.alive = False
+        raise ExperimentExecutionError("Failed to create SSH master connection to '%s'" % (node.name,))
+
+    async def acquire_session(self, node):
+        await self._state(node).sessions.acquire()
+
+    def release_session(self, node):
+        self._state(node).sessions.release()
+
+    async def close_all(self, nodes):
+        """Stop all master connections that we created."""
+        tasks = []
+        for node in nodes:
+            st = self.masters.get(node.name)
+            if st is None or not st.owned:
+                continue
+            st.alive = False
+            st.owned = False
+            tasks.append(asyncio.ensure_future(self._run(node.control_command('exit'), quiet=True)))
+        if tasks:
+            await asyncio.wait(tasks)
@@ -0,0 +1,92 @@
+from src.error import ExperimentSyntaxError
+
+__all__ = [
+    "TargetIndex",
+]
+
+
+class TargetIndex:
+    """
+    Maps target names and target lists (names separated by spaces)
+    to the nodes they stand for.
+
+    Groups are expanded once when the index is created.  The nodes of a
+    target list are returned as a tuple, in the order in which they are
+    first mentioned, without duplicates.  Results are memoized, so that
+    steps in loops don't resolve their targets again in every iteration.
+
+    Nodes in quarantine are left out of all results.
+    """
+    def __init__(self, nodes, groups):
+        self.nodes = nodes
+        self.groups = groups
+        # names of nodes in quarantine
+        self.quarantined = set()
+        # group name -> tuple of nodes
+        self.expanded = {}
+        # target list -> tuple of nodes
+        self.memo = {}
+        # target list -> set of nodes, see contains
+        self.sets = {}
+        for name in groups:
+            self._expand(name, [])
+
+    def _expand(self, group, path):
+        res = self.expanded.get(group)
+        if res is not None:
+            return res
+        if group in path:
+            cycle = path[path.index(group):] + [group]
+            raise ExperimentSyntaxError("Cyclic group definition (%s)" % (" -> ".join(cycle),))
+        path.append(group)
+        members = []
+        for name in self.groups[group]:
+            if name in self.nodes:
+                members.append(self.nodes[name])
+            elif name in self.groups:
+                members.extend(self._expand(name, path))
+            else:
+                raise ExperimentSyntaxError("Unknown target '%s' in group '%s'" % (name, group))
+        path.pop()
+        res = self.expanded[group] = _unique(members)
+        return res
+
+    def quarantine(self, names):
+        """Leave the nodes 'names' out of all targets from now on."""
+        self.quarantined.update(names)
+        self.memo = {}
+        self.sets = {}
+
+    def resolve(self, targets):
+        res = self.memo.get(targets)
+        if res is not None:
+            return res
+        members = []
+        for name in targets.split():
+            if name in self.nodes:
+                members.append(self.nodes[name])
+            elif name in self.expanded:
+                members.extend(self.expanded[name])
+            else:
+                raise ExperimentSyntaxError("Unknown target '%s'" % (name,))
+        if self.quarantined:
+            members = [m for m in members if m.name not in self.quarantined]
+        res = self.memo[targets] = _unique(members)
+        return res
+
+    def contains(self, targets, node):
+        """Is 'node' one of the nodes of 'targets'?"""
+        members = self.sets.get(targets)
+        if members is None:
+            members = self.sets[targets] = frozenset(self.resolve(targets))
+        return node in members
+
+
+def _unique(nodes):
+    seen = set()
+    res = []
+    for n in nodes:
+        if n not in seen:
+            seen.add(n)
+            res.append(n)
+    return tuple(res)
@@ -0,0 +1,55 @@
+import asyncio
+
+__all__ = [
+    "TaskGroup",
+]
+
+
+class TaskGroup:
+    """
+    Tasks that are started together and don't outlive each other.
+
+    Leaving the 'async with' block waits for all tasks of the group and
+    raises the exception of the first task (in the order they were
+    created) that failed.  If the block itself fails, or the task that
+    runs it is cancelled, all tasks of the group are cancelled and waited
+    for before the exception is passed on.
+    """
+    def __init__(self):
+        self.tasks = []
+
+    async def __aenter__(self):
+        return self
+
+    def create_task(self, coro):
+        task = asyncio.ensure_future(coro)
+        self.tasks.append(task)
+        return task
+
+    async def cancel(self):
+        for t in self.tasks:
+            t.cancel()
+        if self.tasks:
+            await asyncio.wait(self.tasks)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            await self.cancel()
+            return False
+        if not self.tasks:
+            return False
+        try:
+            await asyncio.wait(self.tasks)
+        except asyncio.CancelledError:
+            await self.cancel()
+            raise
+        error = None
+        for t in self.tasks:
+            if t.cancelled():
+                continue
+            e = t.exception()
+            if e is not None and error is None:
+                error = e
+        if error is not None:
+            raise error
+        return False
@@ -0,0 +1,230 @@
+"""
+Per-node logs of the output of run tasks.
+
+The output of all commands that run on a node is appended to the
+segment files of the node's log directory, in chunks of at most
+'buffer_size' bytes.  A segment is closed and a new one is started
+when it grows beyond 'segment_size' bytes.  Nothing is ever
+overwritten, running an experiment again appends to the same log.
+
+The file 'index' has one JSON array per line, either
+
+  ["out" or "err", task, iteration, segment, offset, length, compressed]
+
+for a chunk of output or
+
+  ["exit", task, iteration, status]
+
+when the command has finished (status is null if the command was
+killed, and "not started" if it couldn't be started, e.g. because
+the node is unreachable).  The iteration counts the runs of a task on the node,
+starting from 0.
+
+To show the output of a task, run
+
+  python3 -m src.tasklog LOGROOT NODE [TASK [ITERATION]] [--stderr]
+"""
+
+import argparse
+import collections
+import json
+import os
+import sys
+import zlib
+
+__all__ = [
+    "NodeLog",
+    "LogReader",
+]
+
+CHUNK = 1 << 16
+
+
+def _segment_name(segment):
+    return "segment-%06d.log" % (segment,)
+
+
+def read_index(directory):
+    """Iterate over the entries of the index in 'directory'."""
+    try:
+        f = open(os.path.join(directory, 'index'), 'r', encoding='utf-8')
+    except FileNotFoundError:
+        return
+    with f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # cut off when we crashed while writing it
+                continue
+            yield entry
+
+
+class TaskRecord:
+    """The output of one run of a task."""
+    def __init__(self, log, task, iteration):
+        self.log = log
+        self.task = task
+        self.iteration = iteration
+        self.buffers = {'out': bytearray(), 'err': bytearray()}
+        # exit status, if the command finished
+        self.status = None
+
+    def write(self, stream, data):
+        buf = self.buffers[stream]
+        buf += data
+        if len(buf) >= self.log.buffer_size:
+            self.log._append(self, stream, buf)
+            del buf[:]
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        for stream, buf in self.buffers.items():
+            if buf:
+                self.log._append(self, stream, buf)
+                del buf[:]
+        self.log._finish(self)
+
+
+class NodeLog:
+    def __init__(self, directory, segment_size=64 << 20, buffer_size=CHUNK, compress=False):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.buffer_size = buffer_size
+        self.compress = compress
+        # task name -> number of runs
+        self.iterations = {}
+        self.segment = 0
+        for entry in read_index(directory):
+            self.iterations[entry[1]] = max(self.iterations.get(entry[1], 0), entry[2] + 1)
+            if entry[0] != 'exit':
+                self.segment = max(self.segment, entry[3])
+        index_path = os.path.join(directory, 'index')
+        cut_off = False
+        if os.path.exists(index_path):
+            with open(index_path, 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                if f.tell() > 0:
+                    f.seek(-1, os.SEEK_END)
+                    cut_off = f.read(1) != b'\n'
+        self.index = open(index_path, 'a', encoding='utf-8')
+        if cut_off:
+            # Don't continue a line that was cut off
+            self.index.write('\n')
+        self._open_segment()
+
+    def _open_segment(self):
+        self.file = open(os.path.join(self.directory, _segment_name(self.segment)), 'ab')
+        self.offset = self.file.tell()
+
+    def begin(self, task):
+        """Start recording a new run of 'task'."""
+        iteration = self.iterations.get(task, 0)
+        self.iterations[task] = iteration + 1
+        return TaskRecord(self, task, iteration)
+
+    def _append(self, record, stream, data):
+        data = bytes(data)
+        if self.compress:
+            data = zlib.compress(data)
+        if self.offset > 0 and self.offset + len(data) > self.segment_size:
+            self.file.close()
+            self.segment += 1
+            self._open_segment()
+        self.file.write(data)
+        # The index must never point to data that isn't written yet
+        self.file.flush()
+        entry = [stream, record.task, record.iteration, self.segment, self.offset, len(data), int(self.compress)]
+        self.offset += len(data)
+        self.index.write(json.dumps(entry) + '\n')
+
+    def _finish(self, record):
+        self.index.write(json.dumps(['exit', record.task, record.iteration, record.status]) + '\n')
+        self.index.flush()
+
+    def close(self):
+        self.file.close()
+        self.index.close()
+
+
+class LogReader:
+    """Look up the output of tasks in the log of one node."""
+    def __init__(self, directory):
+        self.directory = directory
+        # (task, iteration) -> {'out': [...], 'err': [...], 'status': ...}
+        self.runs = collections.OrderedDict()
+        # task -> iterations in the order they were started
+        self.tasks = {}
+        for entry in read_index(directory):
+            run = self.runs.get((entry[1], entry[2]))
+            if run is None:
+                run = self.runs[(entry[1], entry[2])] = {'out': [], 'err': [], 'status': None}
+                self.tasks.setdefault(entry[1], []).append(entry[2])
+            if entry[0] == 'exit':
+                run['status'] = entry[3]
+            else:
+                run[entry[0]].append(entry[3:])
+
+    def iterations(self, task):
+        return self.tasks.get(task, [])
+
+    def status(self, task, iteration):
+        return self.runs[(task, iteration)]['status']
+
+    def read(self, task, iteration, stream='out'):
+        """Return the output of one run of a task."""
+        chunks = []
+        segment_file = None
+        segment = None
+        try:
+            for seg, offset, length, compressed in self.runs[(task, iteration)][stream]:
+                if seg != segment:
+                    if segment_file is not None:
+                        segment_file.close()
+                    segment_file = open(os.path.join(self.directory, _segment_name(seg)), 'rb')
+                    segment = seg
+                segment_file.seek(offset)
+                data = segment_file.read(length)
+                if compressed:
+                    data = zlib.decompress(data)
+                chunks.append(data)
+        finally:
+            if segment_file is not None:
+                segment_file.close()
+        return b''.join(chunks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show the output of tasks from a gplmt log directory")
+    parser.add_argument("logroot")
+    parser.add_argument("node")
+    parser.add_argument("task", nargs='?')
+    parser.add_argument("iteration", nargs='?', type=int,
+                        help="run of the task, the last one by default")
+    parser.add_argument("--stderr", action="store_true",
+                        help="show standard error instead of standard output")
+    args = parser.parse_args()
+
+    reader = LogReader(os.path.join(args.logroot, args.node))
+    if args.task is None:
+        for (task, iteration), run in reader.runs.items():
+            print("%s\t%s\t%s" % (task, iteration, run['status']))
+        return
+    iterations = reader.iterations(args.task)
+    if not iterations:
+        print("No runs of task '%s' on '%s'" % (args.task, args.node), file=sys.stderr)
+        sys.exit(1)
+    iteration = args.iteration
+    if iteration is None:
+        iteration = iterations[-1]
+    elif iteration not in iterations:
+        print("No run %s of task '%s' on '%s'" % (iteration, args.task, args.node), file=sys.stderr)
+        sys.exit(1)
+    sys.stdout.buffer.write(reader.read(args.task, iteration, 'err' if args.stderr else 'out'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+"""
+Execution trace of an experiment.
+
+While an experiment runs, the Tracer records spans: how long tasklists
+and tasks ran on every node, and where they waited.  The kinds of spans
+(their category in the trace) are
+
+  queue wait      a scheduled tasklist waiting for the event loop
+                  (after its start delay, if it has one)
+  tasklist        a tasklist on a node
+  task            a run, put, get or transfer task of a tasklist
+  semaphore wait  an ssh session waiting for a free connection slot
+  cooldown wait   a new ssh connection waiting for the connection rate
+                  limits (--ssh-rate, --ssh-cooldown, ...)
+  session wait    an ssh session waiting for a free session on the
+                  master connection (--ssh-max-sessions)
+  master setup    setting up an ssh master connection
+  process         a command, from starting it until it exits, with the
+                  time it took to start it ('spawn')
+  transfer        copying files, with the number of bytes
+  join            a synchronization waiting for tasks
+  start delay     how late the first command of a step with a start time
+                  started on a node
+
+Every span belongs to the top-level step that it was started from, which
+the tasks of the step inherit like a context variable.
+
+The trace is written in the JSON format of the Chrome trace viewer,
+which Perfetto (https://ui.perfetto.dev) reads too.  Every node is a
+process in the trace, spans that overlap on a node (tasklists that run
+at the same time, branches of 'par') are shown on separate threads of
+it.  The summary aggregates the spans of every step by kind, it can also
+be made from a written trace:
+
+    python3 -m src.trace trace.json
+"""
+
+import argparse
+import collections
+import contextvars
+import json
+import logging
+import time
+
+__all__ = [
+    "Tracer",
+    "summarize",
+]
+
+# Label of the step that the current task belongs to
+_step = contextvars.ContextVar('gplmt_trace_step', default=None)
+# (key, lane) that the current task records its spans on
+_lane = contextvars.ContextVar('gplmt_trace_lane', default=None)
+
+# Name of the process in the trace for spans that don't belong to a node
+CONTROLLER = 'gplmt'
+
+
+class Span:
+    __slots__ = ('tracer', 'kind', 'label', 'args', 'start')
+
+    def __init__(self, tracer, kind, label, args):
+        self.tracer = tracer
+        self.kind = kind
+        self.label = label
+        self.args = args
+        self.start = None
+
+    def set(self, **args):
+        """Add arguments, e.g. numbers that are only known at the end."""
+        self.args.update(args)
+
+    def mark(self, name):
+        """Add the number of seconds since the start as argument 'name'."""
+        self.args[name] = round(self.tracer.clock() - self.start, 6)
+
+    def __enter__(self):
+        self.start = self.tracer.clock()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer.record(self.kind, self.start, self.tracer.clock(), self.label, self.args)
+        return False
+
+
+class NullSpan:
+    """What spans and lanes are when tracing is disabled."""
+    __slots__ = ()
+
+    def set(self, **args):
+        pass
+
+    def mark(self, name):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Lane:
+    __slots__ = ('tracer', 'key', 'fork', 'token', 'index')
+
+    def __init__(self, tracer, key, fork):
+        self.tracer = tracer
+        self.key = key
+        self.fork = fork
+        self.token = None
+        self.index = None
+
+    def __enter__(self):
+        current = _lane.get()
+        if not self.fork and current is not None and current[0] == self.key:
+            # Already on a lane of the node, e.g. a tasklist that is called
+            return self
+        self.index = self.tracer._take_lane(self.key)
+        self.token = _lane.set((self.key, self.index))
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.token is not None:
+            _lane.reset(self.token)
+            self.tracer._free_lane(self.key, self.index)
+        return False
+
+
+class Tracer:
+    """
+    Records spans of the experiment, or does nothing if not 'enabled'.
+
+    Times are taken from 'clock', by default the monotonic clock.  Spans
+    are kept in memory as tuples until the trace is written, which is
+    about 100 bytes per span.
+    """
+    def __init__(self, enabled=True, clock=time.monotonic):
+        self.enabled = enabled
+        self.clock = clock
+        self.origin = clock()
+        # (kind, label, key, lane, start, end, step, args)
+        self.spans = []
+        # key -> list of busy flags of its lanes
+        self.lanes = {}
+
+    def now(self):
+        return self.clock()
+
+    def set_step(self, label):
+        """Let the current task, and the tasks it creates, belong to step 'label'."""
+        if self.enabled:
+            _step.set(label)
+
+    def lane(self, key, fork=False):
+        """
+        Record the spans of the current task on a free lane of 'key', a
+        node name, until the returned context manager exits.  If the task
+        already records on a lane of 'key', it stays there, unless 'fork'
+        is set because it runs concurrently with the task that owns it.
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        return Lane(self, key, fork)
+
+    def _take_lane(self, key):
+        busy = self.lanes.get(key)
+        if busy is None:
+            busy = self.lanes[key] = []
+        for i, b in enumerate(busy):
+            if not b:
+                busy[i] = True
+                return i
+        busy.append(True)
+        return len(busy) - 1
+
+    def _free_lane(self, key, index):
+        self.lanes[key][index] = False
+
+    def span(self, kind, label=None, **args):
+        """
+        Context manager that records a span of 'kind' around its body.
+        'label' is what the trace viewer shows, by default the kind.
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, kind, label, args)
+
+    def record(self, kind, start, end, label=None, args=None):
+        """Record a span that was measured by the caller."""
+        if not self.enabled:
+            return
+        lane = _lane.get()
+        if lane is None:
+            key, index = CONTROLLER, 0
+        else:
+            key, index = lane
+        self.spans.append((kind, label, key, index, start, end, _step.get(), args))
+
+    def events(self):
+        """Return the spans as events of the Chrome trace format."""
+        events = []
+        pids = {}
+        for kind, label, key, index, start, end, step, args in self.spans:
+            pid = pids.get(key)
+            if pid is None:
+                pid = pids[key] = len(pids) + 1
+                events.append({'ph': 'M', 'name': 'process_name', 'pid': pid, 'tid': 0,
+                               'args': {'name': key}})
+                events.append({'ph': 'M', 'name': 'process_sort_index', 'pid': pid, 'tid': 0,
+                               'args': {'sort_index': pid}})
+            event_args = {'node': key}
+            if step is not None:
+                event_args['step'] = step
+            if args:
+                event_args.update(args)
+            events.append({
+                'ph': 'X',
+                'name': label or kind,
+                'cat': kind,
+                'pid': pid,
+                'tid': index + 1,
+                'ts': round((start - self.origin) * 1e6, 1),
+                'dur': round((end - start) * 1e6, 1),
+                'args': event_args,
+            })
+        return events
+
+    def write(self, filename):
+        trace = {
+            'traceEvents': self.events(),
+            'displayTimeUnit': 'ms',
+            'otherData': {'spans': len(self.spans)},
+        }
+        try:
+            with open(filename, 'w', encoding='utf-8') as f:
+                json.dump(trace, f)
+        except OSError as e:
+            logging.warning("Could not write trace (%s)", e)
+
+    def summary(self):
+        return summarize(self.events())
+
+
+def _percentile(values, p):
+    """Nearest-rank percentile of sorted 'values'."""
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def summarize(events):
+    """
+    Aggregate the spans in Chrome trace 'events' per step, and return
+    the summary as lines.
+    """
+    # step -> kind -> durations, bytes
+    steps = collections.OrderedDict()
+    # step -> first start, last end, node -> time in tasklists
+    extent = {}
+    for ev in events:
+        if ev.get('ph') != 'X':
+            continue
+        args = ev.get('args', {})
+        step = args.get('step', '(outside of steps)')
+        phases = steps.get(step)
+        if phases is None:
+            phases = steps[step] = collections.OrderedDict()
+            extent[step] = [ev['ts'], ev['ts'] + ev['dur'], collections.Counter()]
+        durations = phases.get(ev['cat'])
+        if durations is None:
+            durations = phases[ev['cat']] = [[], 0]
+        durations[0].append(ev['dur'] / 1e6)
+        durations[1] += args.get('bytes', 0)
+        ext = extent[step]
+        ext[0] = min(ext[0], ev['ts'])
+        ext[1] = max(ext[1], ev['ts'] + ev['dur'])
+        if ev['cat'] == 'tasklist':
+            ext[2][args.get('node')] += ev['dur'] / 1e6
+
+    lines = []
+    for step in sorted(steps, key=lambda s: extent[s][0]):
+        phases = steps[step]
+        first, last, nodes = extent[step]
+        lines.append("%s: %.3fs" % (step, (last - first) / 1e6))
+        lines.append("  %-15s %8s %10s %9s %9s %9s %9s %12s" % (
+                "kind", "count", "total (s)", "mean", "p50", "p99", "max", "bytes"))
+        for kind, (durations, nbytes) in phases.items():
+            durations.sort()
+            total = sum(durations)
+            lines.append("  %-15s %8d %10.3f %9.3f %9.3f %9.3f %9.3f %12s" % (
+                    kind, len(durations), total, total / len(durations),
+                    _percentile(durations, 0.5), _percentile(durations, 0.99),
+                    durations[-1], nbytes or ''))
+        if nodes:
+            node, busy = nodes.most_common(1)[0]
+            lines.append("  busiest node: %s (%.3fs in tasklists)" % (node, busy))
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize a trace written with gplmt-light.py --trace")
+    parser.add_argument("trace", help="trace file")
+    args = parser.parse_args()
+    with open(args.trace, 'r', encoding='utf-8') as f:
+        trace = json.load(f)
+    for line in summarize(trace['traceEvents']):
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import hashlib
+import os
+import posixpath
+import shlex
+import tarfile
+
+__all__ = [
+    "digest_files",
+    "manifest_command",
+    "parse_manifest",
+    "write_archive",
+    "extract_archive",
+]
+
+
+def _digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def digest_files(paths):
+    """Return the SHA-256 hex digests of the given local files."""
+    return [_digest(p) for p in paths]
+
+
+def manifest_command(paths):
+    """
+    Shell command that prints the home directory of the remote user,
+    followed by 'sha256sum' lines for all of 'paths' that exist.
+    """
+    quoted = ' '.join(shlex.quote(p) for p in paths)
+    return 'printf "%%s\\n" "$HOME" && { sha256sum -- %s 2>/dev/null; true; }' % (quoted,)
+
+
+def parse_manifest(data):
+    """Parse the output of 'manifest_command' into (home, {path: digest})."""
+    lines = data.decode('utf-8', 'replace').split('\n')
+    home = lines[0]
+    digests = {}
+    for line in lines[1:]:
+        # Names with special characters are escaped by sha256sum,
+        # we just treat those files as changed.
+        if not line or line.startswith('\\'):
+            continue
+        digest, sep, path = line.partition(' ')
+        if not sep or len(path) < 2:
+            continue
+        # text mode uses ' ', binary mode uses '*'
+        digests[path[1:]] = digest
+    return home, digests
+
+
+def write_archive(fileobj, members, compress=False):
+    """
+    Write a tar archive to 'fileobj'.  'members' is a list of
+    (local_source, remote_absolute_path) pairs.  The archive has to be
+    extracted relative to the root directory.
+    """
+    mode = 'w:gz' if compress else 'w'
+    with tarfile.open(fileobj=fileobj, mode=mode) as tar:
+        for source, destination in members:
+            tar.add(source, arcname=posixpath.normpath(destination).lstrip('/'), recursive=False)
+
+
+def extract_archive(fileobj, files, compress=False):
+    """
+    Extract the files requested in 'files', a list of
+    (remote_source, local_destination) pairs, from a tar archive
+    created on the remote side.  Returns the remote sources that
+    were not found in the archive.
+    """
+    wanted = {}
+    for source, destination in files:
+        wanted[posixpath.normpath(source).lstrip('/')] = destination
+    mode = 'r|gz' if compress else 'r|'
+    with tarfile.open(fileobj=fileobj, mode=mode) as tar:
+        for member in tar:
+            destination = wanted.pop(posixpath.normpath(member.name).lstrip('/'), None)
+            if destination is None or not member.isfile():
+                continue
+            os.makedirs(os.path.dirname(os.path.realpath(destination)), exist_ok=True)
+            # Don't leave a truncated file behind if the archive is cut off
+            partial = destination + '.part'
+            with open(partial, 'wb') as f:
+                src = tar.extractfile(member)
+                for chunk in iter(lambda: src.read(1 << 16), b''):
+                    f.write(chunk)
+            os.chmod(partial, member.mode & 0o777)
+            os.replace(partial, destination)
+    return [source for source, destination in files
+            if posixpath.normpath(source).lstrip('/') in wanted]
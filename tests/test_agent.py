@@ -0,0 +1,100 @@
+import json
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from src.gplmtlib import AGENT_SCRIPT
+from src.plan import CallTask, FailTask, ParTask, RunTask, SeqTask, agent_plan, make_tasklist
+from test_experiment import fake_ssh_env, run_gplmt, write_experiment
+
+
+def run_agent(plan, env=None, timeout=None):
+    """Run the agent locally and return its events."""
+    request = json.dumps({'plan': plan, 'env': env or {}, 'timeout': timeout})
+    proc = subprocess.Popen([sys.executable, AGENT_SCRIPT], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    proc.stdin.write((request + '\n').encode('utf-8'))
+    proc.stdin.flush()
+    # Closing stdin stops the agent, so it stays open until it is done
+    events = []
+    for line in proc.stdout:
+        events.append(json.loads(line.decode('utf-8')))
+        if events[-1]['event'] == 'done':
+            break
+    proc.stdin.close()
+    proc.wait(30)
+    proc.stdout.close()
+    return events
+
+
+class AgentPlanTest(unittest.TestCase):
+    def test_plan(self):
+        tasklist = make_tasklist('t', [
+            RunTask('a', 'echo a', 0),
+            ParTask((RunTask('b', 'echo b'), FailTask())),
+        ])
+        self.assertEqual(tasklist.agent_plan, {'type': 'seq', 'children': [{'type': 'seq', 'children': [
+            {'type': 'run', 'id': 0, 'command': 'echo a', 'expected_status': 0},
+            {'type': 'par', 'children': [
+                {'type': 'run', 'id': 1, 'command': 'echo b', 'expected_status': None},
+                {'type': 'fail'},
+            ]},
+        ]}]})
+        self.assertEqual([r.name for r in tasklist.agent_runs], ['a', 'b'])
+
+    def test_not_for_agent(self):
+        runs = []
+        self.assertIsNone(agent_plan(SeqTask((RunTask('a', 'true'), CallTask('x', None))), runs))
+
+
+class AgentProtocolTest(unittest.TestCase):
+    def test_run(self):
+        plan = {'type': 'seq', 'children': [
+            {'type': 'run', 'id': 0, 'command': 'echo "$GREETING"; echo oops >&2', 'expected_status': 0},
+        ]}
+        events = run_agent(plan, env={'GREETING': 'hello'})
+        self.assertEqual(events[0], {'event': 'start', 'id': 0})
+        output = [(e['stream'], e['data']) for e in events if e['event'] == 'output']
+        self.assertIn(('out', 'hello\n'), output)
+        self.assertIn(('err', 'oops\n'), output)
+        self.assertEqual(events[-2], {'event': 'exit', 'id': 0, 'status': 0})
+        self.assertEqual(events[-1], {'event': 'done'})
+
+    def test_unexpected_status(self):
+        plan = {'type': 'seq', 'children': [
+            {'type': 'run', 'id': 0, 'command': 'exit 3', 'expected_status': 0},
+            {'type': 'run', 'id': 1, 'command': 'echo never', 'expected_status': None},
+        ]}
+        events = run_agent(plan)
+        self.assertEqual(events[-2], {'event': 'exit', 'id': 0, 'status': 3})
+        self.assertEqual(events[-1], {'event': 'done', 'error': "Unexpected status"})
+
+    def test_fail(self):
+        events = run_agent({'type': 'par', 'children': [{'type': 'fail'}]})
+        self.assertEqual(events, [{'event': 'done', 'error': "user-requested fail"}])
+
+    def test_timeout(self):
+        plan = {'type': 'run', 'id': 0, 'command': 'sleep 10', 'expected_status': None}
+        events = run_agent(plan, timeout=0.2)
+        self.assertEqual(events[-1], {'event': 'done', 'error': "timeout", 'timeout': True})
+
+
+class AgentTimeoutTest(unittest.TestCase):
+    def test_timeout_like_tasklist(self):
+        # A tasklist that the agent runs times out like any other,
+        # the experiment goes on
+        with tempfile.TemporaryDirectory() as d:
+            filename = write_experiment(
+                    d,
+                    '<tasklist name="slow" timeout="PT1S" agent="true"><seq><run>sleep 10</run></seq></tasklist>'
+                    '<tasklist name="after"><seq><run>echo after</run></seq></tasklist>',
+                    '<step tasklist="slow" targets="n"/><step tasklist="after" targets="n"/>',
+                    '<target name="n" type="ssh"><user>u</user><host>n.test</host></target>')
+            status, output = run_gplmt(filename, env=fake_ssh_env(d))
+        self.assertEqual(status, 0, output)
+        self.assertIn("Tasklist slow on node n timed out", output)
+        self.assertIn("after", output)
+
+
+if __name__ == '__main__':
+    unittest.main()
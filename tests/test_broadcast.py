@@ -0,0 +1,95 @@
+import asyncio
+import unittest
+
+from src.broadcast import Broadcast
+
+
+class Node:
+    def __init__(self, name):
+        self.name = name
+
+
+class BroadcastTest(unittest.TestCase):
+    def test_tree(self):
+        async def run():
+            bc = Broadcast(2)
+            a, b, c, d = (Node(n) for n in 'abcd')
+            self.assertIsNone(await bc.acquire(a))
+            self.assertIsNone(await bc.acquire(b))
+            await bc.done(None, a, True)
+            self.assertIs(await bc.acquire(c), a)
+            self.assertIs(await bc.acquire(d), a)
+            await bc.done(a, c, True)
+            await bc.done(a, d, False, parent_failed=True)
+            # a failed to forward, so it is not used any more
+            self.assertFalse(bc.has_holder(a))
+            self.assertTrue(bc.has_holder(c))
+        asyncio.run(run())
+
+    def test_receiver_failure_keeps_parent(self):
+        # Regression: a failure on the receiving side dropped the parent
+        async def run():
+            bc = Broadcast(1)
+            a, b, c = Node('a'), Node('b'), Node('c')
+            self.assertIsNone(await bc.acquire(a))
+            await bc.done(None, a, True)
+            self.assertIs(await bc.acquire(b), a)
+            await bc.done(a, b, False)
+            self.assertTrue(bc.has_holder(a))
+            self.assertFalse(bc.has_holder(b))
+            self.assertIs(await asyncio.wait_for(bc.acquire(c), 1), a)
+        asyncio.run(run())
+
+    def test_direct_released(self):
+        # Regression: finished direct uploads still counted against the
+        # width, so nobody got a direct upload after a failed one
+        async def run():
+            bc = Broadcast(1)
+            a, b = Node('a'), Node('b')
+            self.assertIsNone(await bc.acquire(a))
+            await bc.done(None, a, False)
+            self.assertEqual(bc.direct, 0)
+            self.assertIsNone(await asyncio.wait_for(bc.acquire(b), 1))
+            self.assertEqual(bc.direct, 1)
+        asyncio.run(run())
+
+    def test_never_own_parent(self):
+        # Regression: broadcasting the same file again handed a
+        # holder itself as parent, which truncated its copy
+        async def run():
+            bc = Broadcast(1)
+            a = Node('a')
+            self.assertIsNone(await bc.acquire(a))
+            await bc.done(None, a, True)
+            self.assertTrue(bc.has_holder(a))
+            # With nobody else to forward from, this is a direct upload
+            # instead of waiting for ourselves
+            parent = await asyncio.wait_for(bc.acquire(a), 1)
+            self.assertIsNone(parent)
+        asyncio.run(run())
+
+    def test_parent_is_other_holder(self):
+        async def run():
+            bc = Broadcast(1)
+            a, b = Node('a'), Node('b')
+            self.assertIsNone(await bc.acquire(a))
+            await bc.done(None, a, True)
+            self.assertIs(await bc.acquire(b), a)
+            await bc.done(a, b, True)
+            self.assertIs(await bc.acquire(a), b)
+        asyncio.run(run())
+
+    def test_remove_holder(self):
+        async def run():
+            bc = Broadcast(1)
+            a, b = Node('a'), Node('b')
+            self.assertIsNone(await bc.acquire(a))
+            await bc.done(None, a, True)
+            await bc.remove_holder(a)
+            self.assertFalse(bc.has_holder(a))
+            self.assertIsNone(await asyncio.wait_for(bc.acquire(b), 1))
+        asyncio.run(run())
+
+
+if __name__ == '__main__':
+    unittest.main()
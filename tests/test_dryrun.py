@@ -0,0 +1,162 @@
+import asyncio
+import time
+import unittest
+
+from src.dryrun import MIN_DURATION, Estimates, VirtualTimeLoop, critical_path
+
+
+def run_virtual(coro):
+    loop = VirtualTimeLoop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class Pol:
+    def __init__(self, task_name, command):
+        self.task_name = task_name
+        self.command = command
+
+
+def span(cat, name, node, ts, dur, lane=1):
+    """A complete event of a trace, times in seconds."""
+    return {'ph': 'X', 'cat': cat, 'name': name, 'pid': 1, 'tid': lane,
+            'ts': ts * 1e6, 'dur': dur * 1e6, 'args': {'node': node}}
+
+
+class VirtualTimeLoopTest(unittest.TestCase):
+    def test_time_jumps(self):
+        async def run():
+            loop = asyncio.get_running_loop()
+            fired = []
+            loop.call_later(7200, lambda: fired.append(loop.time()))
+            self.assertEqual(loop.time(), 0.0)
+            await asyncio.sleep(3600)
+            self.assertEqual(loop.time(), 3600)
+            await asyncio.sleep(3600.5)
+            return fired, loop.time()
+        start = time.monotonic()
+        fired, now = run_virtual(run())
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(fired, [7200])
+        self.assertEqual(now, 7200.5)
+
+    def test_concurrent_sleeps(self):
+        async def run():
+            loop = asyncio.get_running_loop()
+            ends = {}
+
+            async def sleeper(name, seconds):
+                await asyncio.sleep(seconds)
+                ends[name] = loop.time()
+            await asyncio.gather(sleeper('a', 10), sleeper('b', 5), sleeper('c', 10))
+            return ends
+        self.assertEqual(run_virtual(run()), {'a': 10, 'b': 5, 'c': 10})
+
+    def test_executor_in_real_time(self):
+        # While a function runs in the executor, the clock doesn't jump
+        async def run():
+            loop = asyncio.get_running_loop()
+            timer = asyncio.ensure_future(asyncio.sleep(1000))
+            await loop.run_in_executor(None, time.sleep, 0.1)
+            self.assertFalse(timer.done())
+            self.assertLess(loop.time(), 1000)
+            self.assertEqual(loop.executing, 0)
+            await timer
+        run_virtual(run())
+
+
+class EstimatesTest(unittest.TestCase):
+    def estimates(self):
+        est = Estimates(default=2.0, ssh_setup=0.5)
+        est.add_trace([
+            # 'run work' on a takes 1, 3 and 8 seconds, on b 20
+            span('task', 'run work', 'a', 0, 1.5),
+            span('process', 'process', 'a', 0.1, 1),
+            span('task', 'run work', 'a', 10, 3.5),
+            span('process', 'process', 'a', 10.1, 3),
+            span('task', 'run work', 'a', 20, 8.5),
+            span('process', 'process', 'a', 20.1, 8),
+            span('task', 'run work', 'b', 0, 21, lane=2),
+            span('process', 'process', 'b', 0.5, 20, lane=2),
+            # A task that failed doesn't count
+            dict(span('task', 'run other', 'a', 30, 100), args={'node': 'a', 'error': 'x'}),
+            span('process', 'process', 'a', 30, 100),
+            span('master setup', 'master setup', 'a', 0, 0.2),
+            span('master setup', 'master setup', 'b', 0, 0.4),
+            span('master setup', 'master setup', 'b', 0, 0.6),
+        ])
+        return est
+
+    def test_median_per_node(self):
+        est = self.estimates()
+        self.assertEqual(est.command('a', Pol('work', 'make')), 3)
+        self.assertEqual(est.command('b', Pol('work', 'make')), 20)
+
+    def test_median_over_nodes(self):
+        # A node without its own durations gets the median of all nodes
+        est = self.estimates()
+        self.assertEqual(est.command('c', Pol('work', 'make')), 5.5)
+
+    def test_sleep_and_default(self):
+        est = self.estimates()
+        self.assertEqual(est.command('a', Pol('other', 'sleep 12')), 12)
+        self.assertEqual(est.command('a', Pol('other', 'sleep 0')), MIN_DURATION)
+        self.assertEqual(est.command('a', Pol('other', 'sleep 1; make')), 2.0)
+        self.assertEqual(est.command('a', Pol(None, 'make')), 2.0)
+        # Traces go before 'sleep N'
+        self.assertEqual(est.command('a', Pol('work', 'sleep 12')), 3)
+        self.assertEqual(est.sources, {'trace': 1, 'sleep': 2, 'default': 2})
+
+    def test_master_setup(self):
+        est = self.estimates()
+        self.assertAlmostEqual(est.master_setup('a'), 0.2)
+        self.assertAlmostEqual(est.master_setup('b'), 0.5)
+        self.assertAlmostEqual(est.master_setup('c'), 0.4)
+        self.assertEqual(Estimates(ssh_setup=0.7).master_setup('a'), 0.7)
+
+
+def tasklist(label, node, start, end, step='step 1'):
+    return ('tasklist', label, node, 1, start, end, step, {})
+
+
+def task(label, node, start, end):
+    return ('task', label, node, 1, start, end, None, {})
+
+
+class CriticalPathTest(unittest.TestCase):
+    def test_path(self):
+        # n1: A 0-5, C 5-8 after a synchronize; n2: B 0-3, D 5-7
+        spans = [
+            tasklist('A', 'n1', 0, 5),
+            task('run a1', 'n1', 0, 1),
+            task('run a2', 'n1', 1, 5),
+            tasklist('B', 'n2', 0, 3),
+            tasklist('C', 'n1', 5, 8, 'step 3'),
+            tasklist('D', 'n2', 5, 7, 'step 3'),
+        ]
+        path = critical_path(spans, 8)
+        self.assertEqual([(p[3], p[4], p[0], p[1]) for p in path], [('n1', 'A', 0, 5), ('n1', 'C', 5, 8)])
+        self.assertEqual(path[0][5][1], 'run a2')
+        self.assertIsNone(path[1][5])
+
+    def test_prefers_same_node(self):
+        # A and B end at the same time, C on n2 waited for one of them
+        spans = [
+            tasklist('B', 'n2', 0, 4),
+            tasklist('A', 'n1', 0, 4),
+            tasklist('C', 'n2', 4, 6),
+        ]
+        path = critical_path(spans, 6)
+        self.assertEqual([(p[3], p[4]) for p in path], [('n2', 'B'), ('n2', 'C')])
+
+    def test_gap(self):
+        # A start delay shows as a gap between the tasklists
+        spans = [tasklist('A', 'n1', 0, 2), tasklist('B', 'n1', 10, 12)]
+        path = critical_path(spans, 12)
+        self.assertEqual([(p[4], p[0]) for p in path], [('A', 0), ('B', 10)])
+
+
+if __name__ == '__main__':
+    unittest.main()
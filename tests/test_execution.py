@@ -0,0 +1,158 @@
+import asyncio
+import unittest
+
+from src.dryrun import VirtualTimeLoop
+from src.gplmtlib import CLEANUP_COMMAND_MAX, CLEANUP_TASK, ExecutionContext, LoopSkew, cleanup_tasklists
+from src.trace import Tracer
+
+
+class StubNode:
+    def __init__(self, name):
+        self.name = name
+        self.finish = None
+        self.cancelled = False
+
+    async def run_tasklist(self, tasklist, var_env, stop_time):
+        self.finish = asyncio.get_running_loop().create_future()
+        try:
+            await self.finish
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+
+
+class StubTestbed:
+    def __init__(self, nodes):
+        self.nodes = dict((n.name, n) for n in nodes)
+        self.tracer = Tracer(enabled=False)
+        self.journal = None
+
+    def _resolve_target(self, target_name):
+        return [self.nodes[n] for n in target_name.split(' ')]
+
+
+class ExecutionContextTest(unittest.TestCase):
+    def test_cancel_pending_waits(self):
+        # Regression: cancel_pending returned before the tasks had
+        # finished cancelling
+        async def run():
+            nodes = [StubNode('a'), StubNode('b')]
+            ec = ExecutionContext(StubTestbed(nodes))
+            ec.schedule_tasklist('a b', None, background=False)
+            await asyncio.sleep(0)
+            await ec.cancel_pending()
+            self.assertTrue(all(n.cancelled for n in nodes))
+            self.assertEqual(ec.tasks, set())
+            self.assertEqual(ec.foreground, 0)
+            self.assertEqual(ec.node_pending, {})
+        asyncio.run(run())
+
+    def test_join_targets(self):
+        async def run():
+            a, b = StubNode('a'), StubNode('b')
+            ec = ExecutionContext(StubTestbed([a, b]))
+            ec.schedule_tasklist('a b', None, background=False)
+            await asyncio.sleep(0)
+            join = asyncio.ensure_future(ec.join([a]))
+            await asyncio.sleep(0)
+            self.assertFalse(join.done())
+            a.finish.set_result(None)
+            await asyncio.wait_for(join, 1)
+            self.assertEqual(ec.foreground, 1)
+            b.finish.set_result(None)
+            await asyncio.wait_for(ec.join(), 1)
+            self.assertEqual(ec.foreground, 0)
+        asyncio.run(run())
+
+    def test_join_ignores_background(self):
+        async def run():
+            a, b = StubNode('a'), StubNode('b')
+            ec = ExecutionContext(StubTestbed([a, b]))
+            ec.schedule_tasklist('a', None, background=False)
+            ec.schedule_tasklist('b', None, background=True)
+            await asyncio.sleep(0)
+            a.finish.set_result(None)
+            await asyncio.wait_for(ec.join(), 1)
+            self.assertFalse(b.finish.done())
+            await ec.cancel_pending()
+        asyncio.run(run())
+
+
+class CleanupTest(unittest.TestCase):
+    def commands(self, destinations):
+        commands = []
+        for tasklist in cleanup_tasklists(destinations):
+            run, = tasklist.body[0].children
+            self.assertEqual(run.name, CLEANUP_TASK)
+            commands.append(run.command)
+        return commands
+
+    def test_one_command(self):
+        self.assertEqual(self.commands(['a', 'b.txt']), ['rm a b.txt'])
+        self.assertEqual(self.commands([]), [])
+
+    def test_split(self):
+        destinations = ['file-%s' % ('x' * (i % 200 + 1),) for i in range(2000)]
+        commands = self.commands(destinations)
+        self.assertGreater(len(commands), 1)
+        for command in commands:
+            self.assertLessEqual(len(command), CLEANUP_COMMAND_MAX)
+            self.assertTrue(command.startswith('rm '))
+        # Every file is removed once, in order
+        removed = [d for command in commands for d in command.split(' ')[1:]]
+        self.assertEqual(removed, destinations)
+
+
+class LoopSkewTest(unittest.TestCase):
+    def simulate(self, durations, iterations, max_skew, fail=None):
+        """
+        Run 'iterations' iterations on nodes that take 'durations'
+        seconds of virtual time for one, and return their start times.
+        """
+        async def run():
+            loop = asyncio.get_running_loop()
+            skew = LoopSkew(list(durations), max_skew)
+            starts = dict((node, []) for node in durations)
+
+            async def node_iterations(node):
+                try:
+                    for x in range(iterations):
+                        await skew.wait(x)
+                        # No node is more than max_skew iterations ahead of the slowest
+                        if max_skew is not None:
+                            self.assertLessEqual(x - min(skew.finished.values()), max_skew)
+                        starts[node].append(loop.time())
+                        await asyncio.sleep(durations[node])
+                        if node == fail and x == 1:
+                            raise RuntimeError(node)
+                        skew.advance(node)
+                finally:
+                    skew.leave(node)
+            await asyncio.gather(*[node_iterations(n) for n in durations], return_exceptions=True)
+            return starts
+        loop = VirtualTimeLoop()
+        try:
+            return loop.run_until_complete(run())
+        finally:
+            loop.close()
+
+    def test_bound(self):
+        starts = self.simulate({'a': 1, 'b': 3}, 4, 1)
+        self.assertEqual(starts, {'a': [0, 1, 3, 6], 'b': [0, 3, 6, 9]})
+
+    def test_unbounded(self):
+        starts = self.simulate({'a': 1, 'b': 3}, 4, None)
+        self.assertEqual(starts, {'a': [0, 1, 2, 3], 'b': [0, 3, 6, 9]})
+
+    def test_zero_is_iteration_sync(self):
+        starts = self.simulate({'a': 1, 'b': 3, 'c': 2}, 4, 0)
+        self.assertEqual(starts, dict((n, [0, 3, 6, 9]) for n in 'abc'))
+
+    def test_leave(self):
+        # b fails in its second iteration, a doesn't wait for it any more
+        starts = self.simulate({'a': 1, 'b': 3}, 4, 0, fail='b')
+        self.assertEqual(starts, {'a': [0, 3, 6, 7], 'b': [0, 3]})
+
+
+if __name__ == '__main__':
+    unittest.main()
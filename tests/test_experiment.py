@@ -0,0 +1,352 @@
+"""
+Tests that run whole experiments with gplmt-light.py, on local targets
+and on ssh targets that are served by bench/fakessh/ssh.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from src.tasklog import LogReader
+
+TOP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GPLMT = os.path.join(TOP, 'gplmt-light.py')
+EXAMPLES = os.path.join(TOP, 'examples')
+FAKE_SSH_DIR = os.path.join(TOP, 'bench', 'fakessh')
+
+
+def run_gplmt(experiment, *args, env=None):
+    """Run 'experiment' and return the exit status and the output."""
+    argv = [sys.executable, GPLMT, experiment, '--batch', 'yes', '--no-compile-cache', '--output', 'raw']
+    proc = subprocess.run(argv + list(args), cwd=TOP, env=env, timeout=60,
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    return proc.returncode, proc.stdout.decode('utf-8', 'replace')
+
+
+def fake_ssh_env(directory):
+    """Environment in which ssh is bench/fakessh/ssh."""
+    home = os.path.join(directory, 'home')
+    os.makedirs(os.path.join(home, '.ssh'))
+    env = dict(os.environ)
+    # Control paths end up in the temporary home directory
+    env['HOME'] = home
+    env['PATH'] = FAKE_SSH_DIR + os.pathsep + env.get('PATH', '')
+    env['FAKE_SSH_LATENCY'] = '0'
+    env['FAKE_SSH_SETUP'] = '0'
+    return env
+
+
+def write_experiment(directory, tasklists, steps, targets='<target name="local" type="local"/>'):
+    filename = os.path.join(directory, 'experiment.xml')
+    with open(filename, 'w') as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n'
+                '<experiment>\n'
+                '  <targets>%s</targets>\n'
+                '  <tasklists>%s</tasklists>\n'
+                '  <steps>%s</steps>\n'
+                '</experiment>\n' % (targets, tasklists, steps))
+    return filename
+
+
+class CallTest(unittest.TestCase):
+    def test_call(self):
+        # Regression: 'call' passed too few arguments to run_tasklist
+        status, output = run_gplmt(os.path.join(EXAMPLES, 'call.xml'))
+        self.assertEqual(status, 0, output)
+        self.assertEqual(output.count("This is foo"), 2, output)
+        self.assertIn("Hello World", output)
+
+    def test_call_in_loop(self):
+        with tempfile.TemporaryDirectory() as d:
+            filename = write_experiment(
+                    d,
+                    '<tasklist name="inner"><seq><run>echo inner $i</run></seq></tasklist>'
+                    '<tasklist name="outer"><seq><call tasklist="inner"/></seq></tasklist>',
+                    '<loop list="1 2 3" param="i">'
+                    '<step tasklist="outer" targets="local"/><synchronize/></loop>')
+            status, output = run_gplmt(filename)
+        self.assertEqual(status, 0, output)
+        for i in (1, 2, 3):
+            self.assertIn("inner %d" % (i,), output)
+
+
+class CompileCacheTest(unittest.TestCase):
+    def test_export_env_from_environment(self):
+        # Regression: values of export-env from the environment were
+        # cached with the plan
+        with tempfile.TemporaryDirectory() as d:
+            filename = write_experiment(
+                    d,
+                    '<tasklist name="show"><seq><run>echo FOO is $FOO</run></seq></tasklist>',
+                    '<step tasklist="show" targets="local"><export-env var="FOO"/></step>')
+            cache = os.path.join(d, 'cache')
+            for value in ('first', 'second'):
+                env = dict(os.environ, FOO=value)
+                status, output = run_gplmt(filename, '--compile-cache', cache, env=env)
+                self.assertEqual(status, 0, output)
+                self.assertIn("FOO is %s" % (value,), output)
+            self.assertTrue(os.listdir(cache))
+
+    def test_unreadable_schema(self):
+        # Regression: a missing --rng file was reported as a missing
+        # experiment file
+        with tempfile.TemporaryDirectory() as d:
+            filename = write_experiment(d, '', '')
+            rng = os.path.join(d, 'missing.rng')
+            for cache in ([], ['--compile-cache', os.path.join(d, 'cache')]):
+                with self.subTest(cache=cache):
+                    status, output = run_gplmt(filename, '--rng', rng, *cache)
+                    self.assertNotEqual(status, 0, output)
+                    self.assertIn("Could not read schema file '%s'" % (rng,), output)
+                    self.assertNotIn("experiment file", output)
+
+
+class DryRunTest(unittest.TestCase):
+    def test_dry_run(self):
+        # Regression: the dry run testbed didn't take the includes
+        # when opening the journal
+        with tempfile.TemporaryDirectory() as d:
+            marker = os.path.join(d, 'marker')
+            filename = write_experiment(
+                    d,
+                    '<tasklist name="t"><seq><run>sleep 30</run><run>touch %s</run></seq></tasklist>' % (marker,),
+                    '<step tasklist="t" targets="local"/>')
+            status, output = run_gplmt(filename, '--dry', '--dry-default-duration', '2')
+            self.assertEqual(status, 0, output)
+            self.assertIn("predicted makespan: 32.000s", output)
+            self.assertFalse(os.path.exists(marker))
+
+
+class PerNodeLoopTest(unittest.TestCase):
+    TARGETS = ('<target name="a" type="local"><export-env var="NODE" value="a"/></target>'
+               '<target name="b" type="local"><export-env var="NODE" value="b"/></target>')
+
+    def run_loop(self, d, max_skew, *args):
+        """
+        Run a per-node loop of 4 iterations in which b is slow, and
+        return the lines that the tasks logged in order.
+        """
+        log = os.path.join(d, 'log')
+        filename = write_experiment(
+                d,
+                '<tasklist name="first"><seq><run>echo start $NODE $i &gt;&gt; %s; '
+                'if [ $NODE = b ]; then sleep 0.3; fi; echo end $NODE $i &gt;&gt; %s</run></seq></tasklist>'
+                '<tasklist name="second"><seq><run>echo second $NODE $i &gt;&gt; %s</run></seq></tasklist>'
+                % (log, log, log),
+                '<loop list="0 1 2 3" param="i" sync="per-node" max-skew="%d">'
+                '<step tasklist="first" targets="a b"/><synchronize/>'
+                '<step tasklist="second" targets="a b"/></loop>' % (max_skew,),
+                self.TARGETS)
+        status, output = run_gplmt(filename, *args)
+        self.assertEqual(status, 0, output)
+        with open(log) as f:
+            return [tuple(line.split()) for line in f]
+
+    def check_skew(self, lines, max_skew):
+        # A node starts iteration i only when the other one has finished
+        # iteration i - max_skew - 1
+        for index, (event, node, i) in enumerate(lines):
+            if event == 'start':
+                other = 'b' if node == 'a' else 'a'
+                finished = sum(1 for line in lines[:index] if line[:2] == ('second', other))
+                self.assertLessEqual(int(i) - finished, max_skew, lines)
+
+    def test_skew(self):
+        with tempfile.TemporaryDirectory() as d:
+            lines = self.run_loop(d, 1)
+        self.check_skew(lines, 1)
+        self.assertEqual(len(lines), 24)
+        # The synchronize only waits for the node itself, so a goes on
+        # while b still runs its first iteration
+        self.assertLess(lines.index(('second', 'a', '0')), lines.index(('end', 'b', '0')))
+        self.assertLess(lines.index(('start', 'a', '1')), lines.index(('end', 'b', '0')))
+
+    def test_zero_skew(self):
+        # Every iteration waits for all nodes, as with sync="iteration"
+        with tempfile.TemporaryDirectory() as d:
+            lines = self.run_loop(d, 0)
+        self.check_skew(lines, 0)
+        self.assertEqual(len(lines), 24)
+
+    def test_journal(self):
+        with tempfile.TemporaryDirectory() as d:
+            journal = os.path.join(d, 'journal')
+            self.run_loop(d, 1, '--journal', journal)
+            with open(journal) as f:
+                records = [json.loads(line) for line in f]
+            done = set((r['unit'], r['node']) for r in records if r['event'] == 'done')
+            self.assertEqual(done, set(('1/%d%s' % (i, step), node)
+                                       for i in range(4) for step in ('', '.1', '.3') for node in 'ab'))
+            # As if the control host crashed after a had finished and b
+            # had finished two iterations
+            with open(journal, 'w') as f:
+                for r in records:
+                    if r['event'] == 'end' or (r.get('node') == 'b' and r['unit'][2] in '23'):
+                        continue
+                    f.write(json.dumps(r) + '\n')
+            os.remove(os.path.join(d, 'log'))
+            lines = self.run_loop(d, 1, '--journal', journal, '--resume')
+        self.assertEqual(sorted(lines), sorted((event, 'b', i) for event in ('start', 'end', 'second') for i in '23'))
+
+
+class ResumeTest(unittest.TestCase):
+    def test_resume(self):
+        with tempfile.TemporaryDirectory() as d:
+            marker = os.path.join(d, 'marker')
+            filename = write_experiment(
+                    d,
+                    '<tasklist name="first"><seq><run>echo first &gt;&gt; %s</run></seq></tasklist>'
+                    '<tasklist name="second"><seq><run>echo second &gt;&gt; %s</run></seq></tasklist>' % (marker, marker),
+                    '<step tasklist="first" targets="local"/><synchronize/>'
+                    '<step tasklist="second" targets="local"/>')
+            journal = os.path.join(d, 'journal')
+            status, output = run_gplmt(filename, '--journal', journal)
+            self.assertEqual(status, 0, output)
+            status, output = run_gplmt(filename, '--journal', journal, '--resume')
+            self.assertIn("Experiment has finished already", output)
+
+            # As if the control host crashed while the second step ran
+            with open(journal) as f:
+                records = [json.loads(line) for line in f]
+            last = max(r['unit'] for r in records if r['event'] == 'done')
+            with open(journal, 'w') as f:
+                for r in records:
+                    if r['event'] == 'end' or r.get('unit') == last:
+                        continue
+                    f.write(json.dumps(r) + '\n')
+            status, output = run_gplmt(filename, '--journal', journal, '--resume')
+            self.assertEqual(status, 0, output)
+            with open(marker) as f:
+                self.assertEqual(f.read().split(), ['first', 'second', 'second'])
+
+    def test_timeout_journaled(self):
+        # Regression: a tasklist that timed out was journaled as 'ok'
+        with tempfile.TemporaryDirectory() as d:
+            filename = write_experiment(
+                    d,
+                    '<tasklist name="slow" timeout="PT0.2S"><seq><run>sleep 10</run></seq></tasklist>',
+                    '<step tasklist="slow" targets="local"/>')
+            journal = os.path.join(d, 'journal')
+            status, output = run_gplmt(filename, '--journal', journal)
+            self.assertEqual(status, 0, output)
+            with open(journal) as f:
+                done = [json.loads(line) for line in f if '"done"' in line]
+            self.assertEqual([r['outcome'] for r in done], ['timeout'])
+
+    def test_include_changed(self):
+        # Regression: the journal only covered the experiment file, so a
+        # changed include was resumed as the same experiment
+        with tempfile.TemporaryDirectory() as d:
+            library = os.path.join(d, 'library.xml')
+
+            def write_library(text):
+                with open(library, 'w') as f:
+                    f.write('<experiment><targets/><tasklists>'
+                            '<tasklist name="hello"><seq><run>echo %s</run></seq></tasklist>'
+                            '</tasklists><steps/></experiment>' % (text,))
+            write_library('one')
+            filename = write_experiment(d, '', '<step tasklist="lib.hello" targets="local"/>')
+            with open(filename) as f:
+                text = f.read()
+            with open(filename, 'w') as f:
+                f.write(text.replace('<experiment>\n', '<experiment>\n<include file="library.xml" prefix="lib"/>\n'))
+            journal = os.path.join(d, 'journal')
+            for cache in ([], ['--compile-cache', os.path.join(d, 'cache')]):
+                with self.subTest(cache=cache):
+                    write_library('one')
+                    status, output = run_gplmt(filename, '--journal', journal, *cache)
+                    self.assertEqual(status, 0, output)
+                    # Make it resumable
+                    with open(journal) as f:
+                        lines = [line for line in f if '"end"' not in line]
+                    with open(journal, 'w') as f:
+                        f.writelines(lines)
+                    write_library('two')
+                    status, output = run_gplmt(filename, '--journal', journal, '--resume', *cache)
+                    self.assertIn("is of a different experiment", output)
+
+
+class SSHTest(unittest.TestCase):
+    def test_ssh_parallelism(self):
+        # Regression: --ssh-parallelism was parsed as a string
+        targets = ''.join('<target name="n%d" type="ssh"><user>u</user><host>n%d.test</host></target>' % (i, i)
+                          for i in range(6))
+        targets += '<target name="all" type="group">%s</target>' % (
+                ''.join('<target ref="n%d"/>' % (i,) for i in range(6)),)
+        with tempfile.TemporaryDirectory() as d:
+            filename = write_experiment(
+                    d,
+                    '<tasklist name="w"><seq><run>echo ran</run></seq></tasklist>',
+                    '<step tasklist="w" targets="all"/>',
+                    targets)
+            env = fake_ssh_env(d)
+            for adaptive in ([], ['--ssh-parallelism-adaptive']):
+                with self.subTest(adaptive=adaptive):
+                    logroot = os.path.join(d, 'logs%d' % (len(adaptive),))
+                    status, output = run_gplmt(filename, '--ssh-parallelism', '2', '--logroot-dir', logroot,
+                                               *adaptive, env=env)
+                    self.assertEqual(status, 0, output)
+                    with open(os.path.join(logroot, 'stats.json')) as f:
+                        stats = json.load(f)['ssh_concurrency']
+                    if adaptive:
+                        self.assertLessEqual(stats['minimum'], 2)
+                    else:
+                        self.assertEqual(stats['limit'], 2)
+                        self.assertLessEqual(stats['peak_in_use'], 2)
+
+    def test_teardown_chains(self):
+        # Per node, the registered teardowns run before the copied files
+        # are removed, and every file is removed once
+        targets = ''.join('<target name="%s" type="ssh"><export-env var="FILE" value="%s"/>'
+                          '<user>u</user><host>%s.test</host></target>' % (n, f, n)
+                          for n, f in (('n1', 'alpha'), ('n2', 'beta')))
+        targets += '<target name="all" type="group"><target ref="n1"/><target ref="n2"/></target>'
+        with tempfile.TemporaryDirectory() as d:
+            env = fake_ssh_env(d)
+            source = os.path.join(d, 'source')
+            with open(source, 'w') as f:
+                f.write('payload\n')
+            marker = os.path.join(d, 'marker')
+            put = '<put><source>%s</source><destination>%%s</destination></put>' % (source,)
+            filename = write_experiment(
+                    d,
+                    '<tasklist name="put-alpha"><seq>%s%s</seq></tasklist>' % (put % 'alpha', put % 'alpha') +
+                    '<tasklist name="put-beta"><seq>%s</seq></tasklist>' % (put % 'beta',) +
+                    '<tasklist name="check"><seq><run>test -e $FILE &amp;&amp; echo $FILE &gt;&gt; %s</run></seq></tasklist>'
+                    % (marker,),
+                    '<step tasklist="put-alpha" targets="n1"/><step tasklist="put-beta" targets="n2"/>'
+                    '<synchronize/><register-teardown tasklist="check" targets="all"/>',
+                    targets)
+            journal = os.path.join(d, 'journal')
+            status, output = run_gplmt(filename, '--journal', journal, env=env)
+            self.assertEqual(status, 0, output)
+            # The files were still there when the teardowns ran
+            with open(marker) as f:
+                self.assertEqual(sorted(f.read().split()), ['alpha', 'beta'])
+            self.assertEqual(os.listdir(env['HOME']), ['.ssh'])
+            with open(journal) as f:
+                removals = [(r['targets'], r['remove']) for r in map(json.loads, f) if 'remove' in r]
+            self.assertEqual(sorted(removals), [('n1', 'alpha'), ('n2', 'beta')])
+
+    def test_unreachable_not_killed(self):
+        # Regression: runs on nodes we couldn't connect to were
+        # recorded as killed
+        with tempfile.TemporaryDirectory() as d:
+            filename = write_experiment(
+                    d,
+                    '<tasklist name="w"><seq><run>echo hello</run></seq></tasklist>',
+                    '<step tasklist="w" targets="n"/>',
+                    '<target name="n" type="ssh"><user>u</user><host>unreachable.test</host></target>')
+            logroot = os.path.join(d, 'logs')
+            status, output = run_gplmt(filename, '--ssh-master-retries', '0', '--logroot-dir', logroot,
+                                       env=fake_ssh_env(d))
+            self.assertEqual(status, 0, output)
+            reader = LogReader(os.path.join(logroot, 'n'))
+            self.assertEqual(reader.status('_anon0', 0), 'not started')
+
+
+if __name__ == '__main__':
+    unittest.main()
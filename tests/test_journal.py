@@ -0,0 +1,92 @@
+import json
+import os
+import tempfile
+import unittest
+
+from src.error import ExperimentSetupError
+from src.journal import Journal
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmp.name, 'journal')
+        self.experiment = os.path.join(self.tmp.name, 'experiment.xml')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def records(self):
+        with open(self.filename) as f:
+            return [json.loads(line) for line in f]
+
+    def test_resume_skips_done(self):
+        j = Journal(self.filename)
+        j.open(self.experiment, 'abc')
+        j.done('0', 'n1', 'ok')
+        j.done('1/0')
+        j.teardown({'tasklist': 'td', 'targets': 'n1', 'env': {}, 'unit': '0'})
+        j.close()
+
+        j = Journal(self.filename)
+        j.open(self.experiment, 'abc', resume=True)
+        self.assertTrue(j.is_done('0', 'n1'))
+        self.assertFalse(j.is_done('0', 'n2'))
+        self.assertFalse(j.is_done('0'))
+        self.assertTrue(j.is_done('1/0'))
+        self.assertFalse(j.is_done('1/1'))
+        self.assertEqual([t['tasklist'] for t in j.teardowns], ['td'])
+        j.close()
+        self.assertEqual([r['event'] for r in self.records()],
+                         ['begin', 'done', 'done', 'teardown', 'resume'])
+
+    def test_new_journal_overwrites(self):
+        j = Journal(self.filename)
+        j.open(self.experiment, 'abc')
+        j.done('0', 'n1', 'ok')
+        j.close()
+        j = Journal(self.filename)
+        j.open(self.experiment, 'abc')
+        j.close()
+        self.assertEqual([r['event'] for r in self.records()], ['begin'])
+
+    def test_other_experiment(self):
+        j = Journal(self.filename)
+        j.open(self.experiment, 'abc')
+        j.close()
+        with self.assertRaises(ExperimentSetupError):
+            Journal(self.filename).open(self.experiment, 'def', resume=True)
+
+    def test_ended(self):
+        j = Journal(self.filename)
+        j.open(self.experiment, 'abc')
+        j.end()
+        j.close()
+        with self.assertRaises(ExperimentSetupError):
+            Journal(self.filename).open(self.experiment, 'abc', resume=True)
+
+    def test_missing(self):
+        with self.assertRaises(ExperimentSetupError):
+            Journal(self.filename).open(self.experiment, 'abc', resume=True)
+
+    def test_cut_off_record(self):
+        j = Journal(self.filename)
+        j.open(self.experiment, 'abc')
+        j.done('0', 'n1', 'ok')
+        j.close()
+        with open(self.filename, 'a') as f:
+            f.write('{"event": "done", "unit": "1", "no')
+        j = Journal(self.filename)
+        with self.assertLogs(level='WARNING'):
+            j.open(self.experiment, 'abc', resume=True)
+        j.close()
+        self.assertTrue(j.is_done('0', 'n1'))
+        self.assertFalse(j.is_done('1', 'n1'))
+        # The records after the one that was cut off can be read
+        with open(self.filename) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(json.loads(lines[-1])['event'], 'resume')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import asyncio
+import threading
+import unittest
+from unittest import mock
+
+from src import output
+from src.output import OutputMux, fold_names
+
+
+class Terminal:
+    """Stands in for the terminal, optionally blocking the writer thread."""
+    def __init__(self):
+        self.items = []
+        self.unblocked = threading.Event()
+        self.unblocked.set()
+
+    def write(self, items):
+        self.unblocked.wait(10)
+        self.items.extend(items)
+
+    def text(self, stream='out'):
+        return b''.join(data for s, data in self.items if s == stream).decode('utf-8')
+
+
+def run_with_terminal(coro_fn):
+    terminal = Terminal()
+    with mock.patch.object(output, '_write_terminal', terminal.write):
+        asyncio.run(coro_fn(terminal))
+    return terminal
+
+
+class FoldNamesTest(unittest.TestCase):
+    def test_fold(self):
+        self.assertEqual(fold_names(['pl1', 'pl2', 'pl3', 'pl7', 'local']), 'pl[1-3,7],local')
+        self.assertEqual(fold_names(['n01', 'n1']), 'n01,n1')
+
+
+class OutputMuxTest(unittest.TestCase):
+    def test_prefix(self):
+        async def run(terminal):
+            mux = OutputMux()
+            record = mux.begin('n1', 'hello')
+            record.write('out', b'one\ntw')
+            record.write('out', b'o\n')
+            record.write('err', b'no newline')
+            record.status = 0
+            record.close()
+            await mux.close()
+        terminal = run_with_terminal(run)
+        self.assertEqual(terminal.text('out'), 'n1 hello: one\nn1 hello: two\n== summary\nhello: 1 runs, status 0: 1\n')
+        self.assertEqual(terminal.text('err'), 'n1 hello: no newline\n')
+
+    def test_collapse(self):
+        async def run(terminal):
+            mux = OutputMux(collapse=True, interval=60)
+            for name, data, status in (('n1', b'same\n', 0), ('n2', b'same\n', 0),
+                                       ('n3', b'different\n', 1), ('n4', b'same\n', None)):
+                record = mux.begin(name, 'task')
+                record.write('out', data)
+                record.status = status
+                record.close()
+            await mux.close()
+        terminal = run_with_terminal(run)
+        text = terminal.text()
+        self.assertIn('n[1-2,4] (task)\n', text)
+        self.assertIn('n3 (task)\n', text)
+        self.assertEqual(text.count('same\n'), 1)
+        self.assertIn('task: 4 runs, status 0: 2, status 1: n3, status killed: n4', text)
+
+    def test_collapse_too_much_output(self):
+        async def run(terminal):
+            mux = OutputMux(collapse=True, interval=60, max_output=4)
+            record = mux.begin('n1', 'task')
+            record.write('out', b'0123456789')
+            self.assertTrue(record.direct)
+            record.write('out', b'tail')
+            record.close()
+            await mux.close()
+        terminal = run_with_terminal(run)
+        self.assertIn('0123456789\n', terminal.text())
+        self.assertIn('tail\n', terminal.text())
+
+    def test_backpressure(self):
+        async def run(terminal):
+            terminal.unblocked.clear()
+            mux = OutputMux(high_water=10)
+            record = mux.begin('n1', 'task')
+            record.write('out', b'first line\n')
+            drain = asyncio.ensure_future(record.drain())
+            await asyncio.sleep(0.05)
+            # The terminal doesn't take anything, so the reader has to wait
+            self.assertFalse(drain.done())
+            terminal.unblocked.set()
+            await asyncio.wait_for(drain, 5)
+            record.close()
+            await mux.close()
+        terminal = run_with_terminal(run)
+        self.assertIn('n1 task: first line\n', terminal.text())
+
+
+if __name__ == '__main__':
+    unittest.main()
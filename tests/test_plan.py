@@ -0,0 +1,73 @@
+import os
+import tempfile
+import unittest
+
+import lxml.etree
+
+from src.error import ExperimentSyntaxError
+from src.gplmtlib import process_includes
+from src.plan import compile_experiment
+
+BROKEN = '<tasklist name="%s"><seq><call/></seq></tasklist>'
+
+
+def parse(text):
+    return lxml.etree.ElementTree(lxml.etree.fromstring(text))
+
+
+def library(*tasklists):
+    return dict((t.get('name'), t) for t in (lxml.etree.fromstring(x) for x in tasklists))
+
+
+def experiment(tasklists, steps):
+    return parse('<experiment><targets/><tasklists>%s</tasklists><steps>%s</steps></experiment>'
+                 % (tasklists, steps))
+
+
+class LazyLibraryTest(unittest.TestCase):
+    def test_used_and_unused(self):
+        lib = library(
+                '<tasklist name="lib.used"><seq><call tasklist="lib.helper"/></seq></tasklist>',
+                '<tasklist name="lib.helper"><seq><run>echo helper</run></seq></tasklist>',
+                BROKEN % ('lib.unused',))
+        plan = compile_experiment(experiment('', '<step tasklist="lib.used" targets="local"/>'), lib)
+        # Only what the steps reach is compiled, the broken
+        # tasklist that nobody uses doesn't matter
+        self.assertEqual(set(plan.tasklists), {'lib.used', 'lib.helper'})
+        used = plan.tasklists['lib.used']
+        self.assertIs(used.body[0].children[0].tasklist, plan.tasklists['lib.helper'])
+        self.assertIs(plan.steps[0].tasklist, used)
+
+    def test_used_broken(self):
+        lib = library(BROKEN % ('lib.broken',))
+        with self.assertRaises(ExperimentSyntaxError):
+            compile_experiment(experiment('', '<step tasklist="lib.broken" targets="local"/>'), lib)
+
+    def test_own_tasklists_always_compiled(self):
+        with self.assertRaises(ExperimentSyntaxError):
+            compile_experiment(experiment(BROKEN % ('mine',), ''), {})
+
+    def test_recursive(self):
+        lib = library('<tasklist name="lib.again"><seq><call tasklist="lib.again"/></seq></tasklist>')
+        plan = compile_experiment(experiment('', '<step tasklist="lib.again" targets="local"/>'), lib)
+        again = plan.tasklists['lib.again']
+        self.assertIs(again.body[0].children[0].tasklist, again)
+
+    def test_include(self):
+        with tempfile.TemporaryDirectory() as d:
+            with open(os.path.join(d, 'lib.xml'), 'w') as f:
+                f.write('<experiment><targets/><tasklists>'
+                        '<tasklist name="used"><seq><run>echo used</run></seq></tasklist>'
+                        + BROKEN % ('unused',) +
+                        '</tasklists><steps/></experiment>')
+            filename = os.path.join(d, 'experiment.xml')
+            doc = experiment('', '<step tasklist="l.used" targets="local"/>')
+            doc.getroot().insert(0, lxml.etree.fromstring('<include file="lib.xml" prefix="l"/>'))
+            lib = process_includes(doc, filename)
+        self.assertEqual(set(lib), {'l.used', 'l.unused'})
+        plan = compile_experiment(doc, lib)
+        self.assertEqual(set(plan.tasklists), {'l.used'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import asyncio
+import json
+import tempfile
+import time
+import unittest
+
+from bench.plcapi import PASSWORD, FakePLCAPI
+from src import planetlab
+from src.error import ExperimentSetupError
+from src.planetlab import SliceCache, discover, is_alive
+
+AUTH = {'Username': 'test', 'AuthString': PASSWORD, 'AuthMethod': 'password'}
+
+
+class DiscoverTest(unittest.TestCase):
+    def setUp(self):
+        self.api = FakePLCAPI(2, 5, dead=0)
+        self.server = self.api.serve()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:%d/' % (self.server.server_address[1],)
+        self.slices = [(self.url, 'slice0'), (self.url, 'slice1')]
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.cache = SliceCache(tmp.name, ttl=3600)
+        # indexes of the slices that were fetched from the API
+        self.fetched = []
+
+    def get_auth(self, i):
+        self.fetched.append(i)
+        return AUTH
+
+    def discover(self, offline=False):
+        return asyncio.run(discover(self.slices, self.cache, offline, self.get_auth))
+
+    def age(self, slicename, seconds):
+        path = self.cache._path(self.url, slicename)
+        with open(path) as f:
+            cached = json.load(f)
+        cached['time'] -= seconds
+        with open(path, 'w') as f:
+            json.dump(cached, f)
+
+    def test_fetch(self):
+        results = self.discover()
+        self.assertEqual(self.fetched, [0, 1])
+        self.assertEqual([n['hostname'] for n in results[1]],
+                         ['node%d.slice1.example.org' % (i,) for i in range(5)])
+        self.assertEqual(set(results[0][0]), set(planetlab.NODE_FIELDS))
+
+    def test_fresh_and_stale(self):
+        first = self.discover()
+        self.age('slice1', 7200)
+        del self.fetched[:]
+        second = self.discover()
+        # slice0 is fresh and comes from the cache, slice1 is stale
+        self.assertEqual(self.fetched, [1])
+        self.assertEqual(first, second)
+        # and is fresh again
+        del self.fetched[:]
+        self.discover()
+        self.assertEqual(self.fetched, [])
+
+    def test_offline(self):
+        first = self.discover()
+        self.age('slice0', 30 * 86400)
+        del self.fetched[:]
+        self.server.shutdown()
+        # Cached node lists are used however old they are
+        self.assertEqual(self.discover(offline=True), first)
+        self.assertEqual(self.fetched, [])
+
+    def test_offline_without_cache(self):
+        with self.assertRaises(ExperimentSetupError):
+            self.discover(offline=True)
+        self.assertEqual(self.fetched, [])
+
+    def test_broken_cache(self):
+        self.discover()
+        with open(self.cache._path(self.url, 'slice0'), 'w') as f:
+            f.write('{')
+        del self.fetched[:]
+        with self.assertLogs(level='WARNING'):
+            self.discover()
+        self.assertEqual(self.fetched, [0])
+
+
+class IsAliveTest(unittest.TestCase):
+    def test_dead_nodes(self):
+        now = time.time()
+        up = {'hostname': 'up', 'boot_state': 'boot', 'run_level': 'boot', 'last_contact': now - 60}
+        self.assertTrue(is_alive(up, 3600, now))
+        self.assertFalse(is_alive(dict(up, boot_state='safeboot'), 3600, now))
+        self.assertFalse(is_alive(dict(up, run_level='safeboot'), 3600, now))
+        self.assertFalse(is_alive(dict(up, last_contact=now - 7200), 3600, now))
+        self.assertFalse(is_alive(dict(up, last_contact=None), 3600, now))
+        # Without a maximum age, only the boot state counts
+        self.assertTrue(is_alive(dict(up, last_contact=None), None, now))
+        # Older PLC versions don't report a run level
+        self.assertTrue(is_alive(dict(up, run_level=None), 3600, now))
+
+    def test_filter_fake_slice(self):
+        api = FakePLCAPI(1, 200, dead=0.2, seed=1)
+        nodes = [api.nodes[i] for i in api.slices['slice0']]
+        now = time.time()
+        alive = [n for n in nodes if is_alive(n, 3600, now)]
+        dead = [n for n in nodes if not is_alive(n, 3600, now)]
+        self.assertTrue(alive and dead)
+        for n in dead:
+            self.assertTrue(n['boot_state'] != 'boot' or now - n['last_contact'] > 3600)
+
+
+if __name__ == '__main__':
+    unittest.main()
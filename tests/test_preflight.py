@@ -0,0 +1,61 @@
+import asyncio
+import unittest
+
+from src import preflight
+from src.error import ExperimentSetupError
+
+
+class Node:
+    def __init__(self, name):
+        self.name = name
+
+
+class PolicyTest(unittest.TestCase):
+    def test_policy(self):
+        self.assertEqual(preflight.policy('fail'), 'fail')
+        self.assertEqual(preflight.policy('skip'), 'skip')
+        self.assertEqual(preflight.policy('80%'), 0.8)
+        for s in ('80', '120%', 'never'):
+            with self.assertRaises(ValueError):
+                preflight.policy(s)
+
+
+class CheckNodesTest(unittest.TestCase):
+    def test_deadline_after_own_limits(self):
+        # Regression: waiting for our own connection rate limits counted
+        # against the deadline, and healthy nodes were quarantined
+        async def check(node, bounded):
+            await asyncio.sleep(0.1 * int(node.name))
+            return await bounded(asyncio.sleep(0.01))
+        nodes = [Node(str(i)) for i in range(5)]
+        failed = asyncio.run(preflight.check_nodes(nodes, check, 0.05))
+        self.assertEqual(failed, {})
+
+    def test_reasons(self):
+        async def check(node, bounded):
+            if node.name == 'slow':
+                await bounded(asyncio.sleep(10))
+            if node.name == 'broken':
+                raise RuntimeError("boom")
+            if node.name == 'down':
+                return "TCP connect to port 22 failed"
+            return None
+        nodes = [Node(n) for n in ('ok', 'slow', 'broken', 'down')]
+        failed = asyncio.run(preflight.check_nodes(nodes, check, 0.05))
+        self.assertEqual(set(failed), {'slow', 'broken', 'down'})
+        self.assertEqual(failed['slow'], "not ready after 0.05s")
+        self.assertIn("boom", failed['broken'])
+        self.assertEqual(failed['down'], "TCP connect to port 22 failed")
+
+    def test_apply_policy(self):
+        preflight.apply_policy('fail', 3, {})
+        preflight.apply_policy('skip', 3, {'a': 'x', 'b': 'x'})
+        preflight.apply_policy(0.5, 4, {'a': 'x', 'b': 'x'})
+        with self.assertRaises(ExperimentSetupError):
+            preflight.apply_policy('fail', 3, {'a': 'x'})
+        with self.assertRaises(ExperimentSetupError):
+            preflight.apply_policy(0.8, 4, {'a': 'x'})
+
+
+if __name__ == '__main__':
+    unittest.main()
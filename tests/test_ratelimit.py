@@ -0,0 +1,110 @@
+import asyncio
+import unittest
+
+from src.ratelimit import AdaptiveLimiter, ConnectionScheduler, subnet_key
+
+
+class SubnetKeyTest(unittest.TestCase):
+    def test_ipv4(self):
+        self.assertEqual(subnet_key('10.1.2.3'), '10.1.2.0/24')
+        self.assertEqual(subnet_key('10.1.2.3', 16), '10.1.0.0/16')
+
+    def test_host_name(self):
+        self.assertEqual(subnet_key('node1.lab.example.org'), 'lab.example.org')
+        self.assertEqual(subnet_key('localhost'), 'localhost')
+
+
+class ConnectionSchedulerTest(unittest.TestCase):
+    def test_no_subnet_limit(self):
+        # Without a subnet rate, a cluster in one subnet gets the global rate
+        sched = ConnectionScheduler(rate=100, burst=1)
+        starts = [sched.reserve('10.0.0.%d' % (i,), 0.0) for i in range(1, 11)]
+        self.assertAlmostEqual(starts[-1], 0.09)
+
+    def test_subnet_limit(self):
+        sched = ConnectionScheduler(subnet_rate=2, subnet_burst=1)
+        starts = [sched.reserve('10.0.0.%d' % (i,), 0.0) for i in range(1, 4)]
+        self.assertEqual(starts, [0.0, 0.5, 1.0])
+        # Another subnet is not affected
+        self.assertEqual(sched.reserve('10.0.1.1', 0.0), 0.0)
+
+    def test_cancelled_wait(self):
+        # A connection that waited for the rate limit and was cancelled
+        # doesn't push back later connections
+        async def run():
+            sched = ConnectionScheduler(rate=10, burst=1)
+            await sched.acquire('a')
+            waiter = asyncio.ensure_future(sched.acquire('b'))
+            await asyncio.sleep(0)
+            waiter.cancel()
+            await asyncio.wait([waiter])
+            now = asyncio.get_running_loop().time()
+            self.assertLessEqual(sched.reserve('c', now) - now, 0.1 + 1e-3)
+        asyncio.run(run())
+
+
+class AdaptiveLimiterTest(unittest.TestCase):
+    def test_limit(self):
+        async def run():
+            lim = AdaptiveLimiter(2)
+            await lim.acquire()
+            await lim.acquire()
+            waiter = asyncio.ensure_future(lim.acquire())
+            await asyncio.sleep(0)
+            self.assertFalse(waiter.done())
+            lim.release()
+            await waiter
+            self.assertEqual(lim.in_use, 2)
+            self.assertEqual(lim.peak, 2)
+        asyncio.run(run())
+
+    def test_cancel_after_wake(self):
+        # Regression: a waiter that was cancelled, and then dropped by
+        # _wake() before it ran, tried to remove itself from the waiters
+        async def run():
+            lim = AdaptiveLimiter(1)
+            await lim.acquire()
+            cancelled = asyncio.ensure_future(lim.acquire())
+            granted = asyncio.ensure_future(lim.acquire())
+            await asyncio.sleep(0)
+            cancelled.cancel()
+            lim.release()
+            await asyncio.wait([cancelled, granted])
+            self.assertTrue(cancelled.cancelled())
+            self.assertIsNone(granted.result())
+            self.assertEqual(lim.in_use, 1)
+            self.assertEqual(len(lim.waiters), 0)
+            lim.release()
+            self.assertEqual(lim.in_use, 0)
+        asyncio.run(run())
+
+    def test_cancel_after_grant(self):
+        # Granted, but cancelled before it could run: the slot goes back
+        async def run():
+            lim = AdaptiveLimiter(1)
+            await lim.acquire()
+            waiter = asyncio.ensure_future(lim.acquire())
+            await asyncio.sleep(0)
+            lim.release()
+            waiter.cancel()
+            await asyncio.wait([waiter])
+            self.assertTrue(waiter.cancelled())
+            self.assertEqual(lim.in_use, 0)
+        asyncio.run(run())
+
+    def test_cancel_waiting(self):
+        async def run():
+            lim = AdaptiveLimiter(1)
+            await lim.acquire()
+            waiter = asyncio.ensure_future(lim.acquire())
+            await asyncio.sleep(0)
+            waiter.cancel()
+            await asyncio.wait([waiter])
+            self.assertEqual(len(lim.waiters), 0)
+            lim.release()
+            self.assertEqual(lim.in_use, 0)
+        asyncio.run(run())
+
+
+if __name__ == '__main__':
+    unittest.main()
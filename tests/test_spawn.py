@@ -0,0 +1,87 @@
+import asyncio
+import os
+import subprocess
+import unittest
+
+from src.error import ExperimentExecutionError
+from src.output import pump_output
+from src.spawn import SpawnPool
+
+
+class Record:
+    def __init__(self):
+        self.data = {'out': b'', 'err': b''}
+
+    def write(self, stream, data):
+        self.data[stream] += data
+
+    async def drain(self):
+        pass
+
+
+async def run_command(pool, command, env=None):
+    proc = await pool.create_subprocess_shell(
+            command, env or {}, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    record = Record()
+    await pump_output(proc, record)
+    return proc, await proc.wait(), record.data
+
+
+class SpawnPoolTest(unittest.TestCase):
+    def test_round_trip(self):
+        async def run():
+            pool = SpawnPool(2)
+            try:
+                proc, status, data = await run_command(
+                        pool, 'echo "$GREETING"; echo oops >&2; ps -o pgid= -p $$; exit 3',
+                        {'GREETING': 'hello', 'PATH': os.environ['PATH']})
+            finally:
+                pool.close()
+            self.assertEqual(status, 3)
+            self.assertEqual(proc.returncode, 3)
+            out = data['out'].decode().split('\n')
+            self.assertEqual(out[0], 'hello')
+            # The command runs in a session of its own
+            self.assertEqual(int(out[1]), proc.pid)
+            self.assertEqual(data['err'], b'oops\n')
+        asyncio.run(run())
+
+    def test_signal(self):
+        async def run():
+            pool = SpawnPool(1)
+            try:
+                proc, status, data = await run_command(pool, 'kill -TERM $$')
+            finally:
+                pool.close()
+            self.assertEqual(status, -15)
+        asyncio.run(run())
+
+    def test_many(self):
+        async def run():
+            pool = SpawnPool(3)
+            try:
+                results = await asyncio.gather(*[run_command(pool, 'echo %d' % (i,)) for i in range(30)])
+                self.assertEqual(len(pool.workers), 3)
+            finally:
+                pool.close()
+            self.assertEqual([data['out'] for proc, status, data in results],
+                             [b'%d\n' % (i,) for i in range(30)])
+            self.assertTrue(all(status == 0 for proc, status, data in results))
+        asyncio.run(run())
+
+    def test_worker_died(self):
+        async def run():
+            pool = SpawnPool(1)
+            try:
+                proc = await pool.create_subprocess_shell('sleep 10', {})
+                pool.workers[0].proc.kill()
+                with self.assertRaises(ExperimentExecutionError):
+                    await asyncio.wait_for(proc.wait(), 10)
+                os.kill(proc.pid, 9)
+            finally:
+                pool.close()
+        asyncio.run(run())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,261 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+import lxml.etree
+
+from src.dryrun import VirtualTimeLoop
+from src.error import ExperimentExecutionError
+import src.gplmtlib as gplmtlib
+from src.preflight import Deadline
+from src.ratelimit import AdaptiveLimiter, ConnectionScheduler
+from src.sshpool import MasterPool
+from src.trace import Tracer
+
+
+class FlakyNode:
+    """A node whose master connection fails the first 'failures' times."""
+    def __init__(self, directory, failures):
+        self.name = 'flaky'
+        self.host = 'flaky'
+        self.directory = directory
+        self.counter = os.path.join(directory, 'attempts')
+        self.failures = failures
+
+    def get_control_path(self):
+        return os.path.join(self.directory, 'control')
+
+    def master_command(self):
+        script = ('echo attempt >> "$1"; echo "connection refused" >&2; '
+                  '[ $(wc -l < "$1") -gt %d ]' % (self.failures,))
+        return ['sh', '-c', script, 'sh', self.counter]
+
+    def control_command(self, op):
+        return ['false']
+
+    def attempts(self):
+        with open(self.counter) as f:
+            return len(f.readlines())
+
+
+class StubTestbed:
+    ensure_master = gplmtlib.Testbed.ensure_master
+    ssh_acquire = gplmtlib.Testbed.ssh_acquire
+    ssh_release = gplmtlib.Testbed.ssh_release
+
+    def __init__(self, pool):
+        self.master_pool = pool
+        self.ssh_limiter = AdaptiveLimiter(1)
+        self.ssh_scheduler = ConnectionScheduler()
+        self.ssh_reached = set()
+        self.tracer = Tracer(enabled=False)
+
+
+class MasterPoolTest(unittest.TestCase):
+    def test_backoff(self):
+        async def run():
+            delays = []
+
+            async def pause(delay):
+                delays.append(delay)
+            with tempfile.TemporaryDirectory() as d:
+                node = FlakyNode(d, 2)
+                pool = MasterPool(retries=3, backoff=1.0)
+                with self.assertLogs(level='WARNING') as logs:
+                    await pool.ensure(node, pause)
+                self.assertEqual(node.attempts(), 3)
+            self.assertEqual(delays, [1.0, 2.0])
+            self.assertTrue(pool.is_alive(node))
+            # The master's error output is logged, not passed to our terminal
+            self.assertTrue(any("connection refused" in line for line in logs.output))
+        asyncio.run(run())
+
+    def test_give_up(self):
+        async def run():
+            async def pause(delay):
+                pass
+            with tempfile.TemporaryDirectory() as d:
+                node = FlakyNode(d, 10)
+                pool = MasterPool(retries=2)
+                with self.assertLogs(level='WARNING'):
+                    with self.assertRaises(ExperimentExecutionError):
+                        await pool.ensure(node, pause)
+                self.assertEqual(node.attempts(), 3)
+            self.assertFalse(pool.is_alive(node))
+        asyncio.run(run())
+
+    def test_slot_free_during_backoff(self):
+        # Regression: the backoff between attempts held the ssh slot,
+        # so other nodes couldn't connect in the meantime
+        async def run():
+            with tempfile.TemporaryDirectory() as d:
+                node = FlakyNode(d, 1)
+                testbed = StubTestbed(MasterPool(retries=1, backoff=0.2))
+                await testbed.ssh_acquire(node)
+
+                async def connect_other():
+                    await asyncio.sleep(0.1)
+                    await testbed.ssh_limiter.acquire()
+                    testbed.ssh_limiter.release()
+                other = asyncio.ensure_future(connect_other())
+                with self.assertLogs(level='WARNING'):
+                    await testbed.ensure_master(node)
+                # The other node got the slot while we were backing off
+                self.assertTrue(other.done())
+                self.assertEqual(testbed.ssh_limiter.in_use, 1)
+                testbed.ssh_release()
+            self.assertEqual(testbed.ssh_limiter.in_use, 0)
+        asyncio.run(run())
+
+    def test_backoff_outside_deadline(self):
+        async def run():
+            with tempfile.TemporaryDirectory() as d:
+                node = FlakyNode(d, 1)
+                testbed = StubTestbed(MasterPool(retries=1, backoff=0.3))
+                bounded = Deadline(0.2)
+                await testbed.ssh_acquire(node)
+                try:
+                    with self.assertLogs(level='WARNING'):
+                        await bounded(testbed.ensure_master(node, bounded.paused))
+                finally:
+                    testbed.ssh_release()
+            self.assertTrue(testbed.master_pool.is_alive(node))
+        asyncio.run(run())
+
+
+class DeadlineTest(unittest.TestCase):
+    def test_expires(self):
+        async def run():
+            bounded = Deadline(0.05)
+            with self.assertRaises(asyncio.TimeoutError):
+                await bounded(asyncio.sleep(1))
+        asyncio.run(run())
+
+    def test_paused(self):
+        async def run():
+            bounded = Deadline(0.1)
+
+            async def work():
+                await asyncio.sleep(0.05)
+                with bounded.paused():
+                    await asyncio.sleep(0.2)
+                await asyncio.sleep(0.02)
+                return 'done'
+            self.assertEqual(await bounded(work()), 'done')
+        asyncio.run(run())
+
+
+class StartTestbed:
+    """Records when a node prepares for a timed step."""
+    def __init__(self, prewarm, setup=2.0):
+        self.settings = self
+        self.start_prewarm = prewarm
+        self.master_pool = self
+        self.tracer = Tracer(enabled=False)
+        # seconds that setting up the master takes
+        self.setup = setup
+        self.master = False
+        self.in_use = 0
+        self.sessions = 0
+        self.events = []
+
+    def log(self, event):
+        self.events.append((event, asyncio.get_running_loop().time()))
+
+    async def ssh_acquire(self, node):
+        self.in_use += 1
+        self.log('acquire')
+
+    def ssh_release(self):
+        self.in_use -= 1
+
+    async def ensure_master(self, node):
+        if not self.master:
+            await asyncio.sleep(self.setup)
+            self.master = True
+            self.log('master')
+
+    async def acquire_session(self, node):
+        self.sessions += 1
+        self.log('session')
+
+    def release_session(self, node):
+        self.sessions -= 1
+
+
+class PrepareStartTest(unittest.TestCase):
+    def run_start(self, testbed, target, started_at=None):
+        """
+        Run a timed step at loop time 'target' on an ssh node of
+        'testbed', its first command starts at 'started_at' after it.
+        """
+        async def run():
+            node = gplmtlib.SSHNode(lxml.etree.fromstring(
+                    '<target name="n1" type="ssh"><host>h</host><user>u</user></target>'), testbed)
+            jitter = gplmtlib.StartJitter('step')
+            start = gplmtlib.TimedStart(jitter, node, target)
+
+            async def tasklist():
+                # What SSHNode.session does with a reserved session
+                self.assertEqual(start.reserved, testbed.sessions == 1)
+                testbed.log('tasklist')
+                if started_at is not None:
+                    await asyncio.sleep(started_at)
+                    start.reserved = False
+                    gplmtlib.note_started(node)
+                    testbed.release_session(node)
+                    testbed.ssh_release()
+            await gplmtlib.run_timed(tasklist(), node, start)
+            # A master that wasn't ready before the start still is set up
+            await asyncio.sleep(100)
+            return jitter.stats()
+        loop = VirtualTimeLoop()
+        try:
+            return loop.run_until_complete(run())
+        finally:
+            loop.close()
+
+    def test_prewarm(self):
+        testbed = StartTestbed(30)
+        stats = self.run_start(testbed, 100, 0)
+        self.assertEqual(testbed.events, [
+            ('acquire', 70), ('master', 72),
+            ('acquire', 100 - gplmtlib.RESERVE_AHEAD), ('session', 100 - gplmtlib.RESERVE_AHEAD),
+            ('tasklist', 100)])
+        self.assertEqual((stats['starts'], stats['max']), (1, 0))
+        self.assertEqual((testbed.in_use, testbed.sessions), (0, 0))
+
+    def test_unused_reservation(self):
+        # The reservation is given back when the tasklist doesn't use it
+        testbed = StartTestbed(30)
+        stats = self.run_start(testbed, 100)
+        self.assertEqual(testbed.events[-1], ('tasklist', 100))
+        self.assertEqual((testbed.in_use, testbed.sessions), (0, 0))
+        self.assertEqual(stats['starts'], 0)
+
+    def test_slow_master(self):
+        # The master isn't ready a second before the start, so nothing is
+        # reserved, but setting it up goes on
+        testbed = StartTestbed(30, setup=40)
+        self.run_start(testbed, 100)
+        self.assertEqual(testbed.events, [('acquire', 70), ('tasklist', 100), ('master', 110)])
+        self.assertEqual((testbed.in_use, testbed.sessions), (0, 0))
+
+    def test_short_notice(self):
+        # The step starts sooner than --start-prewarm
+        testbed = StartTestbed(30)
+        self.run_start(testbed, 10)
+        self.assertEqual([t for event, t in testbed.events],
+                         [0, 2, 10 - gplmtlib.RESERVE_AHEAD, 10 - gplmtlib.RESERVE_AHEAD, 10])
+
+    def test_off(self):
+        testbed = StartTestbed(0)
+        stats = self.run_start(testbed, 100)
+        self.assertEqual(testbed.events, [('tasklist', 100)])
+        self.assertEqual(stats['starts'], 0)
+        self.assertIsNone(stats['max'])
+
+
+if __name__ == '__main__':
+    unittest.main()
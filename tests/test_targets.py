@@ -0,0 +1,61 @@
+import unittest
+
+from src.error import ExperimentSyntaxError
+from src.targets import TargetIndex
+
+
+class Node:
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return self.name
+
+
+def make_index(groups, names=('a', 'b', 'c', 'd')):
+    nodes = dict((n, Node(n)) for n in names)
+    return nodes, TargetIndex(nodes, groups)
+
+
+class TargetIndexTest(unittest.TestCase):
+    def test_dedup(self):
+        nodes, index = make_index({'g1': ['a', 'b'], 'g2': ['b', 'c', 'a'], 'all': ['g1', 'g2']})
+        a, b, c = nodes['a'], nodes['b'], nodes['c']
+        self.assertEqual(index.resolve('all'), (a, b, c))
+        self.assertEqual(index.resolve('c g1 a c'), (c, a, b))
+        self.assertEqual(index.resolve('g2 g1'), (b, c, a))
+
+    def test_memo(self):
+        nodes, index = make_index({'g': ['a', 'b']})
+        self.assertIs(index.resolve('g c'), index.resolve('g c'))
+
+    def test_unknown(self):
+        with self.assertRaises(ExperimentSyntaxError):
+            make_index({'g': ['a', 'x']})
+        nodes, index = make_index({})
+        with self.assertRaises(ExperimentSyntaxError):
+            index.resolve('a x')
+
+    def test_cycle(self):
+        with self.assertRaises(ExperimentSyntaxError) as cm:
+            make_index({'g1': ['a', 'g2'], 'g2': ['g3'], 'g3': ['b', 'g1']})
+        self.assertIn("g1 -> g2 -> g3 -> g1", str(cm.exception))
+
+    def test_self_cycle(self):
+        with self.assertRaises(ExperimentSyntaxError):
+            make_index({'g': ['a', 'g']})
+
+    def test_diamond_is_not_a_cycle(self):
+        nodes, index = make_index({'top': ['l', 'r'], 'l': ['bottom'], 'r': ['bottom'], 'bottom': ['d']})
+        self.assertEqual(index.resolve('top'), (nodes['d'],))
+
+    def test_quarantine(self):
+        nodes, index = make_index({'g': ['a', 'b', 'c']})
+        self.assertTrue(index.contains('g', nodes['b']))
+        index.quarantine(['b'])
+        self.assertEqual(index.resolve('g'), (nodes['a'], nodes['c']))
+        self.assertFalse(index.contains('g', nodes['b']))
+
+
+if __name__ == '__main__':
+    unittest.main()
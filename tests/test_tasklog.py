@@ -0,0 +1,86 @@
+import os
+import tempfile
+import unittest
+
+from src.tasklog import LogReader, NodeLog
+
+
+def record(log, task, out, err=b'', status=0):
+    rec = log.begin(task)
+    for i in range(0, len(out), 5):
+        rec.write('out', out[i:i + 5])
+    if err:
+        rec.write('err', err)
+    rec.status = status
+    rec.close()
+
+
+class NodeLogTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.directory = os.path.join(self.tmp.name, 'node')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_runs_dont_overwrite(self):
+        # Regression: every run of a task wrote to the same files
+        log = NodeLog(self.directory)
+        record(log, 't', b'first\n')
+        record(log, 't', b'second\n', b'oops\n', 1)
+        log.close()
+        reader = LogReader(self.directory)
+        self.assertEqual(reader.iterations('t'), [0, 1])
+        self.assertEqual(reader.read('t', 0), b'first\n')
+        self.assertEqual(reader.read('t', 1), b'second\n')
+        self.assertEqual(reader.read('t', 1, 'err'), b'oops\n')
+        self.assertEqual(reader.status('t', 0), 0)
+        self.assertEqual(reader.status('t', 1), 1)
+
+    def test_reopen_appends(self):
+        log = NodeLog(self.directory, segment_size=16, buffer_size=4)
+        record(log, 't', b'0123456789' * 3)
+        log.close()
+        log = NodeLog(self.directory, segment_size=16, buffer_size=4)
+        record(log, 't', b'abcdefghij' * 3)
+        log.close()
+        reader = LogReader(self.directory)
+        self.assertEqual(reader.iterations('t'), [0, 1])
+        self.assertEqual(reader.read('t', 0), b'0123456789' * 3)
+        self.assertEqual(reader.read('t', 1), b'abcdefghij' * 3)
+
+    def test_segments(self):
+        log = NodeLog(self.directory, segment_size=10, buffer_size=4)
+        record(log, 'a', b'x' * 25)
+        record(log, 'b', b'y' * 25)
+        log.close()
+        segments = sorted(f for f in os.listdir(self.directory) if f.startswith('segment-'))
+        self.assertGreater(len(segments), 1)
+        for name in segments:
+            self.assertLessEqual(os.path.getsize(os.path.join(self.directory, name)), 10)
+        reader = LogReader(self.directory)
+        self.assertEqual(reader.read('a', 0), b'x' * 25)
+        self.assertEqual(reader.read('b', 0), b'y' * 25)
+
+    def test_compress(self):
+        log = NodeLog(self.directory, compress=True)
+        record(log, 't', b'hello ' * 1000)
+        log.close()
+        self.assertEqual(LogReader(self.directory).read('t', 0), b'hello ' * 1000)
+
+    def test_cut_off_index(self):
+        log = NodeLog(self.directory)
+        record(log, 't', b'one\n')
+        log.close()
+        with open(os.path.join(self.directory, 'index'), 'a') as f:
+            f.write('["out", "t", 1, 0')
+        log = NodeLog(self.directory)
+        record(log, 't', b'two\n')
+        log.close()
+        reader = LogReader(self.directory)
+        self.assertEqual(reader.read('t', 0), b'one\n')
+        self.assertEqual(reader.read('t', 1), b'two\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import io
+import os
+import subprocess
+import tempfile
+import unittest
+
+from src import transfer
+
+
+class ManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.dir = self.tmp.name
+
+    def write(self, name, data):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def manifest(self, paths):
+        out = subprocess.run(
+                ['sh', '-c', transfer.manifest_command(paths)],
+                stdout=subprocess.PIPE, check=True,
+                env=dict(os.environ, HOME='/home/remote')).stdout
+        return transfer.parse_manifest(out)
+
+    def test_mismatch(self):
+        local_same = self.write('same', b'unchanged\n')
+        local_changed = self.write('changed', b'new contents\n')
+        remote_same = self.write('remote-same', b'unchanged\n')
+        remote_changed = self.write('remote-changed', b'old contents\n')
+        missing = os.path.join(self.dir, 'missing')
+        home, digests = self.manifest([remote_same, remote_changed, missing])
+        self.assertEqual(home, '/home/remote')
+        # Files that don't exist remotely are not in the manifest
+        self.assertEqual(set(digests), {remote_same, remote_changed})
+        same, changed = transfer.digest_files([local_same, local_changed])
+        self.assertEqual(digests[remote_same], same)
+        self.assertNotEqual(digests[remote_changed], changed)
+
+    def test_escaped_names(self):
+        # sha256sum escapes names with a backslash or a newline,
+        # those files are treated as changed
+        path = self.write('back\\slash', b'x')
+        home, digests = self.manifest([path])
+        self.assertEqual(digests, {})
+
+    def test_binary_mode(self):
+        digest = 'ab' * 32
+        home, digests = transfer.parse_manifest(
+                ('/root\n%s *bin\n%s  text\ngarbage\n' % (digest, digest)).encode())
+        self.assertEqual(home, '/root')
+        self.assertEqual(digests, {'bin': digest, 'text': digest})
+
+
+class ArchiveTest(unittest.TestCase):
+    def test_round_trip(self):
+        with tempfile.TemporaryDirectory() as d:
+            source = os.path.join(d, 'source')
+            with open(source, 'wb') as f:
+                f.write(b'payload')
+            os.chmod(source, 0o750)
+            archive = io.BytesIO()
+            transfer.write_archive(archive, [(source, '/remote/dir/file')], compress=True)
+            archive.seek(0)
+            destination = os.path.join(d, 'out', 'file')
+            missing = transfer.extract_archive(
+                    archive, [('/remote/dir/file', destination), ('/remote/other', os.path.join(d, 'other'))],
+                    compress=True)
+            self.assertEqual(missing, ['/remote/other'])
+            with open(destination, 'rb') as f:
+                self.assertEqual(f.read(), b'payload')
+            self.assertEqual(os.stat(destination).st_mode & 0o777, 0o750)
+            self.assertFalse(os.path.exists(destination + '.part'))
+
+
+if __name__ == '__main__':
+    unittest.main()